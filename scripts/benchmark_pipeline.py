@@ -0,0 +1,390 @@
+"""
+benchmark_pipeline.py
+
+End-to-end throughput benchmark of the pipeline. It generates a synthetic QA split, starts
+local mock provider servers (see collect_responses/mock_server.py), and runs each stage as
+its own process, the way run_benchmark.py does:
+
+- responses:<model>         responses_runner against the mock API, with a cold response cache
+- responses_cached:<model>  the same run again, answered entirely from the response cache
+- cache_lookups             raw lookups in the on-disk cache stores written by the first run
+- metrics                   metrics_runner with BioScore graded through the mock batch API
+- graphs                    graphs_runner on the graded results
+
+Each stage reports its wall time, questions (or lookups) per second, peak RSS and exit code.
+The results are saved as JSON and can be compared against a stored baseline; the script exits
+with status 1 when a stage regresses beyond the tolerance, so it can gate changes:
+
+    python -m scripts.benchmark_pipeline --questions 500 --save_baseline
+    python -m scripts.benchmark_pipeline --questions 500 --baseline benchmarks/baseline.json
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import subprocess
+import tempfile
+import uuid as uuid_lib
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import yaml
+import pandas as pd
+
+from scripts.scripts_utils import save_dataset
+from scripts.collect_responses.cache_store import ResponseCacheStore
+from scripts.collect_responses.mock_server import start_mock_server
+from scripts.collect_responses.model_registry import load_model_registry
+
+BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+DEFAULT_CONFIG_PATH = os.path.join(BASE_DIR, 'configs', 'default_config.yaml')
+DEFAULT_BASELINE_PATH = os.path.join(BASE_DIR, 'benchmarks', 'baseline.json')
+DEFAULT_OUTPUT_DIR = os.path.join(BASE_DIR, 'benchmarks', 'results')
+DEFAULT_MODELS = ['gpt-4o', 'claude-3.7-sonnet', 'gemini-2.0-flash', 'perplexity-sonar-huge']
+
+BIO_CATEGORIES = ['Genetics', 'Pharmacology', 'Neurobiology', 'Clinical', 'Drug Discovery']
+REASONING_CATEGORIES = ['Numeric', 'Membership', 'Comparison', 'Estimation', 'Aggregation']
+GENES = ['APOE', 'MAPT', 'SNCA', 'LRRK2', 'GBA', 'TREM2', 'APP', 'PSEN1', 'GRN', 'C9orf72']
+DISEASES = ["Alzheimer's disease", "Parkinson's disease", 'frontotemporal dementia', 'ALS', 'Lewy body dementia']
+
+# Throughput metric reported by each kind of stage
+THROUGHPUT_KEYS = ('questions_per_s', 'lookups_per_s')
+
+
+def make_synthetic_dataset(num_questions: int, seed: int = 0) -> pd.DataFrame:
+    """
+    Generate a QA split with the columns of CARDBiomedBench, from a handful of question templates.
+
+    Args:
+        num_questions (int): Number of questions.
+        seed (int, optional): Random seed. Defaults to 0.
+
+    Returns:
+        pd.DataFrame: The synthetic split.
+    """
+    rng = random.Random(seed)
+    templates = [
+        ("Which variants of {gene} are associated with {disease}?", "Several {gene} variants, including rs{n}, are associated with {disease}."),
+        ("What is the p-value of the top {gene} SNP in {disease} GWAS?", "The top {gene} SNP rs{n} has a p-value of {n}e-8."),
+        ("Is {gene} a drug target for {disease}?", "{gene} is a candidate target for {disease}, with compound CHEMBL{n} in trials."),
+    ]
+    template_uuids = [str(uuid_lib.UUID(int=rng.getrandbits(128))) for _ in templates]
+    rows = []
+    for i in range(num_questions):
+        t = rng.randrange(len(templates))
+        values = {'gene': rng.choice(GENES), 'disease': rng.choice(DISEASES), 'n': rng.randrange(1000, 99999)}
+        question, answer = templates[t]
+        rows.append({
+            'uuid': str(uuid_lib.UUID(int=rng.getrandbits(128))),
+            'template_uuid': template_uuids[t],
+            # The index keeps every question distinct, so the first run never hits the cache
+            'question': f"{question.format(**values)} (#{i})",
+            'answer': answer.format(**values),
+            'bio_category': rng.choice(BIO_CATEGORIES),
+            'reasoning_category': rng.choice(REASONING_CATEGORIES),
+        })
+    return pd.DataFrame(rows)
+
+
+def run_stage(name: str, cmd: List[str], workdir: str, env: dict, items: int) -> dict:
+    """
+    Run one pipeline stage as a subprocess and measure it.
+
+    Args:
+        name (str): Stage name, also used for its log file.
+        cmd (List[str]): Command to run.
+        workdir (str): Working directory; relative cache and batch paths resolve inside it.
+        env (dict): Environment of the subprocess.
+        items (int): Number of questions the stage processes.
+
+    Returns:
+        dict: The stage's 'wall_s', 'questions_per_s', 'peak_rss_mb', 'exit_code' and 'log_path'.
+    """
+    log_dir = os.path.join(workdir, 'logs')
+    os.makedirs(log_dir, exist_ok=True)
+    log_path = os.path.join(log_dir, f"{name.replace(':', '_')}.log")
+    print(f"🔧 Running stage {name}")
+    with open(log_path, 'w') as log_file:
+        start = time.perf_counter()
+        process = subprocess.Popen(cmd, cwd=workdir, env=env, stdout=log_file, stderr=subprocess.STDOUT)
+        # wait4 reports the resource usage of this child alone
+        _, status, usage = os.wait4(process.pid, 0)
+        wall = time.perf_counter() - start
+    exit_code = os.waitstatus_to_exitcode(status)
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak_rss_mb = usage.ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+    if exit_code != 0:
+        print(f"❌ Stage {name} failed with exit code {exit_code}, see {log_path}")
+    return {
+        'wall_s': wall,
+        'questions_per_s': items / wall if wall > 0 else None,
+        'peak_rss_mb': peak_rss_mb,
+        'exit_code': exit_code,
+        'log_path': log_path,
+    }
+
+
+def measure_cache_lookups(cache_dir: str, repeats: int = 3) -> dict:
+    """
+    Measure raw lookup throughput of the on-disk response cache stores in a directory.
+
+    Args:
+        cache_dir (str): Directory holding the `*_cache.jsonl` stores.
+        repeats (int, optional): Number of passes over every key. Defaults to 3.
+
+    Returns:
+        dict: The number of 'lookups', 'wall_s' and 'lookups_per_s'.
+    """
+    print("🔧 Running stage cache_lookups")
+    lookups, wall = 0, 0.0
+    for file_name in sorted(os.listdir(cache_dir)):
+        if not file_name.endswith('_cache.jsonl'):
+            continue
+        store = ResponseCacheStore(os.path.join(cache_dir, file_name))
+        keys = list(store)
+        start = time.perf_counter()
+        for _ in range(repeats):
+            for key in keys:
+                store[key]
+        wall += time.perf_counter() - start
+        lookups += len(keys) * repeats
+        store.close()
+    return {
+        'lookups': lookups,
+        'wall_s': wall,
+        'lookups_per_s': lookups / wall if wall > 0 else None,
+        'exit_code': 0,
+    }
+
+
+def compare_to_baseline(stages: Dict[str, dict], baseline: Dict[str, dict], tolerance: float) -> List[str]:
+    """
+    Compare stage results against a baseline.
+
+    Args:
+        stages (Dict[str, dict]): Stage results of this run.
+        baseline (Dict[str, dict]): Stage results of the baseline run.
+        tolerance (float): Allowed relative slowdown or memory growth, e.g. 0.2 for 20%.
+
+    Returns:
+        List[str]: A description of every regression found.
+    """
+    regressions = []
+    for name, base in baseline.items():
+        current = stages.get(name)
+        if current is None or base.get('exit_code') != 0:
+            continue
+        if current.get('exit_code') != 0:
+            regressions.append(f"{name}: failed (exit code {current.get('exit_code')})")
+            continue
+        for key in THROUGHPUT_KEYS:
+            if base.get(key) and current.get(key) is not None and current[key] < base[key] * (1 - tolerance):
+                regressions.append(f"{name}: {key} {current[key]:.1f} < baseline {base[key]:.1f}")
+        if base.get('peak_rss_mb') and current.get('peak_rss_mb') and current['peak_rss_mb'] > base['peak_rss_mb'] * (1 + tolerance):
+            regressions.append(f"{name}: peak RSS {current['peak_rss_mb']:.0f} MB > baseline {base['peak_rss_mb']:.0f} MB")
+    return regressions
+
+
+def print_results(stages: Dict[str, dict], baseline: Optional[Dict[str, dict]] = None):
+    """
+    Print one line per stage, with the baseline throughput when available.
+    """
+    print("-" * 100)
+    for name, result in stages.items():
+        status = "✅" if result.get('exit_code') == 0 else "❌"
+        throughput = next((f"{result[key]:>10.1f} {key.replace('_per_s', '')}/s" for key in THROUGHPUT_KEYS if result.get(key) is not None), "")
+        rss = f"{result['peak_rss_mb']:>7.0f} MB" if result.get('peak_rss_mb') is not None else ""
+        reference = ""
+        if baseline and name in baseline:
+            base_value = next((baseline[name].get(key) for key in THROUGHPUT_KEYS if baseline[name].get(key) is not None), None)
+            reference = f"  (baseline {base_value:.1f})" if base_value is not None else ""
+        print(f"{status} {name:<40} {result['wall_s']:>8.2f}s {throughput:<24} {rss}{reference}")
+    print("-" * 100)
+
+
+def main():
+    """
+    Run the pipeline benchmark, save the results and compare them against a baseline.
+    """
+    parser = argparse.ArgumentParser(description="Benchmark pipeline throughput offline against mock providers.")
+    parser.add_argument('--config', type=str, default=DEFAULT_CONFIG_PATH, help='Configuration file with prompts and models')
+    parser.add_argument('--questions', type=int, default=200, help='Number of synthetic questions')
+    parser.add_argument('--models', nargs='+', default=DEFAULT_MODELS, help='API models to collect responses from')
+    parser.add_argument('--collection_mode', type=str, choices=['sync', 'async', 'batch'], default='async',
+        help='Response collection mode'
+    )
+    parser.add_argument('--latency', type=str, default='constant:0.05', help='Mock latency distribution, see mock_server.py')
+    parser.add_argument('--error_rate', type=float, default=0.0, help='Share of mock requests failing with 500')
+    parser.add_argument('--rate_limit_rate', type=float, default=0.0, help='Share of mock requests failing with 429')
+    parser.add_argument('--stages', nargs='+', default=['responses', 'responses_cached', 'cache_lookups', 'metrics', 'graphs'],
+        help='Stages to run'
+    )
+    parser.add_argument('--output', type=str, help='Path of the results JSON (default: benchmarks/results/pipeline_<timestamp>.json)')
+    parser.add_argument('--baseline', type=str, help='Baseline JSON to compare against')
+    parser.add_argument('--save_baseline', nargs='?', const=DEFAULT_BASELINE_PATH, help='Also save the results as the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed relative regression before failing')
+    parser.add_argument('--keep_workdir', action='store_true', help='Keep the temporary working directory')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed for the data and the mock servers')
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as f:
+        config = yaml.safe_load(f)
+    registry = load_model_registry(config['models'])
+    unknown = [model for model in args.models if model not in registry or registry[model]['type'] == 'huggingface']
+    if unknown:
+        print(f"❌ Not API models in the configuration: {', '.join(unknown)}")
+        sys.exit(1)
+
+    workdir = tempfile.mkdtemp(prefix='pipeline_benchmark_')
+    qa_path = os.path.join(workdir, 'data', 'synthetic_qa.csv')
+    res_dir = os.path.join(workdir, 'results') + os.sep
+    res_by_model_dir = os.path.join(res_dir, 'by_model')
+    cache_dir = os.path.join(workdir, 'cache')
+    os.makedirs(os.path.dirname(qa_path), exist_ok=True)
+    save_dataset(qa_path, make_synthetic_dataset(args.questions, args.seed))
+
+    # Collection echoes the question; grading needs a valid BioScore
+    collection_server = start_mock_server(latency=args.latency, error_rate=args.error_rate,
+                                          rate_limit_rate=args.rate_limit_rate, batch_delay=1.0, seed=args.seed)
+    grading_server = start_mock_server(latency=args.latency, response_mode='canned', canned_response='2.0',
+                                       batch_delay=1.0, seed=args.seed)
+    env = {
+        **os.environ,
+        'PYTHONPATH': BASE_DIR,
+        'PYTHONUNBUFFERED': '1',
+        # Requests only reach the mock servers, which accept any key
+        'OPENAI_API_KEY': 'mock', 'ANTHROPIC_API_KEY': 'mock', 'GOOGLE_API_KEY': 'mock', 'PERPLEXITY_API_KEY': 'mock',
+    }
+    model_params = config.get('model_params', {})
+    providers = config.get('providers', {})
+    cache_config = {**(config.get('cache') or {}), 'backend': 'disk', 'directory': cache_dir}
+
+    stages = {}
+    try:
+        for cached in (False, True):
+            stage_kind = 'responses_cached' if cached else 'responses'
+            if stage_kind not in args.stages:
+                continue
+            for model_name in args.models:
+                provider_type = registry[model_name]['type']
+                provider_config = providers.get(provider_type, {})
+                if cached:
+                    # Keep the cache but drop the results, so every question is looked up again
+                    results_path = os.path.join(res_by_model_dir, f'{model_name}_responses.csv')
+                    if not os.path.exists(results_path):
+                        if f"responses:{model_name}" not in stages:
+                            print(f"⚠️  Skipping stage {stage_kind}:{model_name}: the cold responses stage did not run")
+                            continue
+                        # A warm run after a cold run without output would measure nothing cached
+                        print(f"❌ Stage {stage_kind}:{model_name} failed: the cold run saved no responses")
+                        stages[f"{stage_kind}:{model_name}"] = {'wall_s': 0.0, 'exit_code': None, 'error': 'no cold-run responses'}
+                        continue
+                    os.remove(results_path)
+                hyperparams = {
+                    'system_prompt': config['prompts']['system_prompt'].rstrip(),
+                    'max_new_tokens': model_params.get('max_tokens', 1024),
+                    'temperature': model_params.get('temperature', 0.0),
+                    'cache': cache_config,
+                    'models': config['models'],
+                    'max_concurrency': provider_config.get('max_concurrency', 1),
+                    'connection': provider_config.get('connection'),
+                    'base_url': collection_server.base_urls()[provider_type],
+                }
+                cmd = [
+                    sys.executable, '-m', 'scripts.responses_runner',
+                    '--qa_path', qa_path,
+                    '--res_by_model_dir', res_by_model_dir,
+                    '--model_name', model_name,
+                    '--hyperparams', json.dumps(hyperparams),
+                    '--collection_mode', args.collection_mode,
+                ]
+                stages[f"{stage_kind}:{model_name}"] = run_stage(f"{stage_kind}:{model_name}", cmd, workdir, env, args.questions)
+
+        if 'cache_lookups' in args.stages and os.path.isdir(cache_dir):
+            stages['cache_lookups'] = measure_cache_lookups(cache_dir)
+
+        if 'metrics' in args.stages:
+            hyperparams = {
+                'system_prompt': config['prompts']['bioscore_system_prompt'].rstrip(),
+                'max_new_tokens': model_params.get('max_tokens', 1024),
+                'temperature': model_params.get('temperature', 0.0),
+                'cache': cache_config,
+                'models': config['models'],
+                'base_url': grading_server.base_urls()['openai'],
+                'batch_poll_seconds': 1,
+            }
+            cmd = [
+                sys.executable, '-m', 'scripts.metrics_runner',
+                '--res_by_model_dir', res_by_model_dir,
+                '--models_to_grade', *args.models,
+                '--metrics_to_use', 'BioScore',
+                '--hyperparams', json.dumps(hyperparams),
+                '--bioscore_grading_prompt', config['prompts']['bioscore_grading_prompt'].rstrip(),
+            ]
+            stages['metrics'] = run_stage('metrics', cmd, workdir, env, args.questions * len(args.models))
+
+        if 'graphs' in args.stages:
+            cmd = [
+                sys.executable, '-m', 'scripts.graphs_runner',
+                '--qa_path', qa_path,
+                '--res_dir', res_dir,
+                '--scored_path', os.path.join(res_dir, 'synthetic_compiled.csv'),
+                '--models_to_process', *args.models,
+                '--metrics_to_use', 'BioScore',
+            ]
+            stages['graphs'] = run_stage('graphs', cmd, workdir, env, args.questions)
+    finally:
+        collection_server.shutdown()
+        grading_server.shutdown()
+        if not args.keep_workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+            for result in stages.values():
+                result.pop('log_path', None)
+
+    results = {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'host': platform.node(),
+        'python': platform.python_version(),
+        'settings': {
+            'questions': args.questions,
+            'models': args.models,
+            'collection_mode': args.collection_mode,
+            'latency': args.latency,
+            'error_rate': args.error_rate,
+            'rate_limit_rate': args.rate_limit_rate,
+        },
+        'stages': stages,
+    }
+    output_path = args.output or os.path.join(DEFAULT_OUTPUT_DIR, f"pipeline_{datetime.now():%Y%m%d-%H%M%S}.json")
+    for path in filter(None, [output_path, args.save_baseline]):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(results, f, indent=2)
+    print(f"🔧 Results saved to {output_path}" + (f" and {args.save_baseline}" if args.save_baseline else ""))
+    if args.keep_workdir:
+        print(f"🔧 Working directory kept at {workdir}")
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        if baseline.get('settings') != results['settings']:
+            print("⚠️  Baseline was recorded with different settings; comparisons may not be meaningful")
+    print_results(stages, baseline['stages'] if baseline else None)
+
+    failed = [name for name, result in stages.items() if result.get('exit_code') != 0]
+    regressions = compare_to_baseline(stages, baseline['stages'], args.tolerance) if baseline else []
+    for regression in regressions:
+        print(f"❌ Regression in {regression}")
+    if failed or regressions:
+        sys.exit(1)
+    print("✅ No regressions" if baseline else "✅ Benchmark completed")
+
+
+if __name__ == "__main__":
+    main()
@@ -20,6 +20,15 @@ while [[ $# -gt 0 ]]; do
             ARGS+=("--model" "$2")
             shift 2
             ;;
+        --shard|--merge_shards)
+            ARGS+=("$1" "$2")
+            shift 2
+            ;;
+        --shards)
+            # Shard count of a SLURM job array (--array=0-(N-1)); the array task ID selects the shard
+            ARGS+=("--shard" "${SLURM_ARRAY_TASK_ID:?--shards requires a SLURM job array}/$2")
+            shift 2
+            ;;
         --run_responses|--run_metrics|--run_graphs)
             ARGS+=("$1")
             shift
@@ -0,0 +1,516 @@
+"""
+cache_store.py
+
+Append-only, crash-safe key/value store for model response caches.
+
+Each insert appends one JSON record to a `.jsonl` data file and one entry to a `.idx`
+index file, so writing a response costs O(1) regardless of the cache size. The index
+(key -> offset in the data file) is loaded lazily on first access, and values are only
+read from disk when they are looked up. A write torn by a killed job is dropped on the
+next load, and an index entry pointing at an unreadable record triggers a rebuild of the index
+from the data file. Concurrent jobs writing the same store, such as the shards of one model, take a
+file lock around each append so records and their index entries stay consistent. Under the lock,
+a job first indexes the records other jobs appended, and reloads the store if another job
+compacted it, so compaction keeps every job's records and no job writes to a replaced file.
+
+Keys are SHA-256 digests over the model name, system prompt, query and generation
+parameters (see `make_cache_key`), so every key has the same small size and cached
+responses are never reused across different generation settings.
+
+This script can also be run directly to migrate legacy `*_cache.json` files in
+`.cache/model_responses_cache` to the append-only format.
+"""
+
+import os
+import re
+import json
+import fcntl
+import hashlib
+import argparse
+from contextlib import contextmanager
+from collections.abc import MutableMapping
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.dirname(__file__), '..', '..', '.cache', 'model_responses_cache')
+
+HASHED_KEY_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+
+class ResponseCacheStore(MutableMapping):
+    def __init__(self, path: str, legacy_path: str = None, fsync: bool = False, key_migration=None):
+        """
+        Parameters:
+        - path (str): Path to the `.jsonl` data file. The index is stored next to it as `<path>.idx`.
+        - legacy_path (str): Optional legacy JSON cache to migrate on first access.
+          Defaults to the data path with a `.json` extension.
+        - fsync (bool): Whether to fsync after every insert, to survive OS crashes and not only killed jobs.
+        - key_migration (callable): Optional function called with the store once its index is loaded,
+          used to rewrite entries stored under legacy keys.
+        """
+        self.path = path
+        self.index_path = f"{path}.idx"
+        self.lock_path = f"{path}.lock"
+        self.legacy_path = legacy_path if legacy_path is not None else os.path.splitext(path)[0] + '.json'
+        self.fsync = fsync
+        self.key_migration = key_migration
+        self._index = None
+        self._data_writer = None
+        self._index_writer = None
+        self._reader = None
+        self._lock_file = None
+        # Identity and indexed size of the data file, to notice appends and compactions by other jobs
+        self._data_inode = None
+        self._data_size = 0
+
+    @contextmanager
+    def _locked(self):
+        """
+        Hold an exclusive lock on the store, so concurrent jobs do not interleave appends or
+        truncate a record another job is still writing.
+        """
+        if self._lock_file is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self._lock_file = open(self.lock_path, 'a')
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def _load_index(self):
+        """
+        Build the in-memory index on first access, migrating a legacy cache first if there is one.
+        """
+        if self._index is not None:
+            return
+        if self.legacy_path != self.path and os.path.exists(self.legacy_path) and not os.path.exists(self.path):
+            migrate_legacy_cache(self.legacy_path, self.path)
+
+        with self._locked():
+            self._read_index()
+
+        if self.key_migration is not None:
+            self.key_migration(self)
+
+    def _read_index(self):
+        """
+        Build the in-memory index from the index file, recovering any records that were
+        appended to the data file but not indexed before a crash. Must be called with the store locked.
+        """
+        self._close_writers()
+        self._close_reader()
+        self._index = {}
+        data_size = self._truncate_torn_tail()
+        indexed_end = 0
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r') as f:
+                for line in f:
+                    if not line.endswith('\n'):
+                        break
+                    try:
+                        key, offset, length = json.loads(line)
+                    except ValueError:
+                        continue
+                    if offset + abs(length) > data_size:
+                        continue
+                    self._apply(key, offset, length)
+                    indexed_end = max(indexed_end, offset + abs(length))
+
+        # Recover records written to the data file after the last index entry
+        if data_size > indexed_end:
+            tombstones = self._scan_data(indexed_end)
+            self._rewrite_index([entry for entry in tombstones if entry[0] not in self._index])
+        self._data_size = data_size
+        self._data_inode = os.stat(self.path).st_ino if os.path.exists(self.path) else None
+
+    def _sync(self):
+        """
+        Catch up with other jobs sharing the store: reload the index if the data file was replaced
+        by a compaction, index the records appended since this job last looked, and reopen an index
+        writer whose file was rewritten. Must be called with the store locked.
+        """
+        try:
+            data_stat = os.stat(self.path)
+        except FileNotFoundError:
+            return
+        if data_stat.st_ino != self._data_inode:
+            self._read_index()
+            return
+        if data_stat.st_size > self._data_size:
+            indexed_size = self._data_size
+            self._data_size = self._truncate_torn_tail()
+            self._scan_data(indexed_size)
+        if self._index_writer is not None and os.path.exists(self.index_path):
+            if os.fstat(self._index_writer.fileno()).st_ino != os.stat(self.index_path).st_ino:
+                self._close_writers()
+
+    def _scan_data(self, start: int) -> list:
+        """
+        Index the records of the data file from byte `start` onwards. Undecodable lines are skipped.
+        Must be called with the store locked.
+
+        Returns:
+        - list: The (key, offset, length) entries of the deletions found.
+        """
+        tombstones = []
+        with open(self.path, 'rb') as f:
+            f.seek(start)
+            offset = start
+            for line in f:
+                try:
+                    record = json.loads(line)
+                    length = -len(line) if record.get('deleted') else len(line)
+                    self._apply(record['key'], offset, length)
+                    if length < 0:
+                        tombstones.append((record['key'], offset, length))
+                except (ValueError, KeyError):
+                    pass
+                offset += len(line)
+        return tombstones
+
+    def _rebuild_index(self):
+        """
+        Rebuild the index from a full scan of the data file, after an index entry pointed at a
+        record that could not be read. Entries whose records are unreadable are dropped.
+        """
+        with self._locked():
+            self._close_reader()
+            self._index = {}
+            self._data_size = self._truncate_torn_tail()
+            tombstones = self._scan_data(0) if self._data_size > 0 else []
+            self._rewrite_index([entry for entry in tombstones if entry[0] not in self._index])
+            self._data_inode = os.stat(self.path).st_ino if os.path.exists(self.path) else None
+
+    def _truncate_torn_tail(self) -> int:
+        """
+        Drop a trailing partial record left by an interrupted write.
+
+        Returns:
+        - int: The size of the data file after truncation.
+        """
+        if not os.path.exists(self.path):
+            return 0
+        size = os.path.getsize(self.path)
+        if size == 0:
+            return 0
+        with open(self.path, 'rb+') as f:
+            f.seek(size - 1)
+            if f.read(1) == b'\n':
+                return size
+            # Walk back to the last complete line
+            position = size
+            while position > 0:
+                step = min(4096, position)
+                position -= step
+                f.seek(position)
+                chunk = f.read(step)
+                newline = chunk.rfind(b'\n')
+                if newline != -1:
+                    position += newline + 1
+                    break
+            f.truncate(position)
+            return position
+
+    def _apply(self, key: str, offset: int, length: int):
+        if length < 0:
+            self._index.pop(key, None)
+        else:
+            self._index[key] = (offset, length)
+
+    def _rewrite_index(self, tombstones: list = ()):
+        """
+        Rewrite the index file from the in-memory index. Recovered deletions are kept as
+        entries so the next load knows the data file is fully indexed.
+        """
+        self._close_writers()
+        tmp_path = f"{self.index_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            for key, (offset, length) in self._index.items():
+                f.write(json.dumps([key, offset, length]) + '\n')
+            for key, offset, length in tombstones:
+                f.write(json.dumps([key, offset, length]) + '\n')
+        os.replace(tmp_path, self.index_path)
+
+    def _append(self, record: dict) -> tuple:
+        """
+        Append a record to the data file and its index entry to the index file.
+
+        Returns:
+        - tuple: The (offset, length) of the record, with a negative length for deletions.
+        """
+        line = (json.dumps(record) + '\n').encode('utf-8')
+        length = -len(line) if record.get('deleted') else len(line)
+        with self._locked():
+            self._sync()
+            if self._data_writer is None:
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+                self._data_writer = open(self.path, 'ab')
+                self._index_writer = open(self.index_path, 'a')
+                self._data_inode = os.fstat(self._data_writer.fileno()).st_ino
+            # Other jobs may have appended since this one last wrote, so the offset is the size on disk
+            offset = os.fstat(self._data_writer.fileno()).st_size
+            self._data_writer.write(line)
+            self._data_writer.flush()
+            self._data_size = offset + len(line)
+            self._index_writer.write(json.dumps([record['key'], offset, length]) + '\n')
+            self._index_writer.flush()
+            if self.fsync:
+                os.fsync(self._data_writer.fileno())
+                os.fsync(self._index_writer.fileno())
+        return offset, length
+
+    def _refresh(self):
+        """
+        Catch up with other jobs if the data file grew or was replaced since this job last read it.
+        """
+        self._load_index()
+        try:
+            data_stat = os.stat(self.path)
+        except FileNotFoundError:
+            return
+        if data_stat.st_ino != self._data_inode or data_stat.st_size > self._data_size:
+            with self._locked():
+                self._sync()
+
+    def __contains__(self, key) -> bool:
+        self._refresh()
+        return key in self._index
+
+    def _read(self, key: str):
+        """
+        Read the value of an indexed key, raising ValueError or KeyError if its record is unreadable.
+        """
+        offset, length = self._index[key]
+        if self._reader is None:
+            self._reader = open(self.path, 'rb')
+        self._reader.seek(offset)
+        record = json.loads(self._reader.read(length))
+        if not isinstance(record, dict) or record.get('key') != key:
+            raise ValueError(f"record at offset {offset} does not belong to the key")
+        return record['value']
+
+    def __getitem__(self, key: str):
+        self._refresh()
+        if key not in self._index:
+            raise KeyError(key)
+        try:
+            return self._read(key)
+        except (ValueError, KeyError) as e:
+            # A stale or damaged index entry; rebuild the index rather than failing the lookup
+            print(f"⚠️  Unreadable cache entry in {os.path.basename(self.path)} ({e}), rebuilding the index")
+            self._rebuild_index()
+        try:
+            return self._read(key)
+        except (ValueError, KeyError):
+            # Still unreadable, e.g. compacted again by another job; treat it as missing
+            self._index.pop(key, None)
+            raise KeyError(key)
+
+    def __setitem__(self, key: str, value):
+        self._load_index()
+        offset, length = self._append({'key': key, 'value': value})
+        self._index[key] = (offset, length)
+
+    def __delitem__(self, key: str):
+        self._refresh()
+        if key not in self._index:
+            raise KeyError(key)
+        self._append({'key': key, 'deleted': True})
+        # Another job may have deleted the key too; its tombstone is indexed during the append
+        self._index.pop(key, None)
+
+    def __iter__(self):
+        self._refresh()
+        return iter(list(self._index))
+
+    def __len__(self) -> int:
+        self._refresh()
+        return len(self._index)
+
+    def oldest_key(self):
+        """
+        Get the key that was first inserted among the live entries, or None if the store is empty.
+        """
+        self._refresh()
+        return next(iter(self._index), None)
+
+    def flush(self):
+        """
+        Flush pending writes. Inserts are flushed as they happen, so this only matters with external buffering.
+        """
+        if self._data_writer is not None:
+            self._data_writer.flush()
+            self._index_writer.flush()
+
+    def compact(self):
+        """
+        Rewrite the data file keeping only the latest value of each live key, reclaiming
+        space used by overwritten and deleted records.
+        """
+        self._load_index()
+        with self._locked():
+            # Include the records other jobs appended, and drop handles to a file already compacted
+            self._sync()
+            tmp_path = f"{self.path}.tmp"
+            new_index = {}
+            with open(tmp_path, 'wb') as f:
+                offset = 0
+                for key in self._index:
+                    try:
+                        value = self._read(key)
+                    except (ValueError, KeyError):
+                        # Unreadable records are dropped rather than copied
+                        continue
+                    line = (json.dumps({'key': key, 'value': value}) + '\n').encode('utf-8')
+                    f.write(line)
+                    new_index[key] = (offset, len(line))
+                    offset += len(line)
+            self._close_writers()
+            self._close_reader()
+            os.replace(tmp_path, self.path)
+            self._index = new_index
+            self._data_inode = os.stat(self.path).st_ino
+            self._data_size = offset
+            self._rewrite_index()
+
+    def _close_writers(self):
+        for handle in (self._data_writer, self._index_writer):
+            if handle is not None:
+                handle.close()
+        self._data_writer = None
+        self._index_writer = None
+
+    def _close_reader(self):
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+
+    def close(self):
+        """
+        Close any open file handles. The store reopens them on next use.
+        """
+        self._close_writers()
+        self._close_reader()
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+
+def make_cache_key(model_name: str, system_prompt: str, query: str, **params) -> str:
+    """
+    Build a fixed-size cache key from a canonical encoding of everything that affects a response.
+
+    Parameters:
+    - model_name (str): The API or Hugging Face model ID.
+    - system_prompt (str): The system prompt sent with the query.
+    - query (str): The input query string.
+    - **params: Generation parameters such as max_tokens and temperature.
+
+    Returns:
+    - str: The hex SHA-256 digest of the canonical tuple.
+    """
+    canonical = json.dumps(
+        [model_name, system_prompt, query, params],
+        sort_keys=True,
+        ensure_ascii=False,
+        separators=(',', ':')
+    )
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def legacy_key_migration(model_name: str, system_prompt: str, get_cache_key):
+    """
+    Build a key migration that rewrites entries stored under the legacy
+    `{model_name}_{system_prompt}_{query}` keys to hashed keys. Legacy entries for other
+    system prompts (e.g. the BioScore grader sharing a model's cache) are left alone
+    until a query instance with that system prompt opens the store. Legacy keys did not
+    record generation parameters, so migrated entries take the opening instance's.
+
+    Parameters:
+    - model_name (str): The model name used in the legacy keys.
+    - system_prompt (str): The system prompt used in the legacy keys.
+    - get_cache_key (callable): Maps a query string to its hashed key.
+
+    Returns:
+    - callable: A function to pass as `key_migration` to `ResponseCacheStore`.
+    """
+    prefix = f"{model_name}_{system_prompt}_"
+
+    def migrate(store: ResponseCacheStore):
+        legacy_keys = [
+            key for key in store._index
+            if key.startswith(prefix) and not HASHED_KEY_PATTERN.match(key)
+        ]
+        for key in legacy_keys:
+            new_key = get_cache_key(key[len(prefix):])
+            if new_key not in store._index:
+                store[new_key] = store[key]
+            del store[key]
+        if legacy_keys:
+            store.compact()
+            print(f"🔧 Migrated {len(legacy_keys)} cache entries to hashed keys in {os.path.basename(store.path)}")
+
+    return migrate
+
+
+def migrate_legacy_cache(legacy_path: str, store_path: str) -> int:
+    """
+    Copy a legacy whole-file JSON cache into an append-only store, then rename the
+    legacy file to `<legacy_path>.migrated` so it is not migrated again.
+
+    Parameters:
+    - legacy_path (str): Path to the legacy `*_cache.json` file.
+    - store_path (str): Path to the `.jsonl` store to create.
+
+    Returns:
+    - int: The number of migrated entries.
+    """
+    try:
+        with open(legacy_path, 'r') as f:
+            legacy_cache = json.load(f)
+    except Exception as e:
+        print(f"Error loading legacy cache file {legacy_path}: {e}")
+        return 0
+
+    # Build the store under a temporary name so an interrupted migration is retried from scratch
+    tmp_path = f"{store_path}.migrating"
+    for path in (tmp_path, f"{tmp_path}.idx"):
+        if os.path.exists(path):
+            os.remove(path)
+    store = ResponseCacheStore(tmp_path, legacy_path=tmp_path)
+    for key, value in legacy_cache.items():
+        store[key] = value
+    store.close()
+    os.replace(f"{tmp_path}.idx", f"{store_path}.idx")
+    os.replace(tmp_path, store_path)
+    os.replace(legacy_path, f"{legacy_path}.migrated")
+    return len(legacy_cache)
+
+
+def main():
+    """
+    Migrate every legacy JSON cache in the cache directory to the append-only format.
+    """
+    parser = argparse.ArgumentParser(description="Migrate legacy JSON response caches to append-only stores.")
+    parser.add_argument('--cache_dir', type=str, default=DEFAULT_CACHE_DIR,
+        help='Directory containing the *_cache.json files'
+    )
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.cache_dir):
+        print(f"❌ Cache directory {args.cache_dir} does not exist.")
+        return
+
+    for file_name in sorted(os.listdir(args.cache_dir)):
+        if not file_name.endswith('_cache.json'):
+            continue
+        legacy_path = os.path.join(args.cache_dir, file_name)
+        store_path = os.path.splitext(legacy_path)[0] + '.jsonl'
+        if os.path.exists(store_path):
+            print(f"⚠️  Skipping {file_name}: {os.path.basename(store_path)} already exists")
+            continue
+        migrated = migrate_legacy_cache(legacy_path, store_path)
+        print(f"🔧 Migrated {migrated} entries from {file_name}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""
+checkpoint.py
+
+Incremental checkpoints for response collection. Completed responses and their query
+metrics are appended to a `{model}_responses.checkpoint.jsonl` file as they arrive, so a
+killed job can resume by skipping every UUID that already has a valid response. Each record
+carries the response cache key of its query, so a rerun with a different system prompt or
+generation parameters does not reuse responses collected with the old ones.
+"""
+
+import os
+import json
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+import pandas as pd
+
+from scripts.scripts_utils import load_dataset
+
+
+class ResponseCheckpoint:
+    def __init__(self, path: str, flush_every: int = 25, flush_interval: float = 60.0):
+        """
+        Parameters:
+        - path (str): Path to the `.jsonl` checkpoint file.
+        - flush_every (int): Write buffered responses after this many completions.
+        - flush_interval (float): Write buffered responses after this many seconds.
+        """
+        self.path = path
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.buffer = []
+        self.last_flush = time.monotonic()
+
+    def load(self) -> Dict[str, dict]:
+        """
+        Load the responses recorded by a previous run, ignoring a torn final line.
+
+        Returns:
+        - Dict[str, dict]: Mapping of UUID to its record, with the 'response' and any query metrics.
+        """
+        records = {}
+        if not os.path.exists(self.path):
+            return records
+        with open(self.path, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                    uuid = str(record.pop('uuid'))
+                    if 'response' not in record:
+                        continue
+                    records[uuid] = record
+                except (ValueError, KeyError):
+                    continue
+        return records
+
+    def add(self, uuid: str, response: str, metrics: Optional[dict] = None, cache_key: Optional[str] = None):
+        """
+        Record a completed response, its query metrics and its query's cache key, writing the buffer
+        out if a checkpoint is due.
+        """
+        self.buffer.append({'uuid': str(uuid), 'response': response, **(metrics or {}), 'cache_key': cache_key})
+        if len(self.buffer) >= self.flush_every or time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Append buffered responses to the checkpoint file.
+        """
+        if self.buffer:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            with open(self.path, 'a') as f:
+                for record in self.buffer:
+                    f.write(json.dumps(record) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self.buffer = []
+        self.last_flush = time.monotonic()
+
+    def remove(self):
+        """
+        Delete the checkpoint file once the final results have been written.
+        """
+        self.buffer = []
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def load_completed_responses(
+    save_path: str,
+    checkpoint: ResponseCheckpoint,
+    response_col: str,
+    is_valid: Callable[[str], bool],
+    metric_cols: Optional[Dict[str, str]] = None,
+    cache_keys: Optional[Dict[str, str]] = None,
+    cache_key_col: Optional[str] = None
+) -> Dict[str, dict]:
+    """
+    Gather valid responses and their query metrics from a previous results CSV and from the checkpoint file.
+
+    Args:
+        save_path (str): Path to the `{model}_responses.csv` results file.
+        checkpoint (ResponseCheckpoint): The model's checkpoint.
+        response_col (str): Name of the response column, e.g. `{model}_response`.
+        is_valid (Callable): Returns True for responses that do not need to be collected again.
+        metric_cols (Dict[str, str], optional): Mapping of metric name to its column in the results CSV.
+        cache_keys (Dict[str, str], optional): Mapping of UUID to the cache key of its query under the
+            current settings. When given, a response is only reused if it was recorded with that key.
+        cache_key_col (str, optional): Name of the cache key column in the results CSV, e.g. `{model}_cache_key`.
+
+    Returns:
+        Dict[str, dict]: Mapping of UUID to a record with the valid 'response' and the metrics found for it.
+    """
+    metric_cols = metric_cols or {}
+
+    def is_current(uuid: str, cache_key) -> bool:
+        return cache_keys is None or (cache_key is not None and cache_keys.get(uuid) == cache_key)
+
+    completed = {}
+    if os.path.exists(save_path):
+        previous = load_dataset(save_path)
+        if 'uuid' in previous.columns and response_col in previous.columns:
+            has_keys = cache_key_col is not None and cache_key_col in previous.columns
+            for _, row in previous.iterrows():
+                response = row[response_col]
+                cache_key = row[cache_key_col] if has_keys and not pd.isna(row[cache_key_col]) else None
+                if isinstance(response, str) and is_valid(response) and is_current(str(row['uuid']), cache_key):
+                    record = {'response': response}
+                    for metric, col in metric_cols.items():
+                        if col in previous.columns and not pd.isna(row[col]):
+                            record[metric] = row[col]
+                    completed[str(row['uuid'])] = record
+    for uuid, record in checkpoint.load().items():
+        response = record['response']
+        if isinstance(response, str) and is_valid(response) and is_current(uuid, record.pop('cache_key', None)):
+            completed[uuid] = record
+    return completed
+
+
+def is_valid_response(response: str, query_checker: Callable[[str], Tuple[str, bool]]) -> bool:
+    """
+    Check that a stored response is a real answer rather than an error left by a failed query.
+    """
+    return bool(response) and not response.startswith("ERROR:") and query_checker(response)[1]
@@ -1,24 +1,43 @@
 import os
 import gc
 import json
+import time
 from dotenv import load_dotenv
 import anthropic
 
-class ClaudeQuery:
-    def __init__(self, system_prompt, model_name, max_tokens, temperature):
+from scripts.collect_responses.response_cache import ResponseCacheMixin
+from scripts.collect_responses.rate_limiter import get_rate_limiter, estimate_tokens
+from scripts.collect_responses.hedging import get_hedger
+from scripts.collect_responses.query_result import QueryResult
+
+# Prompt cache breakpoint: the prompt up to and including the marked block is cached for a few minutes
+CACHE_CONTROL = {"type": "ephemeral"}
+
+class ClaudeQuery(ResponseCacheMixin):
+    def __init__(self, system_prompt, model_name, max_tokens, temperature, rate_limit=None, cache_config=None, base_url=None, hedging=None, prompt_prefix=None):
         self.system_prompt = system_prompt
+        # Fixed opening shared by many queries, e.g. the BioScore grading instructions
+        self.prompt_prefix = prompt_prefix
         self.model_name = model_name
         self.max_tokens = max_tokens
         self.temperature = temperature
+        self.base_url = base_url
+        self.rate_limiter = get_rate_limiter('anthropic', rate_limit)
+        self.hedger = get_hedger('anthropic', hedging)
+        self.cache_config = cache_config
         self.cache_file = self.get_cache_file_path()
         self.cache = self.load_cache()
-        self.model = self.initialize_claude_model()
+        self.model = self.initialize_claude_model(base_url)
+        self.async_model = self.initialize_async_claude_model(base_url)
 
     @staticmethod
-    def initialize_claude_model():
+    def initialize_claude_model(base_url=None):
         """
         Initialize an anthropic model.
 
+        Parameters:
+        - base_url (str): Optional API base URL, e.g. a local stand-in server. Defaults to the Anthropic API.
+
         Returns:
         - anthropic.Anthropic: Initialized anthropic model.
         """
@@ -26,98 +45,201 @@ class ClaudeQuery:
             load_dotenv(os.path.join(os.path.dirname(__file__), '../../configs/.env'))
             anthropic_api_key = os.environ.get("ANTHROPIC_API_KEY")
             if anthropic_api_key:
-                return anthropic.Anthropic(api_key=anthropic_api_key)
+                return anthropic.Anthropic(api_key=anthropic_api_key, base_url=base_url)
             else:
                 print("Anthropic API key not found in environment variables.")
         except Exception as e:
             print(f"Error initializing Claude model: {e}")
         return None
 
-    def get_cache_file_path(self):
+    @staticmethod
+    def initialize_async_claude_model(base_url=None):
+        """
+        Initialize an asynchronous anthropic model used for concurrent collection.
+
+        Parameters:
+        - base_url (str): Optional API base URL, e.g. a local stand-in server. Defaults to the Anthropic API.
+
+        Returns:
+        - anthropic.AsyncAnthropic: Initialized asynchronous anthropic model.
+        """
+        try:
+            load_dotenv(os.path.join(os.path.dirname(__file__), '../../configs/.env'))
+            anthropic_api_key = os.environ.get("ANTHROPIC_API_KEY")
+            if anthropic_api_key:
+                return anthropic.AsyncAnthropic(api_key=anthropic_api_key, base_url=base_url)
+        except Exception as e:
+            print(f"Error initializing async Claude model: {e}")
+        return None
+
+    def query(self, query: str) -> str:
         """
-        Get the path to the cache file based on the model name.
+        Query the Claude API or retrieve from cache if available.
+
+        Parameters:
+        - query (str): The input query string.
 
         Returns:
-        - str: The cache file path.
+        - str: The response content from the API or the cached response.
         """
-        cache_dir = os.path.join(os.path.dirname(__file__), '..', '..', '.cache', 'model_responses_cache')
-        os.makedirs(cache_dir, exist_ok=True)
-        return os.path.join(cache_dir, f'{self.model_name}_cache.json')
+        return self.query_result(query).response
 
-    def load_cache(self):
+    async def aquery(self, query: str) -> str:
         """
-        Load the cache from the cache file.
-        
+        Asynchronously query the Claude API or retrieve from cache if available.
+
+        Parameters:
+        - query (str): The input query string.
+
         Returns:
-        - dict: The loaded cache data.
+        - str: The response content from the API or the cached response.
         """
-        if os.path.exists(self.cache_file):
-            try:
-                with open(self.cache_file, 'r') as f:
-                    return json.load(f)
-            except Exception as e:
-                print(f"Error loading cache file: {e}")
-        return {}
+        return (await self.aquery_result(query)).response
 
-    def save_cache(self):
+    def query_result(self, query: str) -> QueryResult:
         """
-        Save the cache to a cache file.
+        Query the Claude API or retrieve from cache if available, with timing and token usage.
+
+        Parameters:
+        - query (str): The input query string.
+
+        Returns:
+        - QueryResult: The response content or an error message, with request metrics.
         """
+        cache_key = self.get_cache_key(query)
+
+        # Check if the result is already cached
+        if cache_key in self.cache:
+            return QueryResult(self.cache[cache_key], cache_hit=True)
+
+        # If not cached, query the API
+        tokens = estimate_tokens(self.system_prompt, query, max_tokens=self.max_tokens)
+        self.rate_limiter.acquire(tokens)
+        start = time.perf_counter()
         try:
-            with open(self.cache_file, 'w') as f:
-                json.dump(self.cache, f)
+            message = self.hedger.run(
+                lambda: self.model.messages.create(
+                    model=self.model_name,
+                    max_tokens=self.max_tokens,
+                    temperature=self.temperature,
+                    system=self.build_system(),
+                    messages=self.build_messages(query)
+                ),
+                reserve=lambda: self.rate_limiter.try_acquire(tokens)
+            )
+            return self._message_result(cache_key, message, time.perf_counter() - start)
         except Exception as e:
-            print(f"Error saving cache file: {e}")
+            self.rate_limiter.record_error(e)
+            return QueryResult.from_error(self.model_name, e, latency_s=time.perf_counter() - start)
+
+    def build_system(self):
+        """
+        Build the system prompt, marked as a prompt cache breakpoint so requests after the first
+        read it from the cache.
+
+        Returns:
+        - The system prompt as a cached text block, or the plain (empty) prompt.
+        """
+        if not self.system_prompt or not self.system_prompt.strip():
+            return self.system_prompt
+        return [{"type": "text", "text": self.system_prompt, "cache_control": CACHE_CONTROL}]
 
-    def get_cache_key(self, query: str):
+    def build_messages(self, query: str) -> list:
         """
-        Generate a unique cache key based on the model name, query, and system prompt.
+        Build the user message for a query. A query starting with `prompt_prefix` is split after
+        the prefix, which is marked as a second cache breakpoint.
 
         Parameters:
         - query (str): The input query string.
 
         Returns:
-        - str: The cache key.
+        - list: The user message.
         """
-        return f"{self.model_name}_{self.system_prompt}_{query}"
+        prefix = self.prompt_prefix
+        if prefix and prefix.strip() and query.startswith(prefix) and query[len(prefix):].strip():
+            content = [
+                {"type": "text", "text": prefix, "cache_control": CACHE_CONTROL},
+                {"type": "text", "text": query[len(prefix):]},
+            ]
+        else:
+            content = query
+        return [{"role": "user", "content": content}]
 
-    def query(self, query: str) -> str:
+    async def aquery_result(self, query: str) -> QueryResult:
         """
-        Query the Claude API or retrieve from cache if available.
+        Asynchronously query the Claude API or retrieve from cache if available, with timing and token usage.
 
         Parameters:
         - query (str): The input query string.
 
         Returns:
-        - str: The response content from the API or the cached response.
+        - QueryResult: The response content or an error message, with request metrics.
         """
         cache_key = self.get_cache_key(query)
 
         # Check if the result is already cached
         if cache_key in self.cache:
-            return self.cache[cache_key]
+            return QueryResult(self.cache[cache_key], cache_hit=True)
 
+        # Identical queries already in flight wait on that request instead of sending their own
+        return await self.coalesce_request(cache_key, lambda: self._arequest(query, cache_key))
+
+    async def _arequest(self, query: str, cache_key: str) -> QueryResult:
+        """
+        Send an uncached query to the Claude API and cache the response.
+        """
         # If not cached, query the API
+        tokens = estimate_tokens(self.system_prompt, query, max_tokens=self.max_tokens)
+        await self.rate_limiter.aacquire(tokens)
+        start = time.perf_counter()
         try:
-            message = self.model.messages.create(
-                model=self.model_name,
-                max_tokens=self.max_tokens,
-                temperature=self.temperature,
-                system=self.system_prompt,
-                messages=[
-                    {"role": "user", "content": query},
-                ]
+            message = await self.hedger.arun(
+                lambda: self.async_model.messages.create(
+                    model=self.model_name,
+                    max_tokens=self.max_tokens,
+                    temperature=self.temperature,
+                    system=self.build_system(),
+                    messages=self.build_messages(query)
+                ),
+                reserve=lambda: self.rate_limiter.try_acquire(tokens)
             )
-            response = message.content[0].text
+            return self._message_result(cache_key, message, time.perf_counter() - start)
+        except Exception as e:
+            self.rate_limiter.record_error(e)
+            return QueryResult.from_error(self.model_name, e, latency_s=time.perf_counter() - start)
+
+    def _message_result(self, cache_key: str, message, latency: float) -> QueryResult:
+        """
+        Cache a message's text and wrap it with its latency and token usage.
+        """
+        response = message.content[0].text
 
-            # Cache the result
-            self.cache[cache_key] = response
-            self.save_cache()
+        # Cache the result
+        self.cache[cache_key] = response
+        self.save_cache()
 
-            return response
+        usage = getattr(message, 'usage', None)
+        input_tokens = getattr(usage, 'input_tokens', None)
+        cache_read = getattr(usage, 'cache_read_input_tokens', None) or 0
+        cache_creation = getattr(usage, 'cache_creation_input_tokens', None) or 0
+        return QueryResult(
+            response,
+            latency_s=latency,
+            # Anthropic reports cached prompt tokens separately from input_tokens
+            input_tokens=input_tokens + cache_read + cache_creation if input_tokens is not None else None,
+            cached_input_tokens=cache_read if usage is not None else None,
+            output_tokens=getattr(usage, 'output_tokens', None)
+        )
+
+    async def aclose(self):
+        """
+        Close the asynchronous model's connection pool.
+        """
+        try:
+            if self.async_model is not None:
+                await self.async_model.close()
         except Exception as e:
-            error_message = f"Error in {self.model_name} response: {e}"
-            return error_message
+            print(f"Error closing async {self.model_name} model: {e}")
 
     def delete(self):
         """
@@ -127,10 +249,130 @@ class ClaudeQuery:
             if self.model is not None:
                 del self.model
 
+            if self.async_model is not None:
+                del self.async_model
+
             for attr in ['system_prompt', 'model_name']:
                 if hasattr(self, attr):
                     delattr(self, attr)
 
             gc.collect()
         except Exception as e:
-            print(f"Error during deletion of {self.model_name} model: {e}")
\ No newline at end of file
+            print(f"Error during deletion of {self.model_name} model: {e}")
+
+    def build_batch_request(self, custom_id: str, query: str) -> dict:
+        """
+        Build one Message Batches request for a query.
+
+        Parameters:
+        - custom_id (str): Identifier used to map the result back to the query.
+        - query (str): The input query string.
+
+        Returns:
+        - dict: The batch request.
+        """
+        return {
+            "custom_id": custom_id,
+            "params": {
+                "model": self.model_name,
+                "max_tokens": self.max_tokens,
+                "temperature": self.temperature,
+                "system": self.build_system(),
+                "messages": self.build_messages(query)
+            }
+        }
+
+    @staticmethod
+    def parse_batch_result(result: dict):
+        """
+        Extract the response text from one line of Message Batches results.
+
+        Parameters:
+        - result (dict): A decoded results line.
+
+        Returns:
+        - Tuple[str, str]: The custom ID and the response text, or None if the request did not succeed.
+        """
+        custom_id = result.get("custom_id")
+        outcome = result.get("result", {})
+        if outcome.get("type") != "succeeded":
+            return custom_id, None
+        content = outcome.get("message", {}).get("content", [{}])
+        return custom_id, content[0].get("text") if content else None
+
+    def submit_batch_query(self, batch_file_path: str) -> str:
+        """
+        Submit a batch query to the Anthropic Message Batches API.
+
+        Parameters:
+        - batch_file_path (str): Path to the .jsonl file containing batch requests.
+
+        Returns:
+        - str: The ID of the submitted batch or an error message.
+        """
+        try:
+            with open(batch_file_path, 'r') as f:
+                requests = [json.loads(line) for line in f if line.strip()]
+
+            batch = self.model.messages.batches.create(requests=requests)
+
+            return batch.id
+        except Exception as e:
+            error_message = f"Error during batch submission: {e}"
+            return {"error": error_message}
+
+    def poll_batch_status(self, batch_id: str, poll_freq: int = 30):
+        """
+        Poll the status of an ongoing batch job.
+
+        Parameters:
+        - batch_id (str): The ID of the batch job.
+
+        Returns:
+        - str: The batch results as JSONL, or a dict with an error message.
+        """
+        try:
+            batch_status = None
+            start_time = time.time()
+
+            while batch_status != "ended":
+                time.sleep(poll_freq)
+                elapsed_time = time.time() - start_time
+                hours, rem = divmod(elapsed_time, 3600)
+                minutes, seconds = divmod(rem, 60)
+                time_passed = "{:0>2}:{:0>2}:{:0>2}".format(int(hours), int(minutes), int(seconds))
+
+                batch_info = self.model.messages.batches.retrieve(batch_id)
+                batch_status = batch_info.processing_status
+                counts = batch_info.request_counts
+                print(f"     🔧 Batch Status: {batch_status} | Succeeded: {counts.succeeded} | "
+                      f"Errored: {counts.errored} | Time Passed: {time_passed}")
+
+            # Retrieve and return the results once the batch has ended
+            batch_results = "".join(
+                result.model_dump_json() + "\n"
+                for result in self.model.messages.batches.results(batch_id)
+            )
+
+            return batch_results
+
+        except Exception as e:
+            error_message = f"Error during batch polling: {e}"
+            return {"error": error_message}
+
+    def cancel_batch(self, batch_id: str):
+        """
+        Cancel an ongoing batch job.
+
+        Parameters:
+        - batch_id (str): The ID of the batch job to be canceled.
+
+        Returns:
+        - dict: The status of the cancellation request.
+        """
+        try:
+            cancellation_response = self.model.messages.batches.cancel(batch_id)
+            return cancellation_response
+        except Exception as e:
+            error_message = f"Error during batch cancellation: {e}"
+            return {"error": error_message}
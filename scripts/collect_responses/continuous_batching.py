@@ -0,0 +1,219 @@
+"""
+continuous_batching.py
+
+Iteration-level (continuous) batching for local Hugging Face models. Static batches run until
+their longest answer finishes, so the slots of short answers sit idle. The engine instead keeps
+up to `max_slots` sequences decoding together, one token per step, and admits the next question
+into a slot as soon as a sequence emits EOS or reaches `max_new_tokens`. Completions are yielded
+as they finish, so callers can checkpoint them straight away.
+
+The key/value cache of the running batch is a left-padded `DynamicCache` with one row per slot.
+A new question is prefilled on its own, from a copy of the system prompt cache when one is given,
+and its row is merged into the batch by left-padding the shorter of the two. Finished rows are
+dropped, and cache columns that are padding in every remaining row are trimmed.
+"""
+
+import copy
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Hashable, Iterable, Iterator, List, Optional, Tuple
+
+import torch
+import torch.nn.functional as F
+from transformers import DynamicCache
+
+# Sampling settings matching `HuggingFaceQuery`'s static generation
+SAMPLING_TEMPERATURE = 0.6
+SAMPLING_TOP_P = 0.9
+
+
+@dataclass
+class Completion:
+    key: Hashable
+    token_ids: List[int]
+    finished_by_eos: bool
+    latency_s: float
+    ttft_s: float
+
+
+@dataclass
+class _Slot:
+    key: Hashable
+    admitted: float
+    ttft_s: float
+    token_ids: List[int] = field(default_factory=list)
+
+
+class ContinuousBatchingEngine:
+    def __init__(
+        self,
+        model,
+        max_slots: int,
+        max_new_tokens: int,
+        eos_token_ids: Iterable[int],
+        do_sample: bool = False,
+        prefix_ids: Optional[torch.Tensor] = None,
+        prefix_cache: Optional[DynamicCache] = None
+    ):
+        """
+        Parameters:
+        - model: The causal language model; it must accept a `DynamicCache`.
+        - max_slots (int): Maximum number of sequences decoding at once.
+        - max_new_tokens (int): Maximum number of tokens generated for each sequence.
+        - eos_token_ids (Iterable[int]): Token IDs that end a sequence.
+        - do_sample (bool): Sample with temperature and nucleus sampling instead of decoding greedily.
+        - prefix_ids (torch.Tensor): Token IDs of a shared prompt prefix, of shape (1, prefix length).
+        - prefix_cache (DynamicCache): Key/value cache of `prefix_ids`, copied for every sequence.
+        """
+        self.model = model
+        self.max_slots = max(1, max_slots)
+        self.max_new_tokens = max_new_tokens
+        self.eos_token_ids = set(eos_token_ids)
+        self.do_sample = do_sample
+        self.device = model.device
+        self.prefix_cache = prefix_cache
+        self.prefix_length = prefix_ids.shape[1] if prefix_ids is not None and prefix_cache is not None else 0
+
+    def _next_tokens(self, logits: torch.Tensor) -> torch.Tensor:
+        """
+        Pick the next token of every row from its last-position logits.
+        """
+        if not self.do_sample:
+            return logits.argmax(dim=-1)
+        probs = torch.softmax(logits.float() / SAMPLING_TEMPERATURE, dim=-1)
+        sorted_probs, sorted_ids = probs.sort(dim=-1, descending=True)
+        # Keep the smallest set of tokens whose probability reaches top_p
+        outside_nucleus = sorted_probs.cumsum(dim=-1) - sorted_probs > SAMPLING_TOP_P
+        sorted_probs = sorted_probs.masked_fill(outside_nucleus, 0.0)
+        choice = torch.multinomial(sorted_probs, num_samples=1)
+        return sorted_ids.gather(-1, choice).squeeze(-1)
+
+    def _prefill(self, input_ids: List[int]) -> Tuple[DynamicCache, int]:
+        """
+        Encode one prompt after the shared prefix.
+
+        Returns:
+        - Tuple[DynamicCache, int]: The prompt's key/value cache and its first generated token.
+        """
+        cache = copy.deepcopy(self.prefix_cache) if self.prefix_cache is not None else DynamicCache()
+        length = self.prefix_length + len(input_ids)
+        outputs = self.model(
+            input_ids=torch.tensor([input_ids], device=self.device),
+            attention_mask=torch.ones(1, length, dtype=torch.long, device=self.device),
+            position_ids=torch.arange(self.prefix_length, length, device=self.device).unsqueeze(0),
+            past_key_values=cache,
+            use_cache=True
+        )
+        return cache, int(self._next_tokens(outputs.logits[:, -1, :])[0])
+
+    @staticmethod
+    def _left_pad(cache: DynamicCache, mask: torch.Tensor, width: int) -> torch.Tensor:
+        """
+        Left-pad every row of a cache and its attention mask to `width` positions.
+
+        Returns:
+        - torch.Tensor: The padded attention mask.
+        """
+        padding = width - mask.shape[1]
+        if padding <= 0:
+            return mask
+        for layer in range(len(cache.key_cache)):
+            cache.key_cache[layer] = F.pad(cache.key_cache[layer], (0, 0, padding, 0))
+            cache.value_cache[layer] = F.pad(cache.value_cache[layer], (0, 0, padding, 0))
+        return F.pad(mask, (padding, 0))
+
+    def generate(self, requests: Iterable[Tuple[Hashable, List[int]]]) -> Iterator[Completion]:
+        """
+        Generate completions for a stream of prompts, admitting each prompt as soon as a slot is free.
+
+        Parameters:
+        - requests (Iterable[Tuple[Hashable, List[int]]]): Pairs of a caller key and the prompt's
+          token IDs, following the shared prefix. Prompts are admitted in order.
+
+        Yields:
+        - Completion: The generated token IDs of each prompt, in the order the prompts finish.
+        """
+        pending = deque(requests)
+        slots: List[_Slot] = []
+        cache, mask, last_tokens = None, None, None
+
+        while pending or slots:
+            # Admit waiting prompts into the free slots
+            finished = []
+            while pending and len(slots) < self.max_slots:
+                key, input_ids = pending.popleft()
+                admitted = time.perf_counter()
+                with torch.no_grad():
+                    row_cache, token = self._prefill(input_ids)
+                slot = _Slot(key, admitted, time.perf_counter() - admitted, [token])
+                if token in self.eos_token_ids or self.max_new_tokens <= 1:
+                    finished.append(slot)
+                    continue
+                row_mask = torch.ones(1, self.prefix_length + len(input_ids), dtype=torch.long, device=self.device)
+                row_token = torch.tensor([token], device=self.device)
+                if cache is None:
+                    cache, mask, last_tokens = row_cache, row_mask, row_token
+                else:
+                    width = max(mask.shape[1], row_mask.shape[1])
+                    mask = self._left_pad(cache, mask, width)
+                    row_mask = self._left_pad(row_cache, row_mask, width)
+                    for layer in range(len(cache.key_cache)):
+                        cache.key_cache[layer] = torch.cat([cache.key_cache[layer], row_cache.key_cache[layer]])
+                        cache.value_cache[layer] = torch.cat([cache.value_cache[layer], row_cache.value_cache[layer]])
+                    mask = torch.cat([mask, row_mask])
+                    last_tokens = torch.cat([last_tokens, row_token])
+                slots.append(slot)
+            for slot in finished:
+                yield self._complete(slot)
+            if not slots:
+                continue
+            finished = []
+
+            # Decode one token for every running sequence
+            mask = torch.cat([mask, mask.new_ones(len(slots), 1)], dim=1)
+            with torch.no_grad():
+                outputs = self.model(
+                    input_ids=last_tokens.unsqueeze(-1),
+                    attention_mask=mask,
+                    # Padding is skipped, so each row's position is its count of earlier tokens
+                    position_ids=(mask.sum(dim=1, keepdim=True) - 1),
+                    past_key_values=cache,
+                    use_cache=True
+                )
+            last_tokens = self._next_tokens(outputs.logits[:, -1, :])
+
+            keep = []
+            for row, (slot, token) in enumerate(zip(slots, last_tokens.tolist())):
+                slot.token_ids.append(token)
+                if token in self.eos_token_ids or len(slot.token_ids) >= self.max_new_tokens:
+                    finished.append(slot)
+                else:
+                    keep.append(row)
+            if len(keep) < len(slots):
+                # Free the finished rows and the padding columns no remaining row needs
+                slots = [slots[row] for row in keep]
+                if keep:
+                    rows = torch.tensor(keep, device=self.device)
+                    cache.batch_select_indices(rows)
+                    mask, last_tokens = mask[rows], last_tokens[rows]
+                    start = int(mask.any(dim=0).nonzero()[0])
+                    if start > 0:
+                        for layer in range(len(cache.key_cache)):
+                            cache.key_cache[layer] = cache.key_cache[layer][:, :, start:]
+                            cache.value_cache[layer] = cache.value_cache[layer][:, :, start:]
+                        mask = mask[:, start:]
+                else:
+                    cache, mask, last_tokens = None, None, None
+            for slot in finished:
+                yield self._complete(slot)
+
+    def _complete(self, slot: _Slot) -> Completion:
+        finished_by_eos = slot.token_ids[-1] in self.eos_token_ids
+        return Completion(
+            key=slot.key,
+            token_ids=slot.token_ids[:-1] if finished_by_eos else slot.token_ids,
+            finished_by_eos=finished_by_eos,
+            latency_s=time.perf_counter() - slot.admitted,
+            ttft_s=slot.ttft_s
+        )
@@ -1,32 +1,63 @@
 import os
 import gc
 import time
-import json
+import asyncio
 from dotenv import load_dotenv
 import google.generativeai as genai
 
-class GeminiQuery:
-    def __init__(self, system_prompt, model_name, max_tokens, temperature):
+from scripts.collect_responses.response_cache import ResponseCacheMixin
+from scripts.collect_responses.rate_limiter import get_rate_limiter, estimate_tokens
+from scripts.collect_responses.hedging import get_hedger
+from scripts.collect_responses.query_result import QueryResult
+
+# `genai.configure` sets the endpoint for the whole process, so every Gemini instance in a process
+# must use the same base_url; this records the one configured first
+_UNCONFIGURED = object()
+_configured_base_url = _UNCONFIGURED
+
+class GeminiQuery(ResponseCacheMixin):
+    def __init__(self, system_prompt, model_name, max_tokens, temperature, rate_limit=None, cache_config=None, base_url=None, hedging=None):
         self.system_prompt = system_prompt
         self.model_name = model_name
         self.max_tokens = max_tokens
         self.temperature = temperature
+        self.base_url = base_url
+        self.rate_limiter = get_rate_limiter('google', rate_limit)
+        self.hedger = get_hedger('google', hedging)
+        self.cache_config = cache_config
         self.cache_file = self.get_cache_file_path()
         self.cache = self.load_cache()
-        self.model = self.initialize_gemini_model()
+        self.model = self.initialize_gemini_model(base_url)
 
-    def initialize_gemini_model(self):
+    def initialize_gemini_model(self, base_url=None):
         """
         Initialize the Gemini model.
 
+        Parameters:
+        - base_url (str): Optional API endpoint, e.g. a local stand-in server. Requests then use the
+          REST transport. Defaults to the Google API.
+
         Returns:
         - genai.GenerativeModel: Initialized Gemini model.
+
+        Raises:
+        - ValueError: If Gemini is already configured with a different endpoint in this process.
         """
+        global _configured_base_url
+        if _configured_base_url is not _UNCONFIGURED and _configured_base_url != base_url:
+            raise ValueError(
+                f"❌ Gemini is already configured for {_configured_base_url or 'the Google API'} in this process "
+                f"and cannot also use {base_url or 'the Google API'}. Run models with different base_url in separate processes."
+            )
         try:
             load_dotenv(os.path.join(os.path.dirname(__file__), '../../configs/.env'))
             google_api_key = os.environ["GOOGLE_API_KEY"]
             if google_api_key:
-                genai.configure(api_key=google_api_key)
+                if base_url:
+                    genai.configure(api_key=google_api_key, transport='rest', client_options={'api_endpoint': base_url})
+                else:
+                    genai.configure(api_key=google_api_key)
+                _configured_base_url = base_url
                 return genai.GenerativeModel(model_name=self.model_name)
             else:
                 print("Google API key not found in environment variables.")
@@ -34,94 +65,144 @@ class GeminiQuery:
             print(f"Error initializing Gemini model: {e}")
         return None
 
-    def get_cache_file_path(self):
-        """
-        Get the path to the cache file based on the model name.
-
-        Returns:
-        - str: The cache file path.
+    def query(self, query: str) -> str:
         """
-        cache_dir = os.path.join(os.path.dirname(__file__), '..', '..', '.cache', 'model_responses_cache')
-        os.makedirs(cache_dir, exist_ok=True)
-        return os.path.join(cache_dir, f'{self.model_name}_cache.json')
+        Query the Google API with Gemini 1.5 Pro or retrieve from cache if available.
 
-    def load_cache(self):
-        """
-        Load the cache from the cache file.
+        Parameters:
+        - query (str): The input query string.
 
         Returns:
-        - dict: The loaded cache data.
-        """
-        if os.path.exists(self.cache_file):
-            try:
-                with open(self.cache_file, 'r') as f:
-                    return json.load(f)
-            except Exception as e:
-                print(f"Error loading cache file: {e}")
-        return {}
-
-    def save_cache(self):
-        """
-        Save the cache to a cache file.
+        - str: The response content from the API or the cached response.
         """
-        try:
-            with open(self.cache_file, 'w') as f:
-                json.dump(self.cache, f)
-        except Exception as e:
-            print(f"Error saving cache file: {e}")
+        return self.query_result(query).response
 
-    def get_cache_key(self, query: str):
+    async def aquery(self, query: str) -> str:
         """
-        Generate a unique cache key based on the model name, query, and system prompt.
+        Asynchronously query the Google API with Gemini or retrieve from cache if available.
 
         Parameters:
         - query (str): The input query string.
 
         Returns:
-        - str: The cache key.
+        - str: The response content from the API or the cached response.
         """
-        return f"{self.model_name}_{self.system_prompt}_{query}"
+        return (await self.aquery_result(query)).response
 
-    def query(self, query: str) -> str:
+    def query_result(self, query: str) -> QueryResult:
         """
-        Query the Google API with Gemini 1.5 Pro or retrieve from cache if available.
+        Query the Google API with Gemini or retrieve from cache if available, with timing and token usage.
 
         Parameters:
         - query (str): The input query string.
 
         Returns:
-        - str: The response content from the API or the cached response.
+        - QueryResult: The response content or an error message, with request metrics.
         """
         cache_key = self.get_cache_key(query)
 
         # Check if the result is already cached
         if cache_key in self.cache:
-            return self.cache[cache_key]
+            return QueryResult(self.cache[cache_key], cache_hit=True)
 
         # If not cached, query the API
-        time.sleep(3)
-        try:
+        tokens = estimate_tokens(self.system_prompt, query, max_tokens=self.max_tokens)
+        self.rate_limiter.acquire(tokens)
+
+        def send():
+            # A chat records the messages sent through it, so a hedged duplicate starts its own
             chat = self.model.start_chat(
                 history=[{"role": "user", "parts": [self.system_prompt]}]
             )
-            response = chat.send_message(
+            return chat.send_message(
                 query, 
                 generation_config=genai.GenerationConfig(
                     max_output_tokens=self.max_tokens,
                     temperature=self.temperature
                 )
             )
-            response_text = response.text
 
-            # Cache the result
-            self.cache[cache_key] = response_text
-            self.save_cache()
+        start = time.perf_counter()
+        try:
+            response = self.hedger.run(send, reserve=lambda: self.rate_limiter.try_acquire(tokens))
+            return self._response_result(cache_key, response, time.perf_counter() - start)
+        except Exception as e:
+            self.rate_limiter.record_error(e)
+            return QueryResult.from_error(self.model_name, e, latency_s=time.perf_counter() - start)
 
-            return response_text
+    async def aquery_result(self, query: str) -> QueryResult:
+        """
+        Asynchronously query the Google API with Gemini or retrieve from cache if available, with timing and token usage.
+
+        Parameters:
+        - query (str): The input query string.
+
+        Returns:
+        - QueryResult: The response content or an error message, with request metrics.
+        """
+        cache_key = self.get_cache_key(query)
+
+        # Check if the result is already cached
+        if cache_key in self.cache:
+            return QueryResult(self.cache[cache_key], cache_hit=True)
+
+        # Identical queries already in flight wait on that request instead of sending their own
+        return await self.coalesce_request(cache_key, lambda: self._arequest(query, cache_key))
+
+    async def _arequest(self, query: str, cache_key: str) -> QueryResult:
+        """
+        Send an uncached query to the Google API with Gemini and cache the response.
+        """
+        # If not cached, query the API
+        tokens = estimate_tokens(self.system_prompt, query, max_tokens=self.max_tokens)
+        await self.rate_limiter.aacquire(tokens)
+
+        async def send():
+            # A chat records the messages sent through it, so a hedged duplicate starts its own
+            chat = self.model.start_chat(
+                history=[{"role": "user", "parts": [self.system_prompt]}]
+            )
+            generation_config = genai.GenerationConfig(
+                max_output_tokens=self.max_tokens,
+                temperature=self.temperature
+            )
+            if self.base_url:
+                # The SDK's REST transport has no async client, so send the request from a worker thread
+                return await asyncio.to_thread(chat.send_message, query, generation_config=generation_config)
+            return await chat.send_message_async(query, generation_config=generation_config)
+
+        start = time.perf_counter()
+        try:
+            response = await self.hedger.arun(send, reserve=lambda: self.rate_limiter.try_acquire(tokens))
+            return self._response_result(cache_key, response, time.perf_counter() - start)
         except Exception as e:
-            error_message = f"Error in {self.model_name} response: {e}"
-            return error_message
-    
+            self.rate_limiter.record_error(e)
+            return QueryResult.from_error(self.model_name, e, latency_s=time.perf_counter() - start)
+
+    def _response_result(self, cache_key: str, response, latency: float) -> QueryResult:
+        """
+        Cache a Gemini response's text and wrap it with its latency and token usage.
+        """
+        response_text = response.text
+
+        # Cache the result
+        self.cache[cache_key] = response_text
+        self.save_cache()
+
+        usage = getattr(response, 'usage_metadata', None)
+        return QueryResult(
+            response_text,
+            latency_s=latency,
+            input_tokens=getattr(usage, 'prompt_token_count', None),
+            output_tokens=getattr(usage, 'candidates_token_count', None)
+        )
+
+    async def aclose(self):
+        """
+        Nothing to close; the Gemini SDK manages its own async transport.
+        """
+        return None
+
     def delete(self):
         """
         Delete the model to free up memory.
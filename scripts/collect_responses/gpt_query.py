@@ -1,25 +1,40 @@
 import os
 import gc
 import time
-import json
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 
-class GPTQuery:
-    def __init__(self, system_prompt, model_name, max_tokens, temperature):
-        self.client = self.initialize_openai_client()
+from scripts.collect_responses.response_cache import ResponseCacheMixin
+from scripts.collect_responses.rate_limiter import get_rate_limiter, estimate_tokens
+from scripts.collect_responses.hedging import get_hedger
+from scripts.collect_responses.query_result import QueryResult
+
+class GPTQuery(ResponseCacheMixin):
+    # Key of the shared rate limiter and hedger
+    provider = 'openai'
+
+    def __init__(self, system_prompt, model_name, max_tokens, temperature, rate_limit=None, cache_config=None, base_url=None, hedging=None):
+        self.client = self.initialize_openai_client(base_url)
+        self.async_client = self.initialize_async_openai_client(base_url)
         self.system_prompt = system_prompt
         self.model_name = model_name
         self.max_tokens = max_tokens
         self.temperature = temperature
+        self.base_url = base_url
+        self.rate_limiter = get_rate_limiter(self.provider, rate_limit)
+        self.hedger = get_hedger(self.provider, hedging)
+        self.cache_config = cache_config
         self.cache_file = self.get_cache_file_path()
         self.cache = self.load_cache()
 
     @staticmethod
-    def initialize_openai_client():
+    def initialize_openai_client(base_url=None):
         """
         Initialize the OpenAI client.
 
+        Parameters:
+        - base_url (str): Optional API base URL, e.g. a local stand-in server. Defaults to the OpenAI API.
+
         Returns:
         - OpenAI: Initialized OpenAI client.
         """
@@ -27,98 +42,194 @@ class GPTQuery:
             load_dotenv(os.path.join(os.path.dirname(__file__), '../../configs/.env'))
             openai_api_key = os.environ.get("OPENAI_API_KEY")
             if openai_api_key:
-                return OpenAI(api_key=openai_api_key)
+                return OpenAI(api_key=openai_api_key, base_url=base_url)
             else:
                 print("OpenAI API key not found in environment variables.")
         except Exception as e:
             print(f"Error initializing OpenAI client: {e}")
         return None
 
-    def get_cache_file_path(self):
+    @staticmethod
+    def initialize_async_openai_client(base_url=None):
         """
-        Get the path to the cache file based on the model name.
+        Initialize the asynchronous OpenAI client used for concurrent collection.
+
+        Parameters:
+        - base_url (str): Optional API base URL, e.g. a local stand-in server. Defaults to the OpenAI API.
 
         Returns:
-        - str: The cache file path.
+        - AsyncOpenAI: Initialized asynchronous OpenAI client.
         """
-        cache_dir = os.path.join(os.path.dirname(__file__), '..', '..', '.cache', 'model_responses_cache')
-        os.makedirs(cache_dir, exist_ok=True)
-        return os.path.join(cache_dir, f'{self.model_name}_cache.json')
+        try:
+            load_dotenv(os.path.join(os.path.dirname(__file__), '../../configs/.env'))
+            openai_api_key = os.environ.get("OPENAI_API_KEY")
+            if openai_api_key:
+                return AsyncOpenAI(api_key=openai_api_key, base_url=base_url)
+        except Exception as e:
+            print(f"Error initializing async OpenAI client: {e}")
+        return None
 
-    def load_cache(self):
+    def query(self, query: str) -> str:
         """
-        Load the cache from the cache file.
-        
+        Query the OpenAI API or retrieve from cache if available.
+
+        Parameters:
+        - query (str): The input query string.
+
+        Returns:
+        - str: The response content from the API or the cached response.
+        """
+        return self.query_result(query).response
+
+    async def aquery(self, query: str) -> str:
+        """
+        Asynchronously query the OpenAI API or retrieve from cache if available.
+
+        Parameters:
+        - query (str): The input query string.
+
         Returns:
-        - dict: The loaded cache data.
+        - str: The response content from the API or the cached response.
         """
-        if os.path.exists(self.cache_file):
-            try:
-                with open(self.cache_file, 'r') as f:
-                    return json.load(f)
-            except Exception as e:
-                print(f"Error loading cache file: {e}")
-        return {}
+        return (await self.aquery_result(query)).response
 
-    def save_cache(self):
+    def query_result(self, query: str) -> QueryResult:
         """
-        Save the cache to a cache file.
+        Query the OpenAI API or retrieve from cache if available, with timing and token usage.
+
+        Parameters:
+        - query (str): The input query string.
+
+        Returns:
+        - QueryResult: The response content or an error message, with request metrics.
         """
+        cache_key = self.get_cache_key(query)
+
+        # Check if the result is already cached
+        if cache_key in self.cache:
+            return QueryResult(self.cache[cache_key], cache_hit=True)
+
+        # If not cached, query the API
+        tokens = estimate_tokens(self.system_prompt, query, max_tokens=self.max_tokens)
+        self.rate_limiter.acquire(tokens)
+        start = time.perf_counter()
         try:
-            with open(self.cache_file, 'w') as f:
-                json.dump(self.cache, f)
+            chat_completion = self.hedger.run(
+                lambda: self.create_completion(self.client, query),
+                reserve=lambda: self.rate_limiter.try_acquire(tokens)
+            )
+            return self._completion_result(cache_key, chat_completion, time.perf_counter() - start)
         except Exception as e:
-            print(f"Error saving cache file: {e}")
+            self.rate_limiter.record_error(e)
+            return QueryResult.from_error(self.model_name, e, latency_s=time.perf_counter() - start)
 
-    def get_cache_key(self, query: str):
+    def create_completion(self, client, query: str):
         """
-        Generate a unique cache key based on the model name, query, and system prompt.
+        Send a query through the sync or async client.
 
         Parameters:
+        - client: The `OpenAI` or `AsyncOpenAI` client.
         - query (str): The input query string.
 
         Returns:
-        - str: The cache key.
+        - The chat completion, or a coroutine returning it for the async client.
         """
-        return f"{self.model_name}_{self.system_prompt}_{query}"
+        return client.chat.completions.create(
+            model=self.model_name,
+            max_tokens=self.max_tokens,
+            temperature=self.temperature,
+            messages=self.build_messages(query)
+        )
+
+    def completion_text(self, completion) -> str:
+        """
+        Get the generated text of a completion returned by `create_completion`.
+        """
+        return completion.choices[0].message.content
 
-    def query(self, query: str) -> str:
+    def build_messages(self, query: str) -> list:
         """
-        Query the OpenAI API or retrieve from cache if available.
+        Build the chat messages for a query. OpenAI caches the longest previously seen prompt
+        prefix automatically, so the shared system prompt comes first and the query last; a
+        query that starts with a fixed template (e.g. the BioScore grading instructions) extends
+        the cached prefix.
 
         Parameters:
         - query (str): The input query string.
 
         Returns:
-        - str: The response content from the API or the cached response.
+        - list: The system and user messages.
+        """
+        return [
+            {"role": "system", "content": self.system_prompt},
+            {"role": "user", "content": query}
+        ]
+
+    async def aquery_result(self, query: str) -> QueryResult:
+        """
+        Asynchronously query the OpenAI API or retrieve from cache if available, with timing and token usage.
+
+        Parameters:
+        - query (str): The input query string.
+
+        Returns:
+        - QueryResult: The response content or an error message, with request metrics.
         """
         cache_key = self.get_cache_key(query)
 
         # Check if the result is already cached
         if cache_key in self.cache:
-            return self.cache[cache_key]
+            return QueryResult(self.cache[cache_key], cache_hit=True)
+
+        # Identical queries already in flight wait on that request instead of sending their own
+        return await self.coalesce_request(cache_key, lambda: self._arequest(query, cache_key))
 
+    async def _arequest(self, query: str, cache_key: str) -> QueryResult:
+        """
+        Send an uncached query to the OpenAI API and cache the response.
+        """
         # If not cached, query the API
+        tokens = estimate_tokens(self.system_prompt, query, max_tokens=self.max_tokens)
+        await self.rate_limiter.aacquire(tokens)
+        start = time.perf_counter()
         try:
-            chat_completion = self.client.chat.completions.create(
-                model=self.model_name,
-                max_tokens=self.max_tokens,
-                temperature=self.temperature,
-                messages=[
-                    {"role": "system", "content": self.system_prompt},
-                    {"role": "user", "content": query}
-                ]
+            chat_completion = await self.hedger.arun(
+                lambda: self.create_completion(self.async_client, query),
+                reserve=lambda: self.rate_limiter.try_acquire(tokens)
             )
-            response = chat_completion.choices[0].message.content
-
-            # Cache the result
-            self.cache[cache_key] = response
-            self.save_cache()
+            return self._completion_result(cache_key, chat_completion, time.perf_counter() - start)
+        except Exception as e:
+            self.rate_limiter.record_error(e)
+            return QueryResult.from_error(self.model_name, e, latency_s=time.perf_counter() - start)
 
-            return response
+    def _completion_result(self, cache_key: str, chat_completion, latency: float) -> QueryResult:
+        """
+        Cache a chat completion's text and wrap it with its latency and token usage.
+        """
+        response = self.completion_text(chat_completion)
+
+        # Cache the result
+        self.cache[cache_key] = response
+        self.save_cache()
+
+        usage = getattr(chat_completion, 'usage', None)
+        return QueryResult(
+            response,
+            latency_s=latency,
+            input_tokens=getattr(usage, 'prompt_tokens', None),
+            cached_input_tokens=getattr(getattr(usage, 'prompt_tokens_details', None), 'cached_tokens', None),
+            output_tokens=getattr(usage, 'completion_tokens', None)
+        )
+
+    async def aclose(self):
+        """
+        Close the asynchronous client's connection pool.
+        """
+        try:
+            if self.async_client is not None:
+                await self.async_client.close()
         except Exception as e:
-            error_message = f"Error in {self.model_name} response: {e}"
-            return error_message
+            print(f"Error closing async {self.model_name} client: {e}")
 
     def delete(self):
         """
@@ -128,6 +239,9 @@ class GPTQuery:
             if self.client is not None:
                 del self.client
 
+            if self.async_client is not None:
+                del self.async_client
+
             for attr in ['system_prompt', 'model_name']:
                 if hasattr(self, attr):
                     delattr(self, attr)
@@ -135,7 +249,48 @@ class GPTQuery:
             gc.collect()
         except Exception as e:
             print(f"Error during deletion of {self.model_name} client: {e}")
-    
+
+    def build_batch_request(self, custom_id: str, query: str) -> dict:
+        """
+        Build one Batch API request line for a query.
+
+        Parameters:
+        - custom_id (str): Identifier used to map the result back to the query.
+        - query (str): The input query string.
+
+        Returns:
+        - dict: The batch request.
+        """
+        return {
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": self.model_name,
+                "max_tokens": self.max_tokens,
+                "temperature": self.temperature,
+                "messages": self.build_messages(query)
+            }
+        }
+
+    @staticmethod
+    def parse_batch_result(result: dict):
+        """
+        Extract the response text from one line of a Batch API output file.
+
+        Parameters:
+        - result (dict): A decoded output line.
+
+        Returns:
+        - Tuple[str, str]: The custom ID and the response text, or None if the request did not succeed.
+        """
+        custom_id = result.get("custom_id")
+        response = result.get("response") or {}
+        if result.get("error") or response.get("status_code") != 200:
+            return custom_id, None
+        choices = response.get("body", {}).get("choices") or [{}]
+        return custom_id, choices[0].get("message", {}).get("content")
+
     def submit_batch_query(self, batch_file_path: str, metadata: dict = None) -> str:
         """
         Submit a batch query to the OpenAI API.
@@ -191,11 +346,13 @@ class GPTQuery:
                 batch_status = batch_info.status
                 print(f"     🔧 Batch Status: {batch_status} | Time Passed: {time_passed}")
 
-                if batch_status == "failed" or batch_status == "expired":
+                if batch_status in ("failed", "expired", "cancelled"):
                     return {"error": f"Batch {batch_status} with error"}
 
             # Retrieve and return the results once completed
             output_file_id = batch_info.output_file_id
+            if output_file_id is None:
+                return {"error": "Batch completed without an output file"}
             file_response = self.client.files.content(output_file_id)
             batch_results = file_response.text
 
@@ -0,0 +1,288 @@
+"""
+hedging.py
+
+Hedged requests for API providers. When a request has been running longer than the provider's
+running p95 latency, a duplicate is sent and whichever succeeds first is used, so a single
+stalled response no longer holds up a run. Each provider gets one hedger per process, like
+its rate limiter. Hedges are capped at a fraction of the provider's requests, and a hedge is
+only sent when the rate limiter has room for it right away.
+
+Hedging is off unless the provider's `hedging` settings enable it.
+"""
+
+import time
+import asyncio
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError, wait, FIRST_COMPLETED
+from typing import Awaitable, Callable, Optional, TypeVar
+
+from scripts.collect_responses.query_result import percentile
+
+T = TypeVar('T')
+
+# Defaults, overridable through the provider's 'hedging' settings
+DEFAULT_PERCENTILE = 95
+DEFAULT_MIN_SAMPLES = 20
+DEFAULT_WINDOW = 500
+DEFAULT_MAX_EXTRA_FRACTION = 0.05
+DEFAULT_MIN_DELAY = 1.0
+DEFAULT_MAX_WORKERS = 16
+
+# Shared hedgers, keyed by provider name
+_HEDGERS = {}
+_HEDGERS_LOCK = threading.Lock()
+
+
+class Hedger:
+    def __init__(
+        self,
+        name: str,
+        enabled: bool = False,
+        percentile: float = DEFAULT_PERCENTILE,
+        min_samples: int = DEFAULT_MIN_SAMPLES,
+        window: int = DEFAULT_WINDOW,
+        max_extra_fraction: float = DEFAULT_MAX_EXTRA_FRACTION,
+        min_delay: float = DEFAULT_MIN_DELAY,
+        max_workers: int = DEFAULT_MAX_WORKERS
+    ):
+        """
+        Parameters:
+        - name (str): Name used when reporting statistics, usually the provider.
+        - enabled (bool): Whether requests are hedged at all.
+        - percentile (float): Latency percentile after which a request is hedged.
+        - min_samples (int): Completed requests needed before the percentile is trusted.
+        - window (int): Number of recent request latencies the percentile is computed over.
+        - max_extra_fraction (float): Maximum hedges as a fraction of requests, capping the extra spend.
+        - min_delay (float): Lower bound in seconds on the hedge delay.
+        - max_workers (int): Worker threads for hedged synchronous requests.
+        """
+        self.name = name
+        self.enabled = enabled
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.max_extra_fraction = max_extra_fraction
+        self.min_delay = min_delay
+        self.max_workers = max_workers
+        self.latencies = deque(maxlen=window)
+        self.lock = threading.Lock()
+        self.executor = None
+        self.requests = 0
+        self.hedges_fired = 0
+        self.hedges_won = 0
+        self.hedges_skipped = 0
+
+    def record_latency(self, latency: float):
+        with self.lock:
+            self.latencies.append(latency)
+
+    def hedge_delay(self) -> Optional[float]:
+        """
+        Get the seconds after which a request is hedged, or None until enough latencies are recorded.
+        """
+        with self.lock:
+            if len(self.latencies) < self.min_samples:
+                return None
+            latencies = list(self.latencies)
+        return max(self.min_delay, percentile(latencies, self.percentile))
+
+    def _claim_hedge(self, reserve: Optional[Callable[[], bool]]) -> bool:
+        """
+        Count a hedge against the spend cap and the rate limiter, if both have room.
+        """
+        with self.lock:
+            within_cap = self.hedges_fired + 1 <= self.max_extra_fraction * self.requests
+            if within_cap and (reserve is None or reserve()):
+                self.hedges_fired += 1
+                return True
+            self.hedges_skipped += 1
+            return False
+
+    def _timed(self, send: Callable[[], T]) -> Callable[[], T]:
+        def timed_send():
+            start = time.perf_counter()
+            result = send()
+            self.record_latency(time.perf_counter() - start)
+            return result
+        return timed_send
+
+    async def _atimed(self, send: Callable[[], Awaitable[T]]) -> T:
+        start = time.perf_counter()
+        result = await send()
+        self.record_latency(time.perf_counter() - start)
+        return result
+
+    def run(self, send: Callable[[], T], reserve: Optional[Callable[[], bool]] = None) -> T:
+        """
+        Send a request, hedging it with a duplicate if it runs past the hedge delay.
+
+        Parameters:
+        - send (Callable): Sends the request and returns the provider response; it raises on failure.
+        - reserve (Callable): Optional non-blocking rate limiter reservation for the duplicate.
+
+        Returns:
+        - The response of the first request to succeed. If every request fails, the last error is raised.
+        """
+        if not self.enabled:
+            return send()
+        with self.lock:
+            self.requests += 1
+        delay = self.hedge_delay()
+        if delay is None:
+            return self._timed(send)()
+
+        if self.executor is None:
+            with self.lock:
+                if self.executor is None:
+                    self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=f"hedge-{self.name}")
+        # Latencies are measured from the primary's start, so a hedged request counts its full wait
+        start = time.perf_counter()
+        primary = self.executor.submit(send)
+        try:
+            result = primary.result(timeout=delay)
+            self.record_latency(time.perf_counter() - start)
+            return result
+        except FutureTimeoutError:
+            pass
+        if not self._claim_hedge(reserve):
+            result = primary.result()
+            self.record_latency(time.perf_counter() - start)
+            return result
+
+        # The slower request cannot be interrupted; it finishes in the background and is discarded
+        hedge_start = time.perf_counter()
+        hedge = self.executor.submit(send)
+        pending, error = {primary, hedge}, None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    self.record_latency(time.perf_counter() - start)
+                    if future is hedge:
+                        with self.lock:
+                            self.hedges_won += 1
+                    elif not hedge.done():
+                        # The losing hedge still adds its own elapsed time once it finishes
+                        hedge.add_done_callback(
+                            lambda f: f.exception() is None and self.record_latency(time.perf_counter() - hedge_start)
+                        )
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    async def arun(self, send: Callable[[], Awaitable[T]], reserve: Optional[Callable[[], bool]] = None) -> T:
+        """
+        Asynchronously send a request, hedging it with a duplicate if it runs past the hedge delay.
+
+        Parameters:
+        - send (Callable): Coroutine function that sends the request and returns the provider
+          response; it raises on failure.
+        - reserve (Callable): Optional non-blocking rate limiter reservation for the duplicate.
+
+        Returns:
+        - The response of the first request to succeed. The slower request is cancelled. If every
+          request fails, the last error is raised.
+        """
+        if not self.enabled:
+            return await send()
+        with self.lock:
+            self.requests += 1
+        delay = self.hedge_delay()
+        if delay is None:
+            return await self._atimed(send)
+
+        # Latencies are measured from the primary's start, so a hedged request counts its full wait
+        start = time.perf_counter()
+        primary = asyncio.ensure_future(send())
+        tasks = {primary}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if done or not self._claim_hedge(reserve):
+                result = await primary
+                self.record_latency(time.perf_counter() - start)
+                return result
+
+            hedge_start = time.perf_counter()
+            hedge = asyncio.ensure_future(send())
+            tasks.add(hedge)
+            pending, error = set(tasks), None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        self.record_latency(time.perf_counter() - start)
+                        if task is hedge:
+                            with self.lock:
+                                self.hedges_won += 1
+                        elif not hedge.done():
+                            # The hedge is cancelled below, but its elapsed time still counts
+                            self.record_latency(time.perf_counter() - hedge_start)
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    def stats(self) -> dict:
+        """
+        Get the hedging counts for this provider.
+
+        Returns:
+        - dict: Requests, hedges fired, won and skipped at the cap, and the current hedge delay.
+        """
+        with self.lock:
+            requests, fired, won, skipped = self.requests, self.hedges_fired, self.hedges_won, self.hedges_skipped
+        return {
+            'requests': requests,
+            'hedges_fired': fired,
+            'hedges_won': won,
+            'hedges_skipped': skipped,
+            'hedge_rate': fired / requests if requests else 0.0,
+            'hedge_delay_s': self.hedge_delay(),
+        }
+
+    def stats_message(self) -> str:
+        stats = self.stats()
+        delay = f"{stats['hedge_delay_s']:.2f}s" if stats['hedge_delay_s'] is not None else "n/a"
+        return (f"🔧 Hedging for {self.name}: {stats['hedges_fired']} of {stats['requests']} requests hedged "
+                f"({stats['hedge_rate']:.1%}), {stats['hedges_won']} hedges won, {stats['hedges_skipped']} skipped "
+                f"at the cap | hedge delay {delay}")
+
+    def shutdown(self):
+        """
+        Release the worker threads without waiting for discarded requests.
+        """
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+
+def get_hedger(provider: str, hedging: Optional[dict] = None) -> Hedger:
+    """
+    Get the hedger shared by all query instances of a provider in this process.
+
+    Parameters:
+    - provider (str): Provider name, e.g. 'openai'.
+    - hedging (dict): Optional settings: 'enabled', 'percentile', 'min_samples', 'window',
+      'max_extra_fraction', 'min_delay' and 'max_workers'. Only used when the provider's
+      hedger is first created.
+
+    Returns:
+    - Hedger: The provider's hedger.
+    """
+    hedging = hedging or {}
+    with _HEDGERS_LOCK:
+        if provider not in _HEDGERS:
+            _HEDGERS[provider] = Hedger(
+                provider,
+                enabled=bool(hedging.get('enabled', False)),
+                percentile=hedging.get('percentile', DEFAULT_PERCENTILE),
+                min_samples=hedging.get('min_samples', DEFAULT_MIN_SAMPLES),
+                window=hedging.get('window', DEFAULT_WINDOW),
+                max_extra_fraction=hedging.get('max_extra_fraction', DEFAULT_MAX_EXTRA_FRACTION),
+                min_delay=hedging.get('min_delay', DEFAULT_MIN_DELAY),
+                max_workers=hedging.get('max_workers', DEFAULT_MAX_WORKERS),
+            )
+        return _HEDGERS[provider]
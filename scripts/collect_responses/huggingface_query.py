@@ -1,99 +1,187 @@
 import os
 import gc
-import json
-import shutil
+import copy
+import time
+import dataclasses
+from typing import Iterator, List, Tuple
 import torch
 from dotenv import load_dotenv
-from transformers import AutoModelForCausalLM, AutoTokenizer, TRANSFORMERS_CACHE
+from transformers import AutoModelForCausalLM, AutoTokenizer, DynamicCache
+from transformers.utils import is_accelerate_available
 
-class HuggingFaceQuery:
-    def __init__(self, system_prompt, model_name, max_tokens, do_sample, torch_dtype=torch.bfloat16):
+from scripts.collect_responses.response_cache import ResponseCacheMixin
+from scripts.collect_responses.model_store import create_model_store
+from scripts.collect_responses.query_result import QueryResult
+from scripts.collect_responses.continuous_batching import ContinuousBatchingEngine
+
+# Weight quantization schemes for CPU inference
+QUANTIZATION_TYPES = ('int8', 'int4')
+
+# CPU kernels are fastest in float32; bfloat16 matrix multiplies are only accelerated on recent CPUs
+CPU_DTYPES = {'float32': torch.float32, 'bfloat16': torch.bfloat16}
+
+class HuggingFaceQuery(ResponseCacheMixin):
+    def __init__(self, system_prompt, model_name, max_tokens, do_sample, torch_dtype=torch.bfloat16, cache_config=None, batch_size=8, reuse_prefix_cache=True, model_store_config=None, cpu_config=None, continuous_batching=True):
+        """
+        Parameters:
+        - batch_size (int): Number of sequences generated together.
+        - continuous_batching (bool): Admit new queries into the running batch as soon as earlier
+          sequences finish, instead of generating static batches that wait for their longest answer.
+          Models with their own cache implementation (e.g. Gemma-2) always use static batches.
+        - cpu_config (dict): Optional CPU inference settings, used when no GPU is available or
+          when 'device' is 'cpu':
+          - device (str): 'cpu' to run on the CPU even when a GPU is available.
+          - quantization (str): 'int8' for dynamically quantized linear layers (torch), 'int4' for
+            4-bit weights (requires optimum-quanto), or None for unquantized weights.
+          - dtype (str): Weight dtype of the unquantized layers, 'float32' (default) or 'bfloat16'.
+          - threads (int): Intra-op threads used by torch. Defaults to torch's choice (all cores).
+          - interop_threads (int): Inter-op threads used by torch.
+          - mmap (bool): Load the memory-mapped weights straight into the model instead of into a
+            randomly initialized copy first, halving peak memory. Needs accelerate. Defaults to True.
+        """
         self.system_prompt = system_prompt
         self.model_name = model_name
         self.max_tokens = max_tokens
         self.do_sample = do_sample
-        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        self.cpu_config = cpu_config or {}
+        self.quantization = self.cpu_config.get('quantization')
+        if self.quantization is not None and self.quantization not in QUANTIZATION_TYPES:
+            raise ValueError(f"❌ Quantization '{self.quantization}' is not recognized. Expected one of: {', '.join(QUANTIZATION_TYPES)}.")
+        self.on_cpu = not torch.cuda.is_available() or self.cpu_config.get('device') == 'cpu'
+        self.device = torch.device("cpu" if self.on_cpu else "cuda")
+        if self.on_cpu:
+            cpu_dtype = self.cpu_config.get('dtype', 'float32')
+            if cpu_dtype not in CPU_DTYPES:
+                raise ValueError(f"❌ CPU dtype '{cpu_dtype}' is not recognized. Expected one of: {', '.join(CPU_DTYPES)}.")
+            # Dynamic int8 quantization only replaces float32 linear layers
+            torch_dtype = torch.float32 if self.quantization == 'int8' else CPU_DTYPES[cpu_dtype]
+            self._configure_cpu_threads()
+        else:
+            # The CPU settings only apply where the model actually runs on the CPU
+            self.quantization = None
         self.torch_dtype = torch_dtype
+        self.batch_size = batch_size
+        self.continuous_batching = continuous_batching
+        self.cache_config = cache_config
         self.cache_file = self.get_cache_file_path()
         self.cache = self.load_cache()
+        self.model_store = create_model_store(model_store_config)
         self.model, self.tokenizer = self._initialize_model_and_tokenizer()
+        self.prefix_ids, self.prefix_cache = self._build_prefix_cache() if reuse_prefix_cache else (None, None)
 
     def _initialize_model_and_tokenizer(self):
         try:
             load_dotenv(os.path.join(os.path.dirname(__file__), '../../configs/.env'))
+            # Weights are downloaded once into the model store and memory-mapped from there
+            model_path = self.model_store.get_model_path(self.model_name)
             model = AutoModelForCausalLM.from_pretrained(
-                self.model_name,
+                model_path,
                 torch_dtype=self.torch_dtype,
-                device_map="auto" if torch.cuda.is_available() else None
+                device_map=None if self.on_cpu else "auto",
+                # Safetensors weights are memory-mapped; this also skips allocating randomly initialized
+                # weights first, which needs accelerate. device_map on GPUs always requires it.
+                low_cpu_mem_usage=(self.cpu_config.get('mmap', True) and is_accelerate_available()) if self.on_cpu else True,
+                local_files_only=True
             )
-            tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+            if self.quantization is not None:
+                model = self._quantize(model)
+            model.eval()
+            # Left padding keeps every prompt flush against its generated tokens in a batch
+            tokenizer = AutoTokenizer.from_pretrained(model_path, padding_side='left', local_files_only=True)
+            if tokenizer.pad_token is None:
+                tokenizer.pad_token = tokenizer.eos_token
             return model, tokenizer
         except Exception as e:
             print(f"Error initializing model and tokenizer for {self.model_name}: {e}")
             return None, None
 
-    def get_cache_file_path(self):
+    def _configure_cpu_threads(self):
         """
-        Get the path to the cache file based on the last part of the model name,
-        with a fallback if splitting by '/' is not possible.
+        Apply the configured torch thread counts for CPU inference.
+        """
+        threads = self.cpu_config.get('threads')
+        if threads:
+            torch.set_num_threads(int(threads))
+        interop_threads = self.cpu_config.get('interop_threads')
+        if interop_threads:
+            try:
+                torch.set_num_interop_threads(int(interop_threads))
+            except RuntimeError:
+                # Inter-op threads can only be set before torch first runs parallel work
+                print(f"⚠️  Inter-op threads already started, keeping {torch.get_num_interop_threads()}")
+        print(f"🔧 Running {self.model_name} on the CPU with {torch.get_num_threads()} threads"
+              f"{f', {self.quantization} weights' if self.quantization else ''}")
 
-        Returns:
-        - str: The cache file path.
+    def _quantize(self, model):
         """
-        try:
-            # Try splitting the model name by '/' and get the last part
-            model_base_name = self.model_name.split('/')[-1]
-        except Exception as e:
-            print(f"Error splitting model name {self.model_name}: {e}")
-            # Fallback to using the entire model name if splitting fails
-            model_base_name = self.model_name
+        Quantize the weights of the model's linear layers for CPU inference.
 
-        # Define the cache directory
-        cache_dir = os.path.join(os.path.dirname(__file__), '..', '..', '.cache', 'model_responses_cache')
-        
-        # Ensure the cache directory exists
-        os.makedirs(cache_dir, exist_ok=True)
-        
-        # Return the path to the cache file
-        return os.path.join(cache_dir, f'{model_base_name}_cache.json')
+        Parameters:
+        - model: The loaded model.
 
+        Returns:
+        - The quantized model.
 
-    def load_cache(self):
+        Raises:
+        - ImportError: If int4 quantization is requested and optimum-quanto is not installed.
         """
-        Load the cache from the cache file.
-        
-        Returns:
-        - dict: The loaded cache data.
+        if self.quantization == 'int8':
+            # Weights are stored as int8 and activations are quantized on the fly for each matmul
+            return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+        try:
+            from optimum.quanto import quantize, freeze, qint4
+        except ImportError as e:
+            raise ImportError("int4 quantization requires the optimum-quanto package (pip install optimum-quanto).") from e
+        # The output projection is left unquantized, as 4-bit logits noticeably change greedy outputs
+        quantize(model, weights=qint4, exclude='lm_head')
+        freeze(model)
+        return model
+
+    def _supports_dynamic_cache(self) -> bool:
         """
-        if os.path.exists(self.cache_file):
-            try:
-                with open(self.cache_file, 'r') as f:
-                    return json.load(f)
-            except Exception as e:
-                print(f"Error loading cache file: {e}")
-        return {}
+        Check whether the model generates with a `DynamicCache` that can be copied, batched and sliced.
+        """
+        # Sliding-window models such as Gemma-2 generate with their own hybrid cache
+        cache_implementation = getattr(self.model.generation_config, 'cache_implementation', None)
+        return self.model._supports_cache_class and cache_implementation in (None, 'dynamic')
 
-    def save_cache(self):
+    def _build_prefix_cache(self):
         """
-        Save the cache to a cache file.
+        Encode the system prompt once and keep its key/value cache, so every batch only
+        prefills its own question tokens.
+
+        Returns:
+        - Tuple[torch.Tensor, DynamicCache]: The system prompt token IDs and their key/value cache,
+          or (None, None) if the model cannot reuse a prefix cache.
         """
+        if self.model is None or self.tokenizer is None or not self.system_prompt:
+            return None, None
+        if not self._supports_dynamic_cache():
+            print(f"⚠️  {self.model_name} uses a '{self.model.generation_config.cache_implementation}' cache, system prompt prefix caching disabled")
+            return None, None
+
         try:
-            with open(self.cache_file, 'w') as f:
-                json.dump(self.cache, f)
+            prefix_ids = self.tokenizer(self.system_prompt, return_tensors="pt")['input_ids'].to(self.device)
+            prefix_cache = DynamicCache()
+            with torch.no_grad():
+                self.model(input_ids=prefix_ids, past_key_values=prefix_cache, use_cache=True)
+            return prefix_ids, prefix_cache
         except Exception as e:
-            print(f"Error saving cache file: {e}")
+            print(f"Error building system prompt cache for {self.model_name}, prefix caching disabled: {e}")
+            return None, None
 
-    def get_cache_key(self, query: str):
+    def cache_params(self) -> dict:
         """
-        Generate a unique cache key based on the model name, query, and system prompt.
-
-        Parameters:
-        - query (str): The input query string.
+        Get the generation parameters that distinguish cached responses.
 
         Returns:
-        - str: The cache key.
+        - dict: Parameters included in the cache key.
         """
-        return f"{self.model_name}_{self.system_prompt}_{query}"
+        params = {'max_tokens': self.max_tokens, 'do_sample': self.do_sample}
+        # Quantized weights can change the generated text; unquantized runs keep their existing keys
+        if self.quantization is not None:
+            params['quantization'] = self.quantization
+        return params
 
     def query(self, query: str) -> str:
         """
@@ -105,43 +193,248 @@ class HuggingFaceQuery:
         Returns:
         - str: The generated text (response) or an error message.
         """
-        cache_key = self.get_cache_key(query)
+        return self.query_result(query).response
+
+    def query_result(self, query: str) -> QueryResult:
+        """
+        Query the Hugging Face model or retrieve from cache if available, with timing and token counts.
+
+        Parameters:
+        - query (str): The input query string.
+
+        Returns:
+        - QueryResult: The generated text or an error message, with generation metrics.
+        """
+        return self.query_batch_results([query])[0]
 
-        # Check if the result is already cached
-        if cache_key in self.cache:
-            return self.cache[cache_key]
+    def query_batch(self, queries: List[str]) -> List[str]:
+        """
+        Query the Hugging Face model with several queries at once, retrieving cached responses where available.
+
+        Parameters:
+        - queries (List[str]): The input query strings.
+
+        Returns:
+        - List[str]: The generated texts (responses) or error messages, in the order of the queries.
+        """
+        return [result.response for result in self.query_batch_results(queries)]
+
+    def query_batch_results(self, queries: List[str]) -> List[QueryResult]:
+        """
+        Query the Hugging Face model with several queries at once, retrieving cached responses where available.
 
-        # If not cached, query the model
+        Parameters:
+        - queries (List[str]): The input query strings.
+
+        Returns:
+        - List[QueryResult]: The generated texts or error messages with generation metrics, in the order of the queries.
+        """
+        results = [None] * len(queries)
+        for i, result in self.stream_batch_results(queries):
+            results[i] = result
+        return results
+
+    def stream_batch_results(self, queries: List[str]) -> Iterator[Tuple[int, QueryResult]]:
+        """
+        Query the Hugging Face model with several queries at once, yielding each result as soon as it is ready.
+        Cached responses come first. Uncached queries are then generated with continuous batching, or in
+        static batches of prompts with similar token lengths for models that do not support it. Repeated
+        queries are generated once.
+
+        Parameters:
+        - queries (List[str]): The input query strings.
+
+        Yields:
+        - Tuple[int, QueryResult]: The index of a query and its generated text or error message with
+          generation metrics, in the order the results complete.
+        """
+        uncached = []
+        # Repeated queries are generated once and share the first occurrence's result
+        first_index = {}
+        duplicates = {}
+        for i, query in enumerate(queries):
+            cache_key = self.get_cache_key(query)
+            if cache_key in first_index:
+                duplicates.setdefault(first_index[cache_key], []).append(i)
+            elif cache_key in self.cache:
+                first_index[cache_key] = i
+                yield i, QueryResult(self.cache[cache_key], cache_hit=True)
+            else:
+                first_index[cache_key] = i
+                uncached.append(i)
+        generating = set(uncached)
+        for first, repeated in duplicates.items():
+            if first not in generating:
+                result = QueryResult(self.cache[self.get_cache_key(queries[first])], cache_hit=True)
+                for i in repeated:
+                    yield i, result
+
+        if not uncached:
+            return
+        if self.model is None or self.tokenizer is None:
+            error = QueryResult(f"Error in {self.model_name} response: model or tokenizer not initialized.")
+            for first in uncached:
+                for i in [first] + duplicates.get(first, []):
+                    yield i, error
+            return
+
+        if self.continuous_batching and self._supports_dynamic_cache():
+            generated = self._stream_continuous(queries, uncached)
+        else:
+            generated = self._stream_static(queries, uncached)
+        for first, result in generated:
+            succeeded = not result.response.startswith(f"Error in {self.model_name} response")
+            if succeeded:
+                self.cache[self.get_cache_key(queries[first])] = result.response
+                self.save_cache()
+            yield first, result
+            for i in duplicates.get(first, []):
+                yield i, dataclasses.replace(result, cache_hit=succeeded)
+
+    def _stream_continuous(self, queries: List[str], uncached: List[int]) -> Iterator[Tuple[int, QueryResult]]:
+        """
+        Generate the uncached queries with continuous batching, yielding each result as its sequence finishes.
+        """
+        if self.prefix_cache is not None:
+            # The system prompt comes from the prefix cache, so only the question is prefilled
+            prompt_ids = self.tokenizer([queries[i] for i in uncached], add_special_tokens=False)['input_ids']
+        else:
+            prompt_ids = self.tokenizer([self.system_prompt + queries[i] for i in uncached])['input_ids']
+        prefix_length = self.prefix_ids.shape[1] if self.prefix_cache is not None else 0
+        eos_token_ids = self.model.generation_config.eos_token_id
+        if eos_token_ids is None:
+            eos_token_ids = self.tokenizer.eos_token_id
+        engine = ContinuousBatchingEngine(
+            self.model,
+            max_slots=self.batch_size,
+            max_new_tokens=self.max_tokens,
+            eos_token_ids=eos_token_ids if isinstance(eos_token_ids, list) else [eos_token_ids],
+            do_sample=self.do_sample,
+            prefix_ids=self.prefix_ids,
+            prefix_cache=self.prefix_cache
+        )
+
+        remaining = dict(zip(uncached, prompt_ids))
+        start = time.perf_counter()
         try:
-            if self.model is None or self.tokenizer is None:
-                return "Model or tokenizer not initialized."
-            
-            input_text = self.system_prompt + query
-            inputs = self.tokenizer(input_text, return_tensors="pt").to(self.device)
+            for completion in engine.generate(list(remaining.items())):
+                yield completion.key, QueryResult(
+                    self.tokenizer.decode(completion.token_ids, skip_special_tokens=True).strip(),
+                    latency_s=completion.latency_s,
+                    ttft_s=completion.ttft_s,
+                    input_tokens=prefix_length + len(remaining.pop(completion.key)),
+                    output_tokens=len(completion.token_ids)
+                )
+        except Exception as e:
+            # Queries still running or waiting when generation failed (e.g. out of memory) fail together
+            for i in remaining:
+                yield i, QueryResult.from_error(self.model_name, e, latency_s=time.perf_counter() - start)
+            if not self.on_cpu:
+                torch.cuda.empty_cache()
 
-            with torch.no_grad():
-                outputs = self.model.generate(
-                    **inputs,
-                    max_length=self.max_tokens,
-                    num_return_sequences=1,
-                    pad_token_id=self.tokenizer.eos_token_id,
-                    do_sample=self.do_sample,
-                    temperature=None if not self.do_sample else 0.6,
-                    top_p=None if not self.do_sample else 0.9
+    def _stream_static(self, queries: List[str], uncached: List[int]) -> Iterator[Tuple[int, QueryResult]]:
+        """
+        Generate the uncached queries in left-padded batches of `batch_size`, yielding each batch's results.
+        Prompts are sorted by token length so each batch holds prompts of similar length. Each result's
+        latency is the wall time of its batch.
+        """
+        # Bucket prompts of similar token length together to minimize padding
+        prompts = {i: self.system_prompt + queries[i] for i in uncached}
+        lengths = {i: len(self.tokenizer(prompts[i])['input_ids']) for i in uncached}
+        ordered = sorted(uncached, key=lambda i: lengths[i])
+
+        for start in range(0, len(ordered), self.batch_size):
+            batch = ordered[start:start + self.batch_size]
+            batch_start = time.perf_counter()
+            try:
+                batch_responses, output_tokens = self._generate_batch([queries[i] for i in batch])
+            except Exception as e:
+                for i in batch:
+                    yield i, QueryResult.from_error(self.model_name, e, latency_s=time.perf_counter() - batch_start)
+                # Free the memory of a failed (e.g. out of memory) batch before moving on
+                if not self.on_cpu:
+                    torch.cuda.empty_cache()
+                continue
+            latency = time.perf_counter() - batch_start
+            for i, response_text, generated in zip(batch, batch_responses, output_tokens):
+                yield i, QueryResult(
+                    response_text,
+                    latency_s=latency,
+                    input_tokens=lengths[i],
+                    output_tokens=generated
                 )
-            generated_text = self.tokenizer.decode(outputs[0], skip_special_tokens=True)
 
-            # Remove the input text from the generated text
-            response_text = generated_text[len(input_text):].strip()
+    def _tokenize_batch(self, queries: List[str]):
+        """
+        Tokenize a batch of queries into generation inputs.
+
+        Without a prefix cache, the system prompt and query are tokenized together and left-padded.
+        With a prefix cache, every row starts with the cached system prompt tokens, followed by
+        padding and then the query tokens, so the cached keys and values line up with every row.
 
-            # Cache the result
-            self.cache[cache_key] = response_text
-            self.save_cache()
+        Parameters:
+        - queries (List[str]): The input query strings.
 
-            return response_text
-        except Exception as e:
-            error_message = f"Error in {self.model_name} response: {e}"
-            return error_message
+        Returns:
+        - Tuple[torch.Tensor, torch.Tensor]: The input IDs and attention mask.
+        """
+        if self.prefix_cache is None:
+            prompts = [self.system_prompt + query for query in queries]
+            inputs = self.tokenizer(prompts, return_tensors="pt", padding=True).to(self.device)
+            return inputs['input_ids'], inputs['attention_mask']
+
+        prefix = self.prefix_ids[0].tolist()
+        query_ids = self.tokenizer(queries, add_special_tokens=False)['input_ids']
+        width = max(len(ids) for ids in query_ids)
+        input_ids, attention_mask = [], []
+        for ids in query_ids:
+            padding = width - len(ids)
+            input_ids.append(prefix + [self.tokenizer.pad_token_id] * padding + ids)
+            attention_mask.append([1] * len(prefix) + [0] * padding + [1] * len(ids))
+        return (
+            torch.tensor(input_ids, device=self.device),
+            torch.tensor(attention_mask, device=self.device)
+        )
+
+    def _generate_batch(self, queries: List[str]) -> Tuple[List[str], List[int]]:
+        """
+        Generate responses for a batch of queries.
+
+        Parameters:
+        - queries (List[str]): The input query strings.
+
+        Returns:
+        - Tuple[List[str], List[int]]: The generated text for each query, without the prompt itself,
+          and the number of generated tokens for each query.
+        """
+        input_ids, attention_mask = self._tokenize_batch(queries)
+
+        past_key_values = None
+        if self.prefix_cache is not None:
+            # Generation extends the cache in place, so each batch works on its own copy
+            past_key_values = copy.deepcopy(self.prefix_cache)
+            past_key_values.batch_repeat_interleave(len(queries))
+
+        with torch.no_grad():
+            outputs = self.model.generate(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                past_key_values=past_key_values,
+                max_new_tokens=self.max_tokens,
+                num_return_sequences=1,
+                pad_token_id=self.tokenizer.pad_token_id,
+                do_sample=self.do_sample,
+                temperature=None if not self.do_sample else 0.6,
+                top_p=None if not self.do_sample else 0.9
+            )
+
+        # Every row of the prompt has the same width, so generated tokens start at the same offset
+        prompt_width = input_ids.shape[1]
+        generated = outputs[:, prompt_width:]
+        texts = [self.tokenizer.decode(output, skip_special_tokens=True).strip() for output in generated]
+        # Finished rows are padded up to the longest generation in the batch
+        output_tokens = (generated != self.tokenizer.pad_token_id).sum(dim=1).tolist()
+        return texts, output_tokens
 
     def delete(self):
         """
@@ -155,14 +448,14 @@ class HuggingFaceQuery:
             if self.tokenizer is not None:
                 del self.tokenizer
 
+            if self.prefix_cache is not None:
+                del self.prefix_cache
+
             # Explicitly delete other attributes if necessary
             for attr in ['system_prompt', 'model_name', 'device', 'torch_dtype']:
                 if hasattr(self, attr):
                     delattr(self, attr)
 
-            # Clear HuggingFace models cache
-            shutil.rmtree(TRANSFORMERS_CACHE)
-
             # Clear any remaining references
             gc.collect()
         except Exception as e:
@@ -0,0 +1,552 @@
+"""
+mock_server.py
+
+Local stand-in for the provider APIs, for load testing response collection and BioScore grading
+offline. It speaks enough of each wire format for the SDK clients used by the query classes:
+
+- OpenAI: POST /v1/chat/completions, /v1/completions, /v1/files and /v1/batches (GET
+  /v1/batches/{id}, GET /v1/files/{id}/content, POST /v1/batches/{id}/cancel). Perplexity and
+  local OpenAI-compatible inference servers use the same completion routes.
+- Anthropic: POST /v1/messages and /v1/messages/batches (GET /v1/messages/batches/{id} and
+  /results, POST /v1/messages/batches/{id}/cancel).
+- Gemini: POST /v1beta/models/{model}:generateContent (REST transport).
+
+Responses either echo the last user message or return a canned text. Each generation request
+waits for a latency drawn from a configurable distribution, and a configurable share of
+requests fails with 429 (with a Retry-After header) or 500. Batches complete after a fixed
+delay. GET /stats returns request counts per route and status.
+
+Run it directly and point the providers' `base_url` settings at the printed URLs:
+
+    python -m scripts.collect_responses.mock_server --port 8000 --latency lognormal:0.8,0.5 --rate_limit_rate 0.05
+"""
+
+import io
+import re
+import sys
+import json
+import time
+import uuid
+import random
+import argparse
+import threading
+from collections import Counter
+from datetime import datetime, timezone
+from email.parser import BytesParser
+from email.policy import default as default_policy
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Optional, Tuple
+
+def parse_latency(spec: str) -> Tuple[str, Tuple[float, ...]]:
+    """
+    Parse a latency distribution of the form 'name:param[,param]' (seconds):
+    'constant:0.2', 'uniform:0.1,0.5', 'lognormal:median,sigma' or 'exponential:mean'.
+
+    Returns:
+    - Tuple[str, Tuple[float, ...]]: The distribution name and its parameters.
+
+    Raises:
+    - ValueError: If the distribution is unknown or has the wrong number of parameters.
+    """
+    name, _, params = spec.partition(':')
+    values = tuple(float(value) for value in params.split(',') if value.strip())
+    expected = {'constant': 1, 'uniform': 2, 'lognormal': 2, 'exponential': 1}
+    if name not in expected or len(values) != expected[name]:
+        raise ValueError(f"❌ Invalid latency '{spec}'. Expected one of: constant:S, uniform:MIN,MAX, lognormal:MEDIAN,SIGMA, exponential:MEAN.")
+    return name, values
+
+
+def count_tokens(text: str) -> int:
+    """
+    Rough token count for usage reporting: one token per whitespace-separated word.
+    """
+    return len(text.split())
+
+
+class MockBehavior:
+    def __init__(
+        self,
+        latency: str = 'constant:0',
+        error_rate: float = 0.0,
+        rate_limit_rate: float = 0.0,
+        retry_after: float = 1.0,
+        response_mode: str = 'echo',
+        canned_response: str = 'This is a mock response.',
+        batch_delay: float = 2.0,
+        seed: Optional[int] = None
+    ):
+        """
+        Parameters:
+        - latency (str): Latency distribution of generation requests, see `parse_latency`.
+        - error_rate (float): Share of generation requests answered with a 500 error.
+        - rate_limit_rate (float): Share of generation requests answered with a 429 error.
+        - retry_after (float): Retry-After value in seconds sent with 429 errors.
+        - response_mode (str): 'echo' to return the last user message, 'canned' for `canned_response`.
+        - canned_response (str): Text returned in 'canned' mode.
+        - batch_delay (float): Seconds until a submitted batch completes.
+        - seed (int): Optional random seed for reproducible latencies and errors.
+        """
+        self.latency = parse_latency(latency)
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.response_mode = response_mode
+        self.canned_response = canned_response
+        self.batch_delay = batch_delay
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.cached_prefixes = set()
+
+    def sample_latency(self) -> float:
+        name, params = self.latency
+        with self.lock:
+            if name == 'uniform':
+                return self.random.uniform(*params)
+            if name == 'lognormal':
+                median, sigma = params
+                return median * self.random.lognormvariate(0.0, sigma)
+            if name == 'exponential':
+                return self.random.expovariate(1.0 / params[0]) if params[0] > 0 else 0.0
+            return params[0]
+
+    def sample_error(self) -> Optional[int]:
+        """
+        Decide whether a generation request fails, returning the HTTP status to send or None.
+        """
+        with self.lock:
+            draw = self.random.random()
+        if draw < self.rate_limit_rate:
+            return 429
+        if draw < self.rate_limit_rate + self.error_rate:
+            return 500
+        return None
+
+    def prompt_cache_hit(self, prefix: str) -> bool:
+        """
+        Simulate the provider's prompt cache: a prefix is a hit once it has been seen before.
+        """
+        with self.lock:
+            hit = prefix in self.cached_prefixes
+            self.cached_prefixes.add(prefix)
+        return hit
+
+    def respond(self, prompt: str) -> str:
+        return prompt if self.response_mode == 'echo' else self.canned_response
+
+
+def _text(content) -> str:
+    """
+    Get the text of a message content given as a string or a list of content blocks.
+    """
+    if isinstance(content, str):
+        return content
+    return ''.join(block.get('text', '') for block in content or [] if isinstance(block, dict))
+
+
+def chat_completion(body: dict, behavior: MockBehavior) -> dict:
+    messages = body.get('messages', [])
+    prompt = next((_text(m.get('content')) for m in reversed(messages) if m.get('role') == 'user'), '')
+    text = behavior.respond(prompt)
+    input_tokens = sum(count_tokens(_text(m.get('content'))) for m in messages)
+    # Everything before the last message stands in for the automatically cached prefix
+    prefix = json.dumps(messages[:-1])
+    cached_tokens = sum(count_tokens(_text(m.get('content'))) for m in messages[:-1]) if behavior.prompt_cache_hit(prefix) else 0
+    return {
+        'id': f"chatcmpl-{uuid.uuid4().hex[:24]}",
+        'object': 'chat.completion',
+        'created': int(time.time()),
+        'model': body.get('model', 'mock'),
+        'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': text}, 'finish_reason': 'stop'}],
+        'usage': {
+            'prompt_tokens': input_tokens,
+            'completion_tokens': count_tokens(text),
+            'total_tokens': input_tokens + count_tokens(text),
+            'prompt_tokens_details': {'cached_tokens': cached_tokens},
+        },
+    }
+
+
+def text_completion(body: dict, behavior: MockBehavior) -> dict:
+    prompt = body.get('prompt', '')
+    prompt = prompt if isinstance(prompt, str) else ''.join(prompt)
+    text = behavior.respond(prompt)
+    return {
+        'id': f"cmpl-{uuid.uuid4().hex[:24]}",
+        'object': 'text_completion',
+        'created': int(time.time()),
+        'model': body.get('model', 'mock'),
+        'choices': [{'index': 0, 'text': text, 'logprobs': None, 'finish_reason': 'stop'}],
+        'usage': {'prompt_tokens': count_tokens(prompt), 'completion_tokens': count_tokens(text), 'total_tokens': count_tokens(prompt) + count_tokens(text)},
+    }
+
+
+def anthropic_message(body: dict, behavior: MockBehavior) -> dict:
+    messages = body.get('messages', [])
+    prompt = next((_text(m.get('content')) for m in reversed(messages) if m.get('role') == 'user'), '')
+    text = behavior.respond(prompt)
+    input_tokens = count_tokens(_text(body.get('system', ''))) + sum(count_tokens(_text(m.get('content'))) for m in messages)
+    # The prompt up to the last cache_control breakpoint is read from or written to the cache
+    blocks = [b for b in body.get('system') or [] if isinstance(b, dict)]
+    for m in messages:
+        blocks += [b for b in m.get('content') or [] if isinstance(b, dict)]
+    breakpoints = [i for i, b in enumerate(blocks) if b.get('cache_control')]
+    cached = count_tokens(''.join(b.get('text', '') for b in blocks[:breakpoints[-1] + 1])) if breakpoints else 0
+    cache_read = cached if cached and behavior.prompt_cache_hit(json.dumps(blocks[:breakpoints[-1] + 1])) else 0
+    cache_creation = cached - cache_read
+    return {
+        'id': f"msg_{uuid.uuid4().hex[:24]}",
+        'type': 'message',
+        'role': 'assistant',
+        'content': [{'type': 'text', 'text': text}],
+        'model': body.get('model', 'mock'),
+        'stop_reason': 'end_turn',
+        'stop_sequence': None,
+        'usage': {
+            'input_tokens': input_tokens - cached,
+            'cache_creation_input_tokens': cache_creation,
+            'cache_read_input_tokens': cache_read,
+            'output_tokens': count_tokens(text),
+        },
+    }
+
+
+def gemini_response(body: dict, behavior: MockBehavior) -> dict:
+    contents = body.get('contents', [])
+    texts = [''.join(part.get('text', '') for part in c.get('parts', [])) for c in contents]
+    user_texts = [t for c, t in zip(contents, texts) if c.get('role', 'user') == 'user']
+    text = behavior.respond(user_texts[-1] if user_texts else '')
+    input_tokens = sum(count_tokens(t) for t in texts)
+    return {
+        'candidates': [{'content': {'parts': [{'text': text}], 'role': 'model'}, 'finishReason': 'STOP', 'index': 0}],
+        'usageMetadata': {'promptTokenCount': input_tokens, 'candidatesTokenCount': count_tokens(text), 'totalTokenCount': input_tokens + count_tokens(text)},
+    }
+
+
+def error_body(api: str, status: int) -> dict:
+    """
+    Build an error response in the wire format of the given API ('openai', 'anthropic' or 'gemini').
+    """
+    message = 'Rate limit exceeded (mock)' if status == 429 else 'Internal server error (mock)'
+    if api == 'anthropic':
+        return {'type': 'error', 'error': {'type': 'rate_limit_error' if status == 429 else 'api_error', 'message': message}}
+    if api == 'gemini':
+        return {'error': {'code': status, 'message': message, 'status': 'RESOURCE_EXHAUSTED' if status == 429 else 'INTERNAL'}}
+    return {'error': {'message': message, 'type': 'rate_limit_exceeded' if status == 429 else 'server_error', 'code': None}}
+
+
+def iso_time(timestamp: float) -> str:
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc).isoformat()
+
+
+class MockProviderServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, behavior: MockBehavior):
+        super().__init__(address, MockProviderHandler)
+        self.behavior = behavior
+        self.state_lock = threading.Lock()
+        self.files = {}
+        self.batches = {}
+        self.stats = Counter()
+
+    def handle_error(self, request, client_address):
+        # Clients may drop requests they no longer need, e.g. the slower copy of a hedged request
+        if isinstance(sys.exc_info()[1], ConnectionError):
+            return
+        super().handle_error(request, client_address)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def base_urls(self) -> dict:
+        """
+        Get the base URL to configure for each provider type.
+        """
+        return {
+            'openai': f"{self.base_url}/v1",
+            'anthropic': self.base_url,
+            'google': self.base_url,
+            'perplexity': self.base_url,
+            'openai_compatible': f"{self.base_url}/v1",
+        }
+
+    def openai_batch(self, batch_id: str) -> dict:
+        """
+        Get an OpenAI batch, writing its output file once the batch delay has passed.
+        """
+        with self.state_lock:
+            batch = self.batches[batch_id]
+            if batch['status'] == 'in_progress' and time.time() - batch['created_at'] >= self.behavior.batch_delay:
+                output = []
+                for line in self.files[batch['input_file_id']]['content'].decode('utf-8').splitlines():
+                    if not line.strip():
+                        continue
+                    request = json.loads(line)
+                    status = 500 if self.behavior.sample_error() else 200
+                    body = chat_completion(request.get('body', {}), self.behavior) if status == 200 else error_body('openai', status)
+                    output.append({
+                        'id': f"batch_req_{uuid.uuid4().hex[:24]}",
+                        'custom_id': request.get('custom_id'),
+                        'response': {'status_code': status, 'request_id': uuid.uuid4().hex, 'body': body},
+                        'error': None,
+                    })
+                output_file_id = self._add_file('\n'.join(json.dumps(line) for line in output).encode('utf-8'), 'batch_output.jsonl', 'batch_output')
+                batch.update({
+                    'status': 'completed',
+                    'output_file_id': output_file_id,
+                    'completed_at': int(time.time()),
+                    'request_counts': {'total': len(output), 'completed': len(output), 'failed': 0},
+                })
+            return {key: value for key, value in batch.items()}
+
+    def anthropic_batch(self, batch_id: str) -> dict:
+        """
+        Get an Anthropic message batch, generating its results once the batch delay has passed.
+        """
+        with self.state_lock:
+            batch = self.batches[batch_id]
+            if batch['processing_status'] == 'canceling':
+                results = [{'custom_id': request.get('custom_id'), 'result': {'type': 'canceled'}} for request in batch['_requests']]
+                batch.update({
+                    'processing_status': 'ended',
+                    'ended_at': iso_time(time.time()),
+                    'request_counts': {'processing': 0, 'succeeded': 0, 'errored': 0, 'canceled': len(results), 'expired': 0},
+                    'results_url': f"{self.base_url}/v1/messages/batches/{batch_id}/results",
+                    '_results': results,
+                })
+            if batch['processing_status'] == 'in_progress' and time.time() - batch['_created'] >= self.behavior.batch_delay:
+                results = []
+                for request in batch['_requests']:
+                    if self.behavior.sample_error():
+                        result = {'type': 'errored', 'error': error_body('anthropic', 500)}
+                    else:
+                        result = {'type': 'succeeded', 'message': anthropic_message(request.get('params', {}), self.behavior)}
+                    results.append({'custom_id': request.get('custom_id'), 'result': result})
+                succeeded = sum(r['result']['type'] == 'succeeded' for r in results)
+                batch.update({
+                    'processing_status': 'ended',
+                    'ended_at': iso_time(time.time()),
+                    'request_counts': {'processing': 0, 'succeeded': succeeded, 'errored': len(results) - succeeded, 'canceled': 0, 'expired': 0},
+                    'results_url': f"{self.base_url}/v1/messages/batches/{batch_id}/results",
+                    '_results': results,
+                })
+            return batch
+
+    def _add_file(self, content: bytes, filename: str, purpose: str) -> str:
+        file_id = f"file-{uuid.uuid4().hex[:24]}"
+        self.files[file_id] = {
+            'id': file_id, 'object': 'file', 'bytes': len(content), 'created_at': int(time.time()),
+            'filename': filename, 'purpose': purpose, 'status': 'processed', 'content': content,
+        }
+        return file_id
+
+
+class MockProviderHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately; without this, keep-alive requests stall on delayed ACKs
+    disable_nagle_algorithm = True
+
+    GEMINI_ROUTE = re.compile(r'^/v1(?:beta)?/models/([^/:]+):generateContent$')
+    OPENAI_BATCH_ROUTE = re.compile(r'^/v1/batches/([^/]+)(/cancel)?$')
+    OPENAI_FILE_ROUTE = re.compile(r'^/v1/files/([^/]+)/content$')
+    ANTHROPIC_BATCH_ROUTE = re.compile(r'^/v1/messages/batches/([^/]+)(/results|/cancel)?$')
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status: int, payload, content_type: str = 'application/json', headers: Optional[dict] = None):
+        body = payload if isinstance(payload, bytes) else json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        route = self.path.split('?')[0]
+        route = re.sub(r'/(file|batch|msgbatch)_?-?[0-9a-f]{24}', r'/{id}', route)
+        with self.server.state_lock:
+            self.server.stats[f"{self.command} {route} {status}"] += 1
+
+    def _read_body(self) -> bytes:
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _read_json(self) -> dict:
+        body = self._read_body()
+        return json.loads(body) if body else {}
+
+    def _generate(self, api: str, build, body: dict):
+        """
+        Answer a generation request after the sampled latency, or with an injected error.
+        """
+        behavior = self.server.behavior
+        time.sleep(behavior.sample_latency())
+        status = behavior.sample_error()
+        if status == 429:
+            return self._send(429, error_body(api, 429), headers={'Retry-After': f"{behavior.retry_after:g}"})
+        if status is not None:
+            return self._send(status, error_body(api, status))
+        return self._send(200, build(body, behavior))
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        server = self.server
+        if path == '/stats':
+            with server.state_lock:
+                return self._send(200, dict(server.stats))
+
+        match = self.OPENAI_BATCH_ROUTE.match(path)
+        if match and match.group(1) in server.batches and not match.group(2):
+            return self._send(200, server.openai_batch(match.group(1)))
+        match = self.OPENAI_FILE_ROUTE.match(path)
+        if match and match.group(1) in server.files:
+            return self._send(200, server.files[match.group(1)]['content'], content_type='application/octet-stream')
+        match = self.ANTHROPIC_BATCH_ROUTE.match(path)
+        if match and match.group(1) in server.batches and match.group(2) != '/cancel':
+            batch = server.anthropic_batch(match.group(1))
+            if match.group(2) == '/results':
+                if batch['processing_status'] != 'ended':
+                    return self._send(404, error_body('anthropic', 404))
+                lines = '\n'.join(json.dumps(result) for result in batch['_results'])
+                return self._send(200, lines.encode('utf-8'), content_type='application/x-jsonl')
+            return self._send(200, {key: value for key, value in batch.items() if not key.startswith('_')})
+        return self._send(404, {'error': {'message': f"Unknown route {path}"}})
+
+    def do_POST(self):
+        path = self.path.split('?')[0]
+        server = self.server
+        if path in ('/v1/chat/completions', '/chat/completions'):
+            return self._generate('openai', chat_completion, self._read_json())
+        if path in ('/v1/completions', '/completions'):
+            return self._generate('openai', text_completion, self._read_json())
+        if path == '/v1/messages':
+            return self._generate('anthropic', anthropic_message, self._read_json())
+        if self.GEMINI_ROUTE.match(path):
+            return self._generate('gemini', gemini_response, self._read_json())
+
+        if path == '/v1/files':
+            content_type = self.headers.get('Content-Type', '')
+            message = BytesParser(policy=default_policy).parse(
+                io.BytesIO(f"Content-Type: {content_type}\r\n\r\n".encode('utf-8') + self._read_body())
+            )
+            fields, filename = {}, 'upload.jsonl'
+            for part in message.iter_parts():
+                name = part.get_param('name', header='content-disposition')
+                fields[name] = part.get_payload(decode=True)
+                filename = part.get_filename() or filename
+            with server.state_lock:
+                file_id = server._add_file(fields.get('file', b''), filename, (fields.get('purpose') or b'batch').decode('utf-8'))
+                file_info = {key: value for key, value in server.files[file_id].items() if key != 'content'}
+            return self._send(200, file_info)
+
+        if path == '/v1/batches':
+            body = self._read_json()
+            if body.get('input_file_id') not in server.files:
+                return self._send(404, error_body('openai', 404))
+            batch_id = f"batch_{uuid.uuid4().hex[:24]}"
+            with server.state_lock:
+                server.batches[batch_id] = {
+                    'id': batch_id, 'object': 'batch', 'endpoint': body.get('endpoint'),
+                    'input_file_id': body['input_file_id'], 'completion_window': body.get('completion_window', '24h'),
+                    'status': 'in_progress', 'output_file_id': None, 'error_file_id': None,
+                    'created_at': int(time.time()), 'metadata': body.get('metadata'),
+                    'request_counts': {'total': 0, 'completed': 0, 'failed': 0},
+                }
+            return self._send(200, server.openai_batch(batch_id))
+
+        if path == '/v1/messages/batches':
+            body = self._read_json()
+            batch_id = f"msgbatch_{uuid.uuid4().hex[:24]}"
+            now = time.time()
+            with server.state_lock:
+                server.batches[batch_id] = {
+                    'id': batch_id, 'type': 'message_batch', 'processing_status': 'in_progress',
+                    'request_counts': {'processing': len(body.get('requests', [])), 'succeeded': 0, 'errored': 0, 'canceled': 0, 'expired': 0},
+                    'created_at': iso_time(now), 'expires_at': iso_time(now + 86400), 'ended_at': None,
+                    'cancel_initiated_at': None, 'archived_at': None, 'results_url': None,
+                    '_created': now, '_requests': body.get('requests', []),
+                }
+            batch = server.anthropic_batch(batch_id)
+            return self._send(200, {key: value for key, value in batch.items() if not key.startswith('_')})
+
+        match = self.OPENAI_BATCH_ROUTE.match(path)
+        if match and match.group(1) in server.batches and match.group(2):
+            with server.state_lock:
+                server.batches[match.group(1)]['status'] = 'cancelled'
+            return self._send(200, server.openai_batch(match.group(1)))
+        match = self.ANTHROPIC_BATCH_ROUTE.match(path)
+        if match and match.group(1) in server.batches and match.group(2) == '/cancel':
+            with server.state_lock:
+                server.batches[match.group(1)].update({'processing_status': 'canceling', 'cancel_initiated_at': iso_time(time.time())})
+            batch = server.anthropic_batch(match.group(1))
+            return self._send(200, {key: value for key, value in batch.items() if not key.startswith('_')})
+        return self._send(404, {'error': {'message': f"Unknown route {path}"}})
+
+
+def start_mock_server(host: str = '127.0.0.1', port: int = 0, **behavior) -> MockProviderServer:
+    """
+    Start the mock provider server on a background thread.
+
+    Parameters:
+    - host (str): Interface to listen on.
+    - port (int): Port to listen on; 0 picks a free port.
+    - **behavior: Latency, error and response settings passed to `MockBehavior`.
+
+    Returns:
+    - MockProviderServer: The running server; call `shutdown()` to stop it.
+    """
+    server = MockProviderServer((host, port), MockBehavior(**behavior))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    """
+    Run the mock provider server until interrupted.
+    """
+    parser = argparse.ArgumentParser(description="Serve mock OpenAI, Anthropic, Gemini and Perplexity endpoints for offline load testing.")
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Interface to listen on')
+    parser.add_argument('--port', type=int, default=8000, help='Port to listen on')
+    parser.add_argument('--latency', type=str, default='constant:0',
+        help="Latency of generation requests in seconds: constant:S, uniform:MIN,MAX, lognormal:MEDIAN,SIGMA or exponential:MEAN"
+    )
+    parser.add_argument('--error_rate', type=float, default=0.0, help='Share of generation requests failing with 500')
+    parser.add_argument('--rate_limit_rate', type=float, default=0.0, help='Share of generation requests failing with 429')
+    parser.add_argument('--retry_after', type=float, default=1.0, help='Retry-After seconds sent with 429 errors')
+    parser.add_argument('--response_mode', type=str, choices=['echo', 'canned'], default='echo',
+        help="Return the last user message ('echo') or --canned_response ('canned')"
+    )
+    parser.add_argument('--canned_response', type=str, default='This is a mock response.', help="Text returned in 'canned' mode")
+    parser.add_argument('--batch_delay', type=float, default=2.0, help='Seconds until a submitted batch completes')
+    parser.add_argument('--seed', type=int, help='Random seed for latencies and injected errors')
+    args = parser.parse_args()
+
+    try:
+        behavior = MockBehavior(
+            latency=args.latency, error_rate=args.error_rate, rate_limit_rate=args.rate_limit_rate,
+            retry_after=args.retry_after, response_mode=args.response_mode,
+            canned_response=args.canned_response, batch_delay=args.batch_delay, seed=args.seed
+        )
+    except ValueError as e:
+        print(e)
+        return
+    server = MockProviderServer((args.host, args.port), behavior)
+    print(f"🔧 Mock provider server listening on {server.base_url}")
+    for provider, url in server.base_urls().items():
+        print(f"   {provider:<12} base_url: {url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print("🔧 Requests served:")
+        for route, count in sorted(server.stats.items()):
+            print(f"   {route:<60} {count}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+"""
+model_registry.py
+
+Registry of the benchmark models, built from the `models` section of the configuration. Each
+entry maps a model name to its provider type and the provider's model ID (the API model
+version or the Hugging Face repository). Provider query classes are imported only when a
+model of that provider is initialized, so a job talking to one API does not load the SDKs
+of the others (or torch and transformers).
+"""
+
+import os
+import importlib
+from typing import Dict, List, Optional
+
+import yaml
+
+BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+DEFAULT_CONFIG_PATH = os.path.join(BASE_DIR, 'configs', 'default_config.yaml')
+
+# Provider type -> query class, the optional settings its constructor accepts and the settings
+# a model entry in the configuration may set for itself ('model_options', optionally mapping the
+# entry's key to the constructor option)
+PROVIDERS = {
+    'openai': {
+        'module': 'scripts.collect_responses.gpt_query',
+        'class': 'GPTQuery',
+        'options': ('temperature', 'rate_limit', 'cache_config', 'base_url', 'hedging'),
+    },
+    'google': {
+        'module': 'scripts.collect_responses.gemini_query',
+        'class': 'GeminiQuery',
+        'options': ('temperature', 'rate_limit', 'cache_config', 'base_url', 'hedging'),
+    },
+    'anthropic': {
+        'module': 'scripts.collect_responses.claude_query',
+        'class': 'ClaudeQuery',
+        'options': ('temperature', 'rate_limit', 'cache_config', 'base_url', 'hedging', 'prompt_prefix'),
+    },
+    'perplexity': {
+        'module': 'scripts.collect_responses.perplexity_query',
+        'class': 'PerplexityQuery',
+        'options': ('temperature', 'rate_limit', 'cache_config', 'connection_config', 'base_url', 'hedging'),
+    },
+    'openai_compatible': {
+        'module': 'scripts.collect_responses.openai_compatible_query',
+        'class': 'OpenAICompatibleQuery',
+        'options': ('temperature', 'rate_limit', 'cache_config', 'base_url', 'hedging'),
+        # Each model may be served by its own inference server
+        'model_options': ('base_url', 'prompt_format'),
+    },
+    'huggingface': {
+        'module': 'scripts.collect_responses.huggingface_query',
+        'class': 'HuggingFaceQuery',
+        'options': ('cache_config', 'batch_size', 'model_store_config', 'cpu_config', 'continuous_batching'),
+        # Local models decode greedily
+        'defaults': {'do_sample': False},
+        # Each model may pick its own CPU quantization and thread count under 'cpu'
+        'model_options': {'cpu': 'cpu_config'},
+    },
+}
+
+# Model IDs of the models the benchmark shipped with, used when an entry in an older
+# configuration has no 'model_id'
+BUILTIN_MODEL_IDS = {
+    'gpt-3.5-turbo': 'gpt-3.5-turbo-0125',
+    'gpt-4o': 'gpt-4o-2024-05-13',
+    'gpt-4.5-preview': 'gpt-4.5-preview-2025-02-27',
+    'gemini-1.5-pro': 'gemini-1.5-pro',
+    'gemini-2.0-flash': 'gemini-2.0-flash',
+    'claude-3.5-sonnet': 'claude-3-5-sonnet-20240620',
+    'claude-3.7-sonnet': 'claude-3-7-sonnet-20250219',
+    'perplexity-sonar-huge': 'llama-3.1-sonar-huge-128k-online',
+    'gemma-2-27b-it': 'google/gemma-2-27b-it',
+    'llama-3.1-70b-it': 'meta-llama/Meta-Llama-3.1-70B-Instruct',
+}
+
+
+def load_model_registry(model_configs: Optional[List[dict]] = None, config_path: str = DEFAULT_CONFIG_PATH) -> Dict[str, dict]:
+    """
+    Build the model registry from the `models` section of the configuration.
+
+    Parameters:
+    - model_configs (List[dict]): Optional model entries with 'name', 'type' and 'model_id';
+      read from the configuration file when not given. Built-in models fall back to their
+      `BUILTIN_MODEL_IDS`, and unused models without a model ID are left out.
+    - config_path (str): Configuration file used when `model_configs` is not given.
+
+    Returns:
+    - Dict[str, dict]: Mapping of model name to its 'type', 'model_id' and the provider's
+      'model_options' set in its entry.
+
+    Raises:
+    - ValueError: If a model has an unknown provider type, or is in use without a model ID.
+    """
+    if model_configs is None:
+        with open(config_path, 'r') as f:
+            model_configs = yaml.safe_load(f).get('models', [])
+    registry = {}
+    for model in model_configs:
+        name, provider_type = model['name'], model.get('type')
+        model_id = model.get('model_id') or BUILTIN_MODEL_IDS.get(name)
+        if provider_type not in PROVIDERS:
+            raise ValueError(f"❌ Model '{name}' has unknown type '{provider_type}'. Expected one of: {', '.join(PROVIDERS)}.")
+        if not model_id:
+            if not model.get('use', True):
+                continue
+            raise ValueError(f"❌ Model '{name}' has no 'model_id' in the configuration.")
+        model_options = PROVIDERS[provider_type].get('model_options', ())
+        if not isinstance(model_options, dict):
+            model_options = {option: option for option in model_options}
+        registry[name] = {
+            'type': provider_type,
+            'model_id': model_id,
+            'options': {option: model[key] for key, option in model_options.items() if model.get(key) is not None},
+        }
+    return registry
+
+
+def get_provider_class(provider_type: str):
+    """
+    Import and return the query class of a provider type.
+    """
+    provider = PROVIDERS[provider_type]
+    return getattr(importlib.import_module(provider['module']), provider['class'])
+
+
+def initialize_model(
+    model_name: str,
+    system_prompt: str,
+    max_new_tokens: int,
+    temperature: float,
+    rate_limit: dict = None,
+    cache_config: dict = None,
+    batch_size: int = 8,
+    model_store_config: dict = None,
+    connection_config: dict = None,
+    base_url: str = None,
+    hedging: dict = None,
+    prompt_prefix: str = None,
+    cpu_config: dict = None,
+    continuous_batching: bool = True,
+    registry: Optional[Dict[str, dict]] = None
+):
+    """
+    Initialize the model client and create an instance of the query class for the specified model.
+
+    Args:
+        model_name (str): Name of the model to initialize.
+        system_prompt (str): System prompt to provide to the model.
+        max_new_tokens (int): Maximum number of tokens to generate.
+        temperature (float): Sampling temperature.
+        rate_limit (dict, optional): Provider quota with 'requests_per_minute' and
+            'tokens_per_minute' for API-backed models. Defaults to None (unthrottled).
+        cache_config (dict, optional): Response cache backend and eviction settings.
+            Defaults to None (on-disk store without eviction).
+        batch_size (int, optional): Number of prompts generated together by local models. Defaults to 8.
+        model_store_config (dict, optional): Local model store directory, size limit and pinned models.
+            Defaults to None (unbounded store under .cache/models).
+        connection_config (dict, optional): HTTP connection pool size and timeouts for clients
+            without a provider SDK. Defaults to None (the client's defaults).
+        base_url (str, optional): API base URL for API-backed models, e.g. the local mock provider
+            server. Defaults to None (the provider's API).
+        hedging (dict, optional): Hedged request settings for API-backed models, see hedging.py.
+            Defaults to None (no hedging).
+        prompt_prefix (str, optional): Fixed opening shared by many queries, cached by providers
+            that need explicit cache breakpoints. Defaults to None.
+        cpu_config (dict, optional): CPU inference settings for local models (device, quantization,
+            threads, mmap), merged with the model entry's own 'cpu' settings. Defaults to None.
+        continuous_batching (bool, optional): Whether local models admit new prompts into the running
+            batch as earlier sequences finish. Defaults to True.
+        registry (Dict[str, dict], optional): Model registry from `load_model_registry`.
+            Defaults to None (built from the default configuration).
+
+    Returns:
+        An instance of the appropriate model query class.
+
+    Raises:
+        ValueError: If the model_name is not recognized.
+    """
+    if registry is None:
+        registry = load_model_registry()
+    if model_name not in registry:
+        raise ValueError(f"❌ Model '{model_name}' is not recognized.")
+    entry = registry[model_name]
+    provider = PROVIDERS[entry['type']]
+
+    settings = {
+        'temperature': temperature,
+        'rate_limit': rate_limit,
+        'cache_config': cache_config,
+        'batch_size': batch_size,
+        'model_store_config': model_store_config,
+        'connection_config': connection_config,
+        'base_url': base_url,
+        'hedging': hedging,
+        'prompt_prefix': prompt_prefix,
+        'cpu_config': cpu_config,
+        'continuous_batching': continuous_batching,
+    }
+    if prompt_prefix is not None and 'prompt_prefix' not in provider['options']:
+        print(f"⚠️  Ignoring prompt_prefix for {model_name}: {entry['type']} models take no explicit cache breakpoints")
+    kwargs = {
+        **provider.get('defaults', {}),
+        **{option: settings[option] for option in provider['options']},
+    }
+    for option, value in entry.get('options', {}).items():
+        # Settings given as a mapping are refined by the model entry rather than replaced
+        if isinstance(value, dict) and isinstance(kwargs.get(option), dict):
+            value = {**kwargs[option], **value}
+        kwargs[option] = value
+    query_class = get_provider_class(entry['type'])
+    return query_class(system_prompt, entry['model_id'], max_tokens=max_new_tokens, **kwargs)
@@ -0,0 +1,294 @@
+"""
+model_store.py
+
+Managed local store for Hugging Face model weights.
+
+Each model is downloaded once into its own directory under `.cache/models` and recorded in a
+`manifest.json` with its size and last use. Later runs load the weights straight from disk
+(memory-mapped safetensors, no network access). When the store grows beyond its size limit,
+the least recently used models are evicted, except pinned ones and the model being loaded.
+
+This script can also be run directly to list, pin, unpin or remove stored models.
+"""
+
+import os
+import json
+import time
+import shutil
+import fcntl
+import argparse
+from contextlib import contextmanager
+from typing import Iterable, List, Optional
+
+BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+DEFAULT_MODEL_DIR = os.path.join(BASE_DIR, '.cache', 'models')
+
+# Files needed to load a model and its tokenizer; pickled .bin weights are only fetched as a fallback
+WEIGHT_PATTERNS = ['*.json', '*.safetensors', '*.model', '*.tiktoken', '*.txt', 'tokenizer*']
+FALLBACK_WEIGHT_PATTERNS = ['*.bin']
+
+
+class ModelStore:
+    def __init__(self, root: str = DEFAULT_MODEL_DIR, max_bytes: Optional[int] = None, pinned: Iterable[str] = (), offline: bool = False):
+        """
+        Parameters:
+        - root (str): Directory holding the model directories and the manifest.
+        - max_bytes (int): Optional size limit for the store; least recently used models beyond it are evicted.
+        - pinned (Iterable[str]): Repository IDs that are never evicted.
+        - offline (bool): Never contact the Hub; models missing from the store raise an error.
+        """
+        self.root = root
+        self.max_bytes = max_bytes
+        self.pinned = set(pinned)
+        self.offline = offline or os.environ.get('HF_HUB_OFFLINE', '0') not in ('0', '', 'false', 'False')
+        self.manifest_path = os.path.join(root, 'manifest.json')
+        self.lock_path = os.path.join(root, '.lock')
+
+    @contextmanager
+    def _locked(self):
+        """
+        Hold an exclusive lock on the store, so concurrent jobs do not download or evict the same model.
+        """
+        os.makedirs(self.root, exist_ok=True)
+        with open(self.lock_path, 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _load_manifest(self) -> dict:
+        if not os.path.exists(self.manifest_path):
+            return {}
+        try:
+            with open(self.manifest_path, 'r') as f:
+                return json.load(f)
+        except ValueError as e:
+            print(f"⚠️  Ignoring unreadable model store manifest {self.manifest_path}: {e}")
+            return {}
+
+    def _save_manifest(self, manifest: dict):
+        tmp_path = f"{self.manifest_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+
+    def _model_dir(self, repo_id: str) -> str:
+        return os.path.join(self.root, repo_id.replace('/', '--'))
+
+    @staticmethod
+    def _directory_size(path: str) -> int:
+        return sum(
+            os.path.getsize(os.path.join(dir_path, file_name))
+            for dir_path, _, file_names in os.walk(path)
+            for file_name in file_names
+        )
+
+    def _is_pinned(self, repo_id: str, entry: dict) -> bool:
+        return repo_id in self.pinned or entry.get('pinned', False)
+
+    def get_model_path(self, repo_id: str) -> str:
+        """
+        Get the local directory of a model, downloading it on first use.
+
+        Parameters:
+        - repo_id (str): The Hugging Face repository ID, e.g. 'google/gemma-2-27b-it'.
+          A path to a local model directory is returned unchanged.
+
+        Returns:
+        - str: Path to the directory to pass to `from_pretrained`.
+
+        Raises:
+        - FileNotFoundError: If the model is not stored and the store is offline.
+        """
+        if os.path.isdir(repo_id):
+            return repo_id
+        with self._locked():
+            manifest = self._load_manifest()
+            entry = manifest.get(repo_id)
+            model_dir = self._model_dir(repo_id)
+            if entry is not None and os.path.isdir(model_dir):
+                entry['last_used'] = time.time()
+                self._save_manifest(manifest)
+                return model_dir
+
+            if self.offline:
+                raise FileNotFoundError(f"❌ {repo_id} is not in the model store at {self.root} and the store is offline.")
+
+            # Make room before downloading when the Hub reports the model's size
+            expected_size = self._remote_size(repo_id)
+            if expected_size:
+                self._evict(manifest, keep={repo_id}, incoming=expected_size)
+                self._save_manifest(manifest)
+
+            print(f"🔧 Downloading {repo_id} to the model store...")
+            self._download(repo_id, model_dir)
+            manifest[repo_id] = {
+                'path': os.path.basename(model_dir),
+                'size': self._directory_size(model_dir),
+                'last_used': time.time(),
+                'pinned': False,
+            }
+            self._evict(manifest, keep={repo_id})
+            self._save_manifest(manifest)
+            return model_dir
+
+    def _remote_size(self, repo_id: str) -> Optional[int]:
+        """
+        Ask the Hub for the total size of the files `_download` would fetch, or None if unknown.
+        """
+        try:
+            from fnmatch import fnmatch
+            from huggingface_hub import HfApi
+            info = HfApi().model_info(repo_id, files_metadata=True)
+            return sum(
+                sibling.size or 0 for sibling in info.siblings
+                if any(fnmatch(sibling.rfilename, pattern) for pattern in WEIGHT_PATTERNS)
+            )
+        except Exception:
+            return None
+
+    @staticmethod
+    def _download(repo_id: str, model_dir: str):
+        """
+        Download the model's safetensors weights, config and tokenizer files. Partially
+        downloaded directories from an interrupted run are resumed.
+        """
+        from huggingface_hub import snapshot_download
+        snapshot_download(repo_id, local_dir=model_dir, allow_patterns=WEIGHT_PATTERNS)
+        has_safetensors = any(
+            file_name.endswith('.safetensors')
+            for _, _, file_names in os.walk(model_dir)
+            for file_name in file_names
+        )
+        if not has_safetensors:
+            print(f"⚠️  {repo_id} has no safetensors weights, downloading .bin weights instead")
+            snapshot_download(repo_id, local_dir=model_dir, allow_patterns=FALLBACK_WEIGHT_PATTERNS)
+
+    def _evict(self, manifest: dict, keep: Iterable[str] = (), incoming: int = 0) -> List[str]:
+        """
+        Remove least recently used, unpinned models until the store plus `incoming` bytes fits
+        within `max_bytes`.
+
+        Returns:
+        - List[str]: The evicted repository IDs.
+        """
+        if self.max_bytes is None:
+            return []
+        evicted = []
+        total = sum(entry.get('size', 0) for entry in manifest.values()) + incoming
+        candidates = sorted(
+            (repo_id for repo_id, entry in manifest.items()
+             if repo_id not in keep and not self._is_pinned(repo_id, entry)),
+            key=lambda repo_id: manifest[repo_id].get('last_used', 0)
+        )
+        for repo_id in candidates:
+            if total <= self.max_bytes:
+                break
+            total -= manifest[repo_id].get('size', 0)
+            self._remove_files(repo_id)
+            del manifest[repo_id]
+            evicted.append(repo_id)
+            print(f"🔧 Evicted {repo_id} from the model store")
+        if total > self.max_bytes:
+            print(f"⚠️  Model store exceeds its {self.max_bytes / 1e9:.1f} GB limit; remaining models are pinned or in use")
+        return evicted
+
+    def _remove_files(self, repo_id: str):
+        model_dir = self._model_dir(repo_id)
+        if os.path.isdir(model_dir):
+            shutil.rmtree(model_dir)
+
+    def list_models(self) -> dict:
+        """
+        Get the manifest entries of all stored models.
+
+        Returns:
+        - dict: Mapping of repository ID to its 'path', 'size', 'last_used' and 'pinned' entry.
+        """
+        with self._locked():
+            return self._load_manifest()
+
+    def set_pinned(self, repo_id: str, pinned: bool = True):
+        """
+        Pin or unpin a stored model. Pinned models are never evicted.
+        """
+        with self._locked():
+            manifest = self._load_manifest()
+            if repo_id not in manifest:
+                raise KeyError(f"❌ {repo_id} is not in the model store.")
+            manifest[repo_id]['pinned'] = pinned
+            self._save_manifest(manifest)
+
+    def remove(self, repo_id: str):
+        """
+        Delete a model's files and manifest entry.
+        """
+        with self._locked():
+            manifest = self._load_manifest()
+            self._remove_files(repo_id)
+            manifest.pop(repo_id, None)
+            self._save_manifest(manifest)
+
+
+def create_model_store(store_config: Optional[dict] = None) -> ModelStore:
+    """
+    Create a model store from the `model_store` configuration section.
+
+    Parameters:
+    - store_config (dict): Optional settings: 'directory', 'max_size_gb', 'pinned' and 'offline'.
+
+    Returns:
+    - ModelStore: The configured store.
+    """
+    store_config = store_config or {}
+    root = store_config.get('directory') or DEFAULT_MODEL_DIR
+    if not os.path.isabs(root):
+        root = os.path.join(BASE_DIR, root)
+    max_size_gb = store_config.get('max_size_gb')
+    return ModelStore(
+        os.path.normpath(root),
+        max_bytes=int(max_size_gb * 1e9) if max_size_gb else None,
+        pinned=store_config.get('pinned') or (),
+        offline=store_config.get('offline', False)
+    )
+
+
+def main():
+    """
+    List stored models, or pin, unpin or remove one.
+    """
+    parser = argparse.ArgumentParser(description="Manage the local Hugging Face model store.")
+    parser.add_argument('--directory', type=str, default=DEFAULT_MODEL_DIR,
+        help='Model store directory'
+    )
+    parser.add_argument('--pin', type=str, help='Repository ID to pin')
+    parser.add_argument('--unpin', type=str, help='Repository ID to unpin')
+    parser.add_argument('--remove', type=str, help='Repository ID to remove')
+    args = parser.parse_args()
+
+    store = ModelStore(args.directory)
+    try:
+        if args.pin:
+            store.set_pinned(args.pin, True)
+        if args.unpin:
+            store.set_pinned(args.unpin, False)
+        if args.remove:
+            store.remove(args.remove)
+    except KeyError as e:
+        print(e.args[0])
+        return
+
+    models = store.list_models()
+    if not models:
+        print(f"🔧 The model store at {args.directory} is empty.")
+        return
+    for repo_id, entry in sorted(models.items(), key=lambda item: -item[1].get('last_used', 0)):
+        last_used = time.strftime('%Y-%m-%d %H:%M', time.localtime(entry.get('last_used', 0)))
+        pinned = '📌' if entry.get('pinned') else '  '
+        print(f"{pinned} {repo_id:<50} {entry.get('size', 0) / 1e9:>8.2f} GB  last used {last_used}")
+    print(f"🔧 Total: {sum(entry.get('size', 0) for entry in models.values()) / 1e9:.2f} GB")
+
+
+if __name__ == "__main__":
+    main()
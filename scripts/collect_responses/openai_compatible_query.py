@@ -0,0 +1,129 @@
+"""
+openai_compatible_query.py
+
+Query class for open-weight models served by a local OpenAI-compatible inference server, such as
+the llama.cpp server or vLLM. The server keeps the model loaded across runs and batches concurrent
+requests itself, so these models are collected through the concurrent async path like the API
+models instead of being loaded into the collection process by `HuggingFaceQuery`.
+"""
+
+import os
+from dotenv import load_dotenv
+from openai import OpenAI, AsyncOpenAI
+
+from scripts.collect_responses.gpt_query import GPTQuery
+
+DEFAULT_BASE_URL = "http://localhost:8000/v1"
+
+# Local servers usually accept any key; set LOCAL_SERVER_API_KEY if the server was started with one
+PLACEHOLDER_API_KEY = "EMPTY"
+
+PROMPT_FORMATS = ('chat', 'raw')
+
+
+class OpenAICompatibleQuery(GPTQuery):
+    provider = 'openai_compatible'
+
+    # Local inference servers do not implement the Batch API
+    build_batch_request = None
+
+    def __init__(self, system_prompt, model_name, max_tokens, temperature, rate_limit=None, cache_config=None, base_url=None, hedging=None, prompt_format='chat'):
+        """
+        Parameters:
+        - prompt_format (str): 'chat' to send the system prompt and query as chat messages, formatted
+          by the server's chat template, or 'raw' to send the system prompt followed by the query as
+          a plain completion prompt, as `HuggingFaceQuery` does. Use 'raw' for models whose chat
+          template has no system role, such as Gemma.
+        """
+        if prompt_format not in PROMPT_FORMATS:
+            raise ValueError(f"❌ Prompt format '{prompt_format}' is not recognized. Expected one of: {', '.join(PROMPT_FORMATS)}.")
+        self.prompt_format = prompt_format
+        super().__init__(system_prompt, model_name, max_tokens, temperature, rate_limit, cache_config, base_url or DEFAULT_BASE_URL, hedging)
+
+    @staticmethod
+    def get_api_key() -> str:
+        load_dotenv(os.path.join(os.path.dirname(__file__), '../../configs/.env'))
+        return os.environ.get("LOCAL_SERVER_API_KEY") or PLACEHOLDER_API_KEY
+
+    @classmethod
+    def initialize_openai_client(cls, base_url=None):
+        """
+        Initialize the OpenAI client for the inference server.
+
+        Parameters:
+        - base_url (str): The server's base URL, e.g. http://localhost:8000/v1.
+
+        Returns:
+        - OpenAI: Initialized OpenAI client.
+        """
+        try:
+            return OpenAI(api_key=cls.get_api_key(), base_url=base_url or DEFAULT_BASE_URL)
+        except Exception as e:
+            print(f"Error initializing inference server client: {e}")
+        return None
+
+    @classmethod
+    def initialize_async_openai_client(cls, base_url=None):
+        """
+        Initialize the asynchronous OpenAI client for the inference server.
+
+        Parameters:
+        - base_url (str): The server's base URL, e.g. http://localhost:8000/v1.
+
+        Returns:
+        - AsyncOpenAI: Initialized asynchronous OpenAI client.
+        """
+        try:
+            return AsyncOpenAI(api_key=cls.get_api_key(), base_url=base_url or DEFAULT_BASE_URL)
+        except Exception as e:
+            print(f"Error initializing async inference server client: {e}")
+        return None
+
+    def get_cache_file_path(self):
+        """
+        Get the path to the cache file, kept apart from the cache of the same model run in-process.
+
+        Returns:
+        - str: The cache file path.
+        """
+        return super().get_cache_file_path().replace('_cache.jsonl', '_server_cache.jsonl')
+
+    def cache_params(self) -> dict:
+        """
+        Get the generation parameters that distinguish cached responses.
+
+        Returns:
+        - dict: Parameters included in the cache key.
+        """
+        params = {**super().cache_params(), 'prompt_format': self.prompt_format}
+        # The server address only locates the served model, so moving the server keeps its cache
+        params.pop('base_url', None)
+        return params
+
+    def create_completion(self, client, query: str):
+        """
+        Send a query through the sync or async client, as chat messages or as a raw prompt.
+
+        Parameters:
+        - client: The `OpenAI` or `AsyncOpenAI` client.
+        - query (str): The input query string.
+
+        Returns:
+        - The completion, or a coroutine returning it for the async client.
+        """
+        if self.prompt_format == 'chat':
+            return super().create_completion(client, query)
+        return client.completions.create(
+            model=self.model_name,
+            max_tokens=self.max_tokens,
+            temperature=self.temperature,
+            prompt=self.system_prompt + query
+        )
+
+    def completion_text(self, completion) -> str:
+        """
+        Get the generated text of a chat or raw completion.
+        """
+        if self.prompt_format == 'chat':
+            return super().completion_text(completion)
+        return completion.choices[0].text
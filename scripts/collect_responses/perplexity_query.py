@@ -1,18 +1,43 @@
 import os
 import gc
 import time
-import json
+import aiohttp
 import requests
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
 
-class PerplexityQuery:
-    def __init__(self, system_prompt, model_name, max_tokens, temperature):
-        self.api_url = "https://api.perplexity.ai/chat/completions"
+from scripts.collect_responses.response_cache import ResponseCacheMixin
+from scripts.collect_responses.rate_limiter import get_rate_limiter, estimate_tokens
+from scripts.collect_responses.hedging import get_hedger
+from scripts.collect_responses.query_result import QueryResult
+
+DEFAULT_BASE_URL = "https://api.perplexity.ai"
+
+# Connection pool defaults, overridable through the provider's 'connection' settings
+DEFAULT_POOL_SIZE = 8
+DEFAULT_CONNECT_TIMEOUT = 10.0
+DEFAULT_READ_TIMEOUT = 120.0
+DEFAULT_KEEPALIVE_TIMEOUT = 60.0
+
+class PerplexityQuery(ResponseCacheMixin):
+    def __init__(self, system_prompt, model_name, max_tokens, temperature, rate_limit=None, cache_config=None, connection_config=None, base_url=None, hedging=None):
+        self.api_url = f"{(base_url or DEFAULT_BASE_URL).rstrip('/')}/chat/completions"
         self.system_prompt = system_prompt
         self.model_name = model_name
         self.max_tokens = max_tokens
         self.temperature = temperature
+        self.base_url = base_url
+        self.rate_limiter = get_rate_limiter('perplexity', rate_limit)
+        self.hedger = get_hedger('perplexity', hedging)
         self.headers = self.initialize_headers()
+        connection_config = connection_config or {}
+        self.pool_size = connection_config.get('pool_size') or DEFAULT_POOL_SIZE
+        self.connect_timeout = connection_config.get('connect_timeout') or DEFAULT_CONNECT_TIMEOUT
+        self.read_timeout = connection_config.get('read_timeout') or DEFAULT_READ_TIMEOUT
+        self.keepalive_timeout = connection_config.get('keepalive_timeout') or DEFAULT_KEEPALIVE_TIMEOUT
+        self.session = self.initialize_session()
+        self.async_session = None
+        self.cache_config = cache_config
         self.cache_file = self.get_cache_file_path()
         self.cache = self.load_cache()
 
@@ -40,69 +65,71 @@ class PerplexityQuery:
             print(f"Error initializing headers: {e}")
             return {}
 
-    def get_cache_file_path(self):
+    def initialize_session(self) -> requests.Session:
         """
-        Get the path to the cache file based on the model name.
+        Initialize a pooled HTTP session, so consecutive requests reuse kept-alive connections
+        instead of opening a new TCP and TLS connection each time.
 
         Returns:
-        - str: The cache file path.
+        - requests.Session: Session with the API headers and a connection pool of `pool_size`.
         """
-        cache_dir = os.path.join(os.path.dirname(__file__), '..', '..', '.cache', 'model_responses_cache')
-        os.makedirs(cache_dir, exist_ok=True)
-        return os.path.join(cache_dir, f'{self.model_name}_cache.json')
+        session = requests.Session()
+        session.headers.update(self.headers)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
 
-    def load_cache(self):
+    def initialize_async_session(self) -> aiohttp.ClientSession:
         """
-        Load the cache from the cache file.
-        
+        Initialize the pooled asynchronous HTTP session. It must be created inside the running event loop.
+
         Returns:
-        - dict: The loaded cache data.
+        - aiohttp.ClientSession: Session keeping up to `pool_size` connections alive.
         """
-        if os.path.exists(self.cache_file):
-            try:
-                with open(self.cache_file, 'r') as f:
-                    return json.load(f)
-            except Exception as e:
-                print(f"Error loading cache file: {e}")
-        return {}
+        connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=self.keepalive_timeout)
+        timeout = aiohttp.ClientTimeout(sock_connect=self.connect_timeout, sock_read=self.read_timeout)
+        return aiohttp.ClientSession(headers=self.headers, connector=connector, timeout=timeout)
 
-    def save_cache(self):
+    def query(self, query: str) -> str:
         """
-        Save the cache to a cache file.
+        Query the Perplexity API or retrieve from cache if available.
+
+        Parameters:
+        - query (str): The input query string.
+
+        Returns:
+        - str: The response content from the API or the cached response.
         """
-        try:
-            with open(self.cache_file, 'w') as f:
-                json.dump(self.cache, f)
-        except Exception as e:
-            print(f"Error saving cache file: {e}")
+        return self.query_result(query).response
 
-    def get_cache_key(self, query: str):
+    async def aquery(self, query: str) -> str:
         """
-        Generate a unique cache key based on the model name, query, and system prompt.
+        Asynchronously query the Perplexity API or retrieve from cache if available.
 
         Parameters:
         - query (str): The input query string.
 
         Returns:
-        - str: The cache key.
+        - str: The response content from the API or the cached response.
         """
-        return f"{self.model_name}_{self.system_prompt}_{query}"
+        return (await self.aquery_result(query)).response
 
-    def query(self, query: str) -> str:
+    def query_result(self, query: str) -> QueryResult:
         """
-        Query the Perplexity API or retrieve from cache if available.
+        Query the Perplexity API or retrieve from cache if available, with timing and token usage.
 
         Parameters:
         - query (str): The input query string.
 
         Returns:
-        - str: The response content from the API or the cached response.
+        - QueryResult: The response content or an error message, with request metrics.
         """
         cache_key = self.get_cache_key(query)
 
         # Check if the result is already cached
         if cache_key in self.cache:
-            return self.cache[cache_key]
+            return QueryResult(self.cache[cache_key], cache_hit=True)
 
         # If not cached, query the API
         payload = {
@@ -115,26 +142,112 @@ class PerplexityQuery:
             ]
         }
 
-        try:
-            time.sleep(3)
-            response = requests.post(self.api_url, json=payload, headers=self.headers)
+        def send():
+            response = self.session.post(self.api_url, json=payload, timeout=(self.connect_timeout, self.read_timeout))
             response.raise_for_status()
-            response_content = response.json().get('choices', [{}])[0].get('message', {}).get('content', 'No content returned')
+            return response.json()
+
+        tokens = estimate_tokens(self.system_prompt, query, max_tokens=self.max_tokens)
+        self.rate_limiter.acquire(tokens)
+        start = time.perf_counter()
+        try:
+            response_json = self.hedger.run(send, reserve=lambda: self.rate_limiter.try_acquire(tokens))
+            return self._response_result(cache_key, response_json, time.perf_counter() - start)
+        except Exception as e:
+            self.rate_limiter.record_error(e)
+            return QueryResult.from_error(self.model_name, e, latency_s=time.perf_counter() - start)
+
+    async def aquery_result(self, query: str) -> QueryResult:
+        """
+        Asynchronously query the Perplexity API or retrieve from cache if available, with timing and token usage.
+
+        Parameters:
+        - query (str): The input query string.
+
+        Returns:
+        - QueryResult: The response content or an error message, with request metrics.
+        """
+        cache_key = self.get_cache_key(query)
 
-            # Cache the result
-            self.cache[cache_key] = response_content
-            self.save_cache()
+        # Check if the result is already cached
+        if cache_key in self.cache:
+            return QueryResult(self.cache[cache_key], cache_hit=True)
+
+        # Identical queries already in flight wait on that request instead of sending their own
+        return await self.coalesce_request(cache_key, lambda: self._arequest(query, cache_key))
+
+    async def _arequest(self, query: str, cache_key: str) -> QueryResult:
+        """
+        Send an uncached query to the Perplexity API and cache the response.
+        """
+        # If not cached, query the API
+        payload = {
+            "model": self.model_name,
+            "max_tokens": self.max_tokens,
+            "temperature": self.temperature,
+            "messages": [
+                {"role": "system", "content": self.system_prompt},
+                {"role": "user", "content": query}
+            ]
+        }
 
-            return response_content
-        except requests.exceptions.RequestException as e:
-            error_message = f"Error in {self.model_name} response: {e}"
-            return error_message
+        async def send():
+            async with self.async_session.post(self.api_url, json=payload) as response:
+                response.raise_for_status()
+                return await response.json()
+
+        start = None
+        try:
+            if self.async_session is None:
+                self.async_session = self.initialize_async_session()
+
+            tokens = estimate_tokens(self.system_prompt, query, max_tokens=self.max_tokens)
+            await self.rate_limiter.aacquire(tokens)
+            start = time.perf_counter()
+            response_json = await self.hedger.arun(send, reserve=lambda: self.rate_limiter.try_acquire(tokens))
+            return self._response_result(cache_key, response_json, time.perf_counter() - start)
+        except Exception as e:
+            self.rate_limiter.record_error(e)
+            return QueryResult.from_error(self.model_name, e, latency_s=time.perf_counter() - start if start is not None else None)
+
+    def _response_result(self, cache_key: str, response_json: dict, latency: float) -> QueryResult:
+        """
+        Cache a chat completion's text and wrap it with its latency and token usage.
+        """
+        response_content = response_json.get('choices', [{}])[0].get('message', {}).get('content', 'No content returned')
+
+        # Cache the result
+        self.cache[cache_key] = response_content
+        self.save_cache()
+
+        usage = response_json.get('usage') or {}
+        return QueryResult(
+            response_content,
+            latency_s=latency,
+            input_tokens=usage.get('prompt_tokens'),
+            output_tokens=usage.get('completion_tokens')
+        )
+
+    async def aclose(self):
+        """
+        Close the asynchronous HTTP session.
+        """
+        try:
+            if self.async_session is not None:
+                await self.async_session.close()
+                self.async_session = None
+        except Exception as e:
+            print(f"Error closing async Perplexity session: {e}")
 
     def delete(self):
         """
-        Delete the attributes to free up memory.
+        Close the HTTP session and delete the attributes to free up memory.
         """
         try:
+            if getattr(self, 'session', None) is not None:
+                self.session.close()
+                del self.session
+
             for attr in ['system_prompt', 'model_name', 'headers']:
                 if hasattr(self, attr):
                     delattr(self, attr)
@@ -0,0 +1,129 @@
+"""
+query_result.py
+
+Structured result of a single model query. Besides the response text, a `QueryResult` carries
+the request's wall time, time to first token (streaming requests only), provider-reported token
+usage (including input tokens read from the provider's prompt cache), the number of retries and whether the response came from the cache. The response
+runner stores these as `{model}_<metric>` columns next to `{model}_response`.
+"""
+
+import math
+from dataclasses import dataclass, asdict
+from typing import List, Optional
+
+from scripts.collect_responses.rate_limiter import classify_error, get_retry_after
+
+# Metric fields written to the response CSVs, in column order
+METRIC_FIELDS = ('latency_s', 'ttft_s', 'input_tokens', 'cached_input_tokens', 'output_tokens', 'retries', 'cache_hit')
+
+
+@dataclass
+class QueryResult:
+    response: str
+    # Wall time of the request in seconds, excluding time spent waiting on the rate limiter
+    latency_s: Optional[float] = None
+    # Seconds until the first token arrived; only known for streamed generations
+    ttft_s: Optional[float] = None
+    input_tokens: Optional[int] = None
+    # Part of input_tokens served from the provider's prompt cache, where the provider reports it
+    cached_input_tokens: Optional[int] = None
+    output_tokens: Optional[int] = None
+    retries: int = 0
+    cache_hit: bool = False
+    # For failed queries: 'rate_limit', 'transient' or 'fatal', and the server's backoff hint in seconds
+    error_type: Optional[str] = None
+    retry_after: Optional[float] = None
+
+    @classmethod
+    def from_error(cls, model_name: str, error: Exception, latency_s: Optional[float] = None) -> 'QueryResult':
+        """
+        Build the result of a failed query from the provider exception.
+
+        Parameters:
+        - model_name (str): The model name used in the error message.
+        - error (Exception): The exception raised by the provider client.
+        - latency_s (float): Optional wall time of the failed request.
+
+        Returns:
+        - QueryResult: An 'Error in {model_name} response' result with the error class and Retry-After hint.
+        """
+        return cls(
+            f"Error in {model_name} response: {error}",
+            latency_s=latency_s,
+            error_type=classify_error(error),
+            retry_after=get_retry_after(error)
+        )
+
+    def metrics(self) -> dict:
+        """
+        Get the metrics written to the response CSVs.
+
+        Returns:
+        - dict: Mapping of metric name (see METRIC_FIELDS) to value.
+        """
+        values = asdict(self)
+        return {field: values[field] for field in METRIC_FIELDS}
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """
+    Get the q-th percentile (0-100) of values with linear interpolation, or None if there are no values.
+    """
+    values = sorted(values)
+    if not values:
+        return None
+    rank = (len(values) - 1) * q / 100
+    low, high = math.floor(rank), math.ceil(rank)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+def summarize_results(results: List[QueryResult], elapsed: float) -> dict:
+    """
+    Summarize the results of one collection run.
+
+    Parameters:
+    - results (List[QueryResult]): Results of the queries sent during the run.
+    - elapsed (float): Wall time of the run in seconds.
+
+    Returns:
+    - dict: Query count, cache hits, retries, p50/p95 latency of uncached queries, input tokens
+      and the share read from the provider's prompt cache, throughput in queries per second and
+      output tokens per second.
+    """
+    latencies = [r.latency_s for r in results if not r.cache_hit and r.latency_s is not None]
+    output_tokens = sum(r.output_tokens or 0 for r in results if not r.cache_hit)
+    input_tokens = sum(r.input_tokens or 0 for r in results if not r.cache_hit)
+    cached_input_tokens = sum(r.cached_input_tokens or 0 for r in results if not r.cache_hit)
+    return {
+        'queries': len(results),
+        'cache_hits': sum(r.cache_hit for r in results),
+        'retries': sum(r.retries for r in results),
+        'latency_p50_s': percentile(latencies, 50),
+        'latency_p95_s': percentile(latencies, 95),
+        'input_tokens': input_tokens,
+        'cached_input_tokens': cached_input_tokens,
+        'prompt_cache_rate': cached_input_tokens / input_tokens if input_tokens else None,
+        'queries_per_s': len(results) / elapsed if elapsed > 0 else None,
+        'output_tokens_per_s': output_tokens / elapsed if elapsed > 0 else None,
+    }
+
+
+def format_summary(model_name: str, summary: dict) -> str:
+    """
+    Format a run summary from `summarize_results` as a one-line report.
+    """
+    def seconds(value):
+        return f"{value:.2f}s" if value is not None else "n/a"
+
+    def rate(value, unit):
+        return f"{value:.2f} {unit}/s" if value is not None else "n/a"
+
+    prompt_cache = ""
+    if summary.get('cached_input_tokens'):
+        prompt_cache = (f" | prompt cache {summary['cached_input_tokens']} of {summary['input_tokens']} "
+                        f"input tokens ({summary['prompt_cache_rate']:.1%})")
+
+    return (f"🔧 {model_name}: {summary['queries']} queries ({summary['cache_hits']} cached, "
+            f"{summary['retries']} retries) | latency p50 {seconds(summary['latency_p50_s'])}, "
+            f"p95 {seconds(summary['latency_p95_s'])} | {rate(summary['queries_per_s'], 'queries')}, "
+            f"{rate(summary['output_tokens_per_s'], 'tokens')}{prompt_cache}")
@@ -0,0 +1,242 @@
+"""
+rate_limiter.py
+
+Token-bucket rate limiting shared by the query classes. Each provider gets one limiter per
+process, configured with a requests-per-minute and a tokens-per-minute quota. When a provider
+rejects a request with a rate-limit error the limiter pauses every caller until the server's
+Retry-After hint has passed.
+"""
+
+import time
+import asyncio
+import threading
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+# Pause applied after a rate-limit error that carries no Retry-After hint
+DEFAULT_RATE_LIMIT_BACKOFF = 10.0
+
+# Errors that fail the same way however often they are retried
+FATAL_STATUS_CODES = {400, 401, 403, 404, 413, 422}
+FATAL_ERROR_TYPES = (
+    'BadRequestError', 'AuthenticationError', 'PermissionDeniedError', 'NotFoundError',
+    'UnprocessableEntityError', 'InvalidArgument', 'PermissionDenied', 'Unauthenticated', 'NotFound',
+)
+
+# Shared limiters, keyed by provider name
+_RATE_LIMITERS = {}
+_RATE_LIMITERS_LOCK = threading.Lock()
+
+
+class TokenBucket:
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.rate = float(per_minute) / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        """
+        Add the amount accumulated since the last refill, up to the bucket capacity.
+        """
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """
+        Seconds until `amount` can be taken from the bucket. Requests larger than the
+        bucket are clamped so they wait for a full bucket instead of forever.
+        """
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.rate
+
+    def take(self, amount: float):
+        self.level -= min(amount, self.capacity)
+
+
+class RateLimiter:
+    def __init__(self, requests_per_minute: Optional[float] = None, tokens_per_minute: Optional[float] = None):
+        self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def _reserve(self, tokens: int) -> float:
+        """
+        Take one request and `tokens` tokens if both are available.
+
+        Returns:
+        - float: 0.0 if the reservation was made, otherwise the seconds to wait before trying again.
+        """
+        with self.lock:
+            now = time.monotonic()
+            wait = self.blocked_until - now
+            for bucket, amount in ((self.request_bucket, 1), (self.token_bucket, tokens)):
+                if bucket is not None:
+                    bucket.refill(now)
+                    wait = max(wait, bucket.wait_time(amount))
+            if wait > 0:
+                return wait
+            if self.request_bucket is not None:
+                self.request_bucket.take(1)
+            if self.token_bucket is not None:
+                self.token_bucket.take(tokens)
+            return 0.0
+
+    def acquire(self, tokens: int = 0):
+        """
+        Block until a request of `tokens` estimated tokens fits within the quota.
+        """
+        while True:
+            wait = self._reserve(tokens)
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    async def aacquire(self, tokens: int = 0):
+        """
+        Wait without blocking the event loop until a request of `tokens` estimated tokens fits within the quota.
+        """
+        while True:
+            wait = self._reserve(tokens)
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+
+    def try_acquire(self, tokens: int = 0) -> bool:
+        """
+        Take a request of `tokens` estimated tokens from the quota only if it fits right away.
+
+        Returns:
+        - bool: Whether the request may be sent now.
+        """
+        return self._reserve(tokens) <= 0
+
+    def backoff(self, seconds: float):
+        """
+        Hold back every request through this limiter for at least `seconds`.
+        """
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def record_error(self, error: Exception):
+        """
+        Inspect a failed request and pause the limiter if the provider signalled a rate limit.
+
+        Parameters:
+        - error (Exception): The exception raised by the provider client.
+        """
+        retry_after = get_retry_after(error)
+        if retry_after is not None:
+            self.backoff(retry_after)
+        elif is_rate_limit_error(error):
+            self.backoff(DEFAULT_RATE_LIMIT_BACKOFF)
+
+
+def get_rate_limiter(provider: str, rate_limit: Optional[dict] = None) -> RateLimiter:
+    """
+    Get the limiter shared by all query instances of a provider in this process.
+
+    Parameters:
+    - provider (str): Provider name, e.g. 'openai'.
+    - rate_limit (dict): Optional quota with 'requests_per_minute' and 'tokens_per_minute'.
+      Only used when the provider's limiter is first created.
+
+    Returns:
+    - RateLimiter: The provider's limiter.
+    """
+    rate_limit = rate_limit or {}
+    with _RATE_LIMITERS_LOCK:
+        if provider not in _RATE_LIMITERS:
+            _RATE_LIMITERS[provider] = RateLimiter(
+                requests_per_minute=rate_limit.get('requests_per_minute'),
+                tokens_per_minute=rate_limit.get('tokens_per_minute')
+            )
+        return _RATE_LIMITERS[provider]
+
+
+def estimate_tokens(*texts: str, max_tokens: int = 0) -> int:
+    """
+    Roughly estimate the tokens a request counts against the quota: about four characters
+    per prompt token plus the requested completion budget.
+    """
+    return sum(len(text or '') for text in texts) // 4 + max_tokens
+
+
+def _get_headers(error: Exception):
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None)
+    if headers is None:
+        headers = getattr(error, 'headers', None)
+    return headers
+
+
+def get_retry_after(error: Exception) -> Optional[float]:
+    """
+    Extract the server's backoff hint from a provider exception.
+
+    Parameters:
+    - error (Exception): The exception raised by the provider client.
+
+    Returns:
+    - float: Seconds to wait, or None if the response carried no Retry-After header.
+    """
+    headers = _get_headers(error)
+    if not headers:
+        return None
+    try:
+        retry_after_ms = headers.get('retry-after-ms')
+        if retry_after_ms is not None:
+            return float(retry_after_ms) / 1000.0
+        retry_after = headers.get('retry-after')
+        if retry_after is None:
+            return None
+        try:
+            return float(retry_after)
+        except ValueError:
+            return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+    except Exception:
+        return None
+
+
+def get_status_code(error: Exception) -> Optional[int]:
+    """
+    Get the HTTP status code attached to a provider exception, if any.
+    """
+    for status in (
+        getattr(error, 'status_code', None),
+        getattr(error, 'status', None),
+        getattr(getattr(error, 'response', None), 'status_code', None),
+        getattr(error, 'code', None),
+    ):
+        if isinstance(status, int):
+            return status
+    return None
+
+
+def is_rate_limit_error(error: Exception) -> bool:
+    """
+    Check whether a provider exception is a rate-limit (HTTP 429) rejection.
+    """
+    return get_status_code(error) == 429 or type(error).__name__ in ('RateLimitError', 'ResourceExhausted')
+
+
+def classify_error(error: Exception) -> str:
+    """
+    Classify a provider exception by whether and how it should be retried.
+
+    Parameters:
+    - error (Exception): The exception raised by the provider client.
+
+    Returns:
+    - str: 'rate_limit' for quota rejections, 'fatal' for requests that cannot succeed on retry
+      (bad request, authentication, unknown model), and 'transient' for everything else,
+      e.g. timeouts, connection errors and server errors.
+    """
+    if is_rate_limit_error(error):
+        return 'rate_limit'
+    if get_status_code(error) in FATAL_STATUS_CODES or type(error).__name__ in FATAL_ERROR_TYPES:
+        return 'fatal'
+    return 'transient'
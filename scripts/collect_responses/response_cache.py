@@ -0,0 +1,391 @@
+"""
+response_cache.py
+
+The response cache shared by every query class in collect_responses.
+
+A `ResponseCache` wraps a pluggable backend and counts hits and misses per model:
+
+- 'memory': an in-process LRU, bounded by entry count and/or approximate size in bytes.
+- 'disk': the append-only `ResponseCacheStore`, bounded by entry count.
+- 'redis': a shared network store, so several nodes can reuse each other's responses.
+
+All backends support age-based expiry. The backend and its limits come from the `cache`
+section of the configuration file. Query classes pick up the cache through `ResponseCacheMixin`.
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import dataclasses
+from collections import OrderedDict
+from typing import Awaitable, Callable, Optional, Tuple
+
+from scripts.collect_responses.cache_store import ResponseCacheStore, make_cache_key, legacy_key_migration
+from scripts.collect_responses.query_result import QueryResult
+
+CACHE_DIR = os.path.join(os.path.dirname(__file__), '..', '..', '.cache', 'model_responses_cache')
+
+
+class MemoryBackend:
+    def __init__(self, max_entries: Optional[int] = None, max_bytes: Optional[int] = None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size_bytes = 0
+
+    @staticmethod
+    def _entry_size(key: str, value) -> int:
+        return sys.getsizeof(key) + sys.getsizeof(value)
+
+    def get(self, key: str) -> Optional[Tuple[object, Optional[float]]]:
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        return entry
+
+    def set(self, key: str, value, created: float):
+        self.delete(key)
+        self.entries[key] = (value, created)
+        self.size_bytes += self._entry_size(key, value)
+        # Evict least recently used entries beyond the limits
+        while self.entries and (
+            (self.max_entries is not None and len(self.entries) > self.max_entries)
+            or (self.max_bytes is not None and self.size_bytes > self.max_bytes)
+        ):
+            self.delete(next(iter(self.entries)))
+
+    def delete(self, key: str):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size_bytes -= self._entry_size(key, entry[0])
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class DiskBackend:
+    def __init__(self, path: str, max_entries: Optional[int] = None, key_migration=None):
+        self.store = ResponseCacheStore(path, key_migration=key_migration)
+        self.max_entries = max_entries
+        self.evicted = 0
+
+    def get(self, key: str) -> Optional[Tuple[object, Optional[float]]]:
+        try:
+            record = self.store[key]
+        except KeyError:
+            return None
+        # Entries written before age tracking are plain responses without a timestamp
+        if isinstance(record, dict) and 'response' in record:
+            return record['response'], record.get('created')
+        return record, None
+
+    def set(self, key: str, value, created: float):
+        self.store[key] = {'response': value, 'created': created}
+        if self.max_entries is not None:
+            # The store index keeps insertion order, so the first keys are the oldest
+            while len(self.store) > self.max_entries:
+                try:
+                    del self.store[self.store.oldest_key()]
+                except KeyError:
+                    # Another job sharing the store evicted it first
+                    continue
+                self.evicted += 1
+            # Reclaim the space of evicted records once they outnumber the live ones
+            if self.evicted > self.max_entries:
+                self.store.compact()
+                self.evicted = 0
+
+    def delete(self, key: str):
+        if key in self.store:
+            del self.store[key]
+
+    def __len__(self) -> int:
+        return len(self.store)
+
+    def flush(self):
+        self.store.flush()
+
+    def close(self):
+        self.store.close()
+
+
+class RedisBackend:
+    def __init__(self, url: str, namespace: str, max_age: Optional[float] = None):
+        try:
+            import redis
+        except ImportError as e:
+            raise ImportError("The 'redis' cache backend requires the redis package (pip install redis).") from e
+        self.client = redis.Redis.from_url(url)
+        self.namespace = namespace
+        self.max_age = max_age
+
+    def _key(self, key: str) -> str:
+        return f"{self.namespace}:{key}"
+
+    def get(self, key: str) -> Optional[Tuple[object, Optional[float]]]:
+        raw = self.client.get(self._key(key))
+        if raw is None:
+            return None
+        record = json.loads(raw)
+        return record['response'], record.get('created')
+
+    def set(self, key: str, value, created: float):
+        expiry = int(self.max_age) if self.max_age else None
+        self.client.set(self._key(key), json.dumps({'response': value, 'created': created}), ex=expiry)
+
+    def delete(self, key: str):
+        self.client.delete(self._key(key))
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self.client.scan_iter(match=f"{self.namespace}:*"))
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.client.close()
+
+
+class ResponseCache:
+    def __init__(self, backend, name: str, max_age: Optional[float] = None):
+        """
+        Parameters:
+        - backend: The storage backend ('memory', 'disk' or 'redis' implementation).
+        - name (str): Name used when reporting statistics, usually the model name.
+        - max_age (float): Optional age in seconds after which entries are treated as missing.
+        """
+        self.backend = backend
+        self.name = name
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self._last_lookup = None
+
+    def _lookup(self, key: str):
+        if self._last_lookup is not None and self._last_lookup[0] == key:
+            return self._last_lookup[1]
+        entry = self.backend.get(key)
+        if entry is not None and self.max_age is not None:
+            created = entry[1]
+            if created is not None and time.time() - created > self.max_age:
+                self.backend.delete(key)
+                entry = None
+        self._last_lookup = (key, entry)
+        return entry
+
+    def __contains__(self, key: str) -> bool:
+        self._last_lookup = None
+        entry = self._lookup(key)
+        if entry is None:
+            self.misses += 1
+            return False
+        self.hits += 1
+        return True
+
+    def __getitem__(self, key: str):
+        entry = self._lookup(key)
+        if entry is None:
+            raise KeyError(key)
+        return entry[0]
+
+    def get(self, key: str, default=None):
+        return self[key] if key in self else default
+
+    def __setitem__(self, key: str, value):
+        self.backend.set(key, value, time.time())
+        self._last_lookup = None
+
+    def __delitem__(self, key: str):
+        self.backend.delete(key)
+        self._last_lookup = None
+
+    def __len__(self) -> int:
+        return len(self.backend)
+
+    def flush(self):
+        self.backend.flush()
+
+    def close(self):
+        self.backend.close()
+
+    def stats(self) -> dict:
+        """
+        Get the hit and miss counts for this cache.
+
+        Returns:
+        - dict: Lookups, hits, misses and hit rate.
+        """
+        lookups = self.hits + self.misses
+        return {
+            'lookups': lookups,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+    def stats_message(self) -> str:
+        stats = self.stats()
+        return (f"🔧 Cache for {self.name}: {stats['hits']} hits, {stats['misses']} misses "
+                f"({stats['hit_rate']:.1%} hit rate)")
+
+
+def create_response_cache(
+    name: str,
+    cache_file: str,
+    cache_config: Optional[dict] = None,
+    key_migration=None
+) -> ResponseCache:
+    """
+    Create a response cache from the `cache` configuration section.
+
+    Parameters:
+    - name (str): Name of the cache, usually the model name.
+    - cache_file (str): Path to the on-disk store, used by the 'disk' backend.
+    - cache_config (dict): Optional settings: 'backend' ('memory', 'disk' or 'redis'),
+      'max_entries', 'max_bytes' (memory only), 'max_age_days' and 'redis_url'.
+    - key_migration (callable): Optional legacy key migration for the 'disk' backend.
+
+    Returns:
+    - ResponseCache: The configured cache.
+
+    Raises:
+    - ValueError: If the backend is not recognized.
+    """
+    cache_config = cache_config or {}
+    backend_name = cache_config.get('backend', 'disk')
+    max_entries = cache_config.get('max_entries')
+    max_age_days = cache_config.get('max_age_days')
+    max_age = max_age_days * 86400 if max_age_days else None
+
+    if backend_name == 'memory':
+        backend = MemoryBackend(max_entries=max_entries, max_bytes=cache_config.get('max_bytes'))
+    elif backend_name == 'disk':
+        backend = DiskBackend(cache_file, max_entries=max_entries, key_migration=key_migration)
+    elif backend_name == 'redis':
+        backend = RedisBackend(
+            cache_config.get('redis_url', 'redis://localhost:6379/0'),
+            namespace=f"cardbiomedbench:{name}",
+            max_age=max_age
+        )
+    else:
+        raise ValueError(f"❌ Cache backend '{backend_name}' is not recognized.")
+    return ResponseCache(backend, name, max_age=max_age)
+
+
+class ResponseCacheMixin:
+    """
+    Cache handling shared by the query classes. Classes set `model_name`, `system_prompt`,
+    `max_tokens`, `cache_config` and, for API models, `base_url` before calling `load_cache`, and override
+    `cache_params` if their generation parameters differ from max_tokens/temperature.
+    Async query paths route cache misses through `coalesce_request`, so concurrent
+    duplicates of a query share one request.
+    """
+
+    def get_cache_file_path(self):
+        """
+        Get the path to the cache file based on the last part of the model name, in the
+        configured cache 'directory' or `CACHE_DIR`.
+
+        Returns:
+        - str: The cache file path.
+        """
+        model_base_name = self.model_name.split('/')[-1]
+        cache_dir = (getattr(self, 'cache_config', None) or {}).get('directory') or CACHE_DIR
+        os.makedirs(cache_dir, exist_ok=True)
+        return os.path.join(cache_dir, f'{model_base_name}_cache.jsonl')
+
+    def load_cache(self):
+        """
+        Open the configured response cache for this model. For the on-disk store, legacy
+        JSON caches and legacy unhashed keys are migrated on first lookup.
+
+        Returns:
+        - ResponseCache: The dict-like response cache.
+        """
+        return create_response_cache(
+            self.model_name,
+            self.cache_file,
+            getattr(self, 'cache_config', None),
+            key_migration=legacy_key_migration(self.model_name, self.system_prompt, self.get_cache_key)
+        )
+
+    def save_cache(self):
+        """
+        Flush the cache. Entries are written when they are set, so nothing is rewritten.
+        """
+        try:
+            self.cache.flush()
+        except Exception as e:
+            print(f"Error saving cache file: {e}")
+
+    def cache_params(self) -> dict:
+        """
+        Get the generation parameters that distinguish cached responses.
+
+        Returns:
+        - dict: Parameters included in the cache key.
+        """
+        params = {'max_tokens': self.max_tokens, 'temperature': self.temperature}
+        # Responses from a stand-in server, such as the mock provider, never pass for the provider's
+        base_url = getattr(self, 'base_url', None)
+        if base_url:
+            params['base_url'] = base_url
+        return params
+
+    def get_cache_key(self, query: str):
+        """
+        Generate a fixed-size cache key by hashing the model name, system prompt, query,
+        and generation parameters.
+
+        Parameters:
+        - query (str): The input query string.
+
+        Returns:
+        - str: The cache key.
+        """
+        return make_cache_key(self.model_name, self.system_prompt, query, **self.cache_params())
+
+    async def coalesce_request(self, cache_key: str, request: Callable[[], Awaitable[QueryResult]]) -> QueryResult:
+        """
+        Send a request for an uncached query, or wait on the identical request already in flight.
+        Waiters get a copy of the first request's result, marked as a cache hit when it succeeded
+        since no request of their own was sent. If the first request is cancelled, waiters send
+        their own.
+
+        Parameters:
+        - cache_key (str): The query's cache key, identifying duplicate queries.
+        - request (Callable): Coroutine function that sends the request and caches the response.
+
+        Returns:
+        - QueryResult: The response with its request metrics.
+        """
+        inflight = self.__dict__.setdefault('_inflight_requests', {})
+        future = inflight.get(cache_key)
+        if future is not None:
+            try:
+                result = await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise
+                return await request()
+            succeeded = not result.response.startswith(f"Error in {self.model_name} response")
+            return dataclasses.replace(result, retries=0, cache_hit=succeeded)
+
+        future = asyncio.get_running_loop().create_future()
+        inflight[cache_key] = future
+        try:
+            result = await request()
+            future.set_result(result)
+            return result
+        finally:
+            if not future.done():
+                future.cancel()
+            del inflight[cache_key]
@@ -0,0 +1,110 @@
+"""
+retry_queue.py
+
+Deferred retries for failed queries. Instead of sleeping in place after a failure, a collector
+schedules the query here and carries on with new work; the query is handed back once its
+backoff has passed. The backoff depends on the error class reported in the `QueryResult`:
+rate-limit and transient errors wait for the server's Retry-After hint or an exponential
+backoff, and fatal errors (bad request, authentication, unknown model) are not retried.
+"""
+
+import time
+import heapq
+from typing import Hashable, List, Optional
+
+from scripts.collect_responses.query_result import QueryResult
+from scripts.collect_responses.rate_limiter import DEFAULT_RATE_LIMIT_BACKOFF
+
+
+def retry_delay(result: QueryResult, failures: int, initial_delay: float) -> Optional[float]:
+    """
+    Get the delay before retrying a failed query.
+
+    Parameters:
+    - result (QueryResult): The failed attempt.
+    - failures (int): Number of failed attempts so far, including this one.
+    - initial_delay (float): Backoff after the first failure; doubled after each further failure.
+
+    Returns:
+    - float: Seconds to wait, or None if the error is fatal and the query should not be retried.
+    """
+    if result.error_type == 'fatal':
+        return None
+    backoff = initial_delay * 2 ** (failures - 1)
+    if result.retry_after is not None:
+        return max(result.retry_after, 0.0)
+    if result.error_type == 'rate_limit':
+        return max(backoff, DEFAULT_RATE_LIMIT_BACKOFF)
+    return backoff
+
+
+def failed_result(query: str, result: QueryResult, failures: int) -> QueryResult:
+    """
+    Turn the last failed attempt into the final error result recorded for a query.
+    """
+    if result.error_type == 'fatal':
+        result.response = f"ERROR: Failed getting response for '{query}' (not retried). Last error: {result.response}"
+    else:
+        result.response = f"ERROR: Failed getting response for '{query}' after {failures} retries. Last error: {result.response}"
+    result.retries = failures - 1
+    return result
+
+
+class RetryQueue:
+    def __init__(self, retries: int, initial_delay: float):
+        """
+        Parameters:
+        - retries (int): Maximum number of attempts per query.
+        - initial_delay (float): Backoff after the first failure; doubled after each further failure.
+        """
+        self.retries = retries
+        self.initial_delay = initial_delay
+        self.failures = {}
+        self.heap = []
+
+    def schedule(self, key: Hashable, result: QueryResult) -> bool:
+        """
+        Record a failed attempt and schedule a retry if the error allows one.
+
+        Parameters:
+        - key (Hashable): Identifies the query, e.g. its index.
+        - result (QueryResult): The failed attempt.
+
+        Returns:
+        - bool: True if a retry was scheduled, False if the query has failed for good.
+        """
+        failures = self.failures.get(key, 0) + 1
+        self.failures[key] = failures
+        delay = retry_delay(result, failures, self.initial_delay)
+        if delay is None or failures >= self.retries:
+            return False
+        heapq.heappush(self.heap, (time.monotonic() + delay, failures, key))
+        print(f"❌ Error querying model ({result.error_type or 'transient'}). Retry {failures}/{self.retries} in {delay:.1f}s")
+        return True
+
+    def failure_count(self, key: Hashable) -> int:
+        """
+        Get the number of failed attempts recorded for a query.
+        """
+        return self.failures.get(key, 0)
+
+    def pop_ready(self) -> List[Hashable]:
+        """
+        Remove and return the queries whose backoff has passed.
+        """
+        ready = []
+        now = time.monotonic()
+        while self.heap and self.heap[0][0] <= now:
+            ready.append(heapq.heappop(self.heap)[2])
+        return ready
+
+    def wait_time(self) -> float:
+        """
+        Seconds until the next scheduled retry is due, or 0.0 if the queue is empty.
+        """
+        if not self.heap:
+            return 0.0
+        return max(0.0, self.heap[0][0] - time.monotonic())
+
+    def __len__(self) -> int:
+        return len(self.heap)
@@ -0,0 +1,116 @@
+"""
+shards.py
+
+Deterministic sharding of a QA split for response collection. Each question is assigned to a
+shard by a hash of its UUID, so every shard job (a SLURM array task or a local process) picks
+the same questions regardless of row order. Shards write `{model}_responses.shard-{i}-of-{N}.csv`,
+and `merge_shards` combines them into `{model}_responses.csv` once every UUID is covered exactly once.
+"""
+
+import os
+import hashlib
+from typing import Tuple
+
+import pandas as pd
+
+from scripts.scripts_utils import load_dataset, save_dataset
+
+
+def parse_shard(spec: str) -> Tuple[int, int]:
+    """
+    Parse a shard specification of the form 'i/N', with 0 <= i < N.
+
+    Args:
+        spec (str): The shard specification, e.g. '0/4'.
+
+    Returns:
+        Tuple[int, int]: The shard index and the number of shards.
+
+    Raises:
+        ValueError: If the specification is malformed or out of range.
+    """
+    try:
+        index, count = (int(part) for part in spec.split('/'))
+    except ValueError:
+        raise ValueError(f"❌ Invalid shard '{spec}'. Expected 'i/N', e.g. '0/4'.")
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f"❌ Invalid shard '{spec}'. The index must be between 0 and N-1.")
+    return index, count
+
+
+def shard_of(uuid, count: int) -> int:
+    """
+    Get the shard a UUID belongs to. Uses a stable hash, unlike Python's salted `hash`.
+    """
+    digest = hashlib.sha1(str(uuid).encode('utf-8')).hexdigest()
+    return int(digest, 16) % count
+
+
+def select_shard(data: pd.DataFrame, index: int, count: int) -> pd.DataFrame:
+    """
+    Get the rows of a dataset that belong to one shard.
+
+    Args:
+        data (pd.DataFrame): The dataset, with a 'uuid' column.
+        index (int): The shard index.
+        count (int): The number of shards.
+
+    Returns:
+        pd.DataFrame: The shard's rows, in their original order.
+    """
+    mask = data['uuid'].map(lambda uuid: shard_of(uuid, count) == index)
+    return data[mask].reset_index(drop=True)
+
+
+def shard_path(res_by_model_dir: str, model_name: str, index: int, count: int) -> str:
+    """
+    Get the path of a shard's partial results file.
+    """
+    return os.path.join(res_by_model_dir, f'{model_name}_responses.shard-{index}-of-{count}.csv')
+
+
+def merge_shards(data: pd.DataFrame, model_name: str, res_by_model_dir: str, count: int) -> pd.DataFrame:
+    """
+    Combine a model's shard results into `{model}_responses.csv`, in the dataset's row order.
+
+    Args:
+        data (pd.DataFrame): The full dataset the shards were taken from.
+        model_name (str): Name of the model.
+        res_by_model_dir (str): Directory holding the shard files.
+        count (int): The number of shards.
+
+    Returns:
+        pd.DataFrame: The merged results.
+
+    Raises:
+        ValueError: If a shard file is missing, a UUID appears more than once or in the wrong
+            shard, or a UUID of the dataset has no response.
+    """
+    shards = []
+    for index in range(count):
+        path = shard_path(res_by_model_dir, model_name, index, count)
+        if not os.path.exists(path):
+            raise ValueError(f"❌ Missing shard {index}/{count} for {model_name}: {path}")
+        shard = load_dataset(path)
+        misplaced = [uuid for uuid in shard['uuid'] if shard_of(uuid, count) != index]
+        if misplaced:
+            raise ValueError(f"❌ Shard {index}/{count} of {model_name} holds {len(misplaced)} UUIDs of other shards, e.g. {misplaced[0]}")
+        shards.append(shard)
+
+    merged = pd.concat(shards, ignore_index=True)
+    merged['uuid'] = merged['uuid'].astype(str)
+    duplicates = merged.loc[merged['uuid'].duplicated(), 'uuid'].tolist()
+    if duplicates:
+        raise ValueError(f"❌ {len(duplicates)} UUIDs appear more than once in the {model_name} shards, e.g. {duplicates[0]}")
+    uuids = data['uuid'].astype(str)
+    missing = sorted(set(uuids) - set(merged['uuid']))
+    if missing:
+        raise ValueError(f"❌ {len(missing)} UUIDs have no response in the {model_name} shards, e.g. {missing[0]}")
+    extra = sorted(set(merged['uuid']) - set(uuids))
+    if extra:
+        raise ValueError(f"❌ {len(extra)} UUIDs in the {model_name} shards are not in the dataset, e.g. {extra[0]}")
+
+    merged = merged.set_index('uuid').loc[uuids].reset_index()
+    merged = merged[list(shards[0].columns)]
+    save_dataset(os.path.join(res_by_model_dir, f'{model_name}_responses.csv'), merged)
+    return merged
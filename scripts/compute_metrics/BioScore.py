@@ -8,12 +8,13 @@ It handles caching, batch submission, result polling, and mapping of scores back
 import os
 import re
 import json
-from typing import Tuple, Dict, List
+import string
+from typing import Tuple, Dict, List, Optional, Set
 
 import pandas as pd
 
 from scripts.scripts_utils import load_dataset, save_dataset
-from scripts.responses_runner import initialize_model
+from scripts.collect_responses.model_registry import initialize_model, load_model_registry
 
 # Define the new cache subdirectory for batch queries
 CACHE_DIR = ".cache/batch_queries"
@@ -40,6 +41,25 @@ def check_BioScore_response(response: str) -> Tuple[float, bool]:
     return None, False
 
 
+def get_template_prefix(template: str) -> str:
+    """
+    Get the fixed opening of a prompt template, up to its first replacement field. Every
+    prompt formatted from the template starts with it, so providers can cache it.
+
+    Args:
+        template (str): The prompt template.
+
+    Returns:
+        str: The text before the first replacement field, as it appears in formatted prompts.
+    """
+    prefix = ''
+    for literal, field, _, _ in string.Formatter().parse(template):
+        prefix += literal
+        if field is not None:
+            break
+    return prefix
+
+
 def process_batch_results(
     batch_result_path: str,
     batch_file_path: str,
@@ -59,6 +79,7 @@ def process_batch_results(
     """
     bioscore_results = {}
     cache = grading_model.cache
+    input_tokens, cached_input_tokens = 0, 0
 
     # Load the original batch queries from the batch file
     batch_queries = {}
@@ -67,7 +88,8 @@ def process_batch_results(
             batch_request = json.loads(line)
             custom_id = batch_request.get('custom_id')
             if custom_id:
-                query = batch_request.get("body", {}).get("messages", [{}])[0].get("content", "")
+                # The grading prompt is the last message, after the system prompt
+                query = batch_request.get("body", {}).get("messages", [{}])[-1].get("content", "")
                 batch_queries[custom_id] = query
 
     # Read and process the batch results
@@ -77,6 +99,9 @@ def process_batch_results(
             custom_id = result.get("custom_id")  # Map back to the original query
             response_content = result.get("response", {}).get("body", {}).get(
                 "choices", [{}])[0].get("message", {}).get("content", "")
+            usage = result.get("response", {}).get("body", {}).get("usage") or {}
+            input_tokens += usage.get("prompt_tokens") or 0
+            cached_input_tokens += (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
 
             if custom_id in batch_queries:
                 original_query = batch_queries[custom_id]
@@ -100,6 +125,10 @@ def process_batch_results(
     # Save the updated cache (only valid responses will be cached)
     grading_model.save_cache()
 
+    if input_tokens:
+        print(f"🔧 Prompt cache for {grading_model.model_name}: {cached_input_tokens} of {input_tokens} "
+              f"input tokens cached ({cached_input_tokens / input_tokens:.1%})")
+
     return bioscore_results
 
 
@@ -107,42 +136,43 @@ def generate_batch_file(
     grading_prompts: List[str],
     batch_file_path: str,
     grading_model,
-    uuids: List[str]
+    uuids: List[str],
+    submitted_keys: Optional[Set[str]] = None,
+    deferred: Optional[List[Tuple[str, str]]] = None
 ) -> bool:
     """
-    Generate a .jsonl batch file with grading prompts for batch querying, excluding cached responses.
+    Generate a .jsonl batch file with grading prompts for batch querying, excluding cached responses
+    and prompts that are already part of a submitted batch.
 
     Args:
         grading_prompts (List[str]): List of grading prompts.
         batch_file_path (str): Path to save the batch file.
         grading_model: The grading model instance with cache support.
         uuids (List[str]): List of UUIDs corresponding to the prompts.
+        submitted_keys (Set[str], optional): Cache keys of prompts already submitted for grading.
+            Keys of the prompts added to this batch are added to the set.
+        deferred (List[Tuple[str, str]], optional): Receives the (UUID, prompt) of every prompt left
+            out because it is already part of a submitted batch.
 
     Returns:
         bool: True if a new batch file is created, False otherwise.
     """
     cache = grading_model.cache
     new_batch_requests = []
+    submitted_keys = submitted_keys if submitted_keys is not None else set()
 
-    # Only include prompts that are not in the cache
+    # Only include prompts that are neither cached nor already submitted; repeated prompts
+    # (e.g. two models giving the same answer) are graded once and read back from the cache
     for prompt, uuid in zip(grading_prompts, uuids):
         cache_key = grading_model.get_cache_key(prompt)
 
-        if cache_key not in cache:
-            batch_request = {
-                "custom_id": str(uuid),
-                "method": "POST",
-                "url": "/v1/chat/completions",
-                "body": {
-                    "model": grading_model.model_name,
-                    "messages": [
-                        {"role": "user", "content": prompt}
-                    ],
-                    "max_tokens": 1024,
-                    "temperature": 0
-                }
-            }
-            new_batch_requests.append(batch_request)
+        if cache_key in submitted_keys:
+            if deferred is not None:
+                deferred.append((uuid, prompt))
+        elif cache_key not in cache:
+            submitted_keys.add(cache_key)
+            # Same messages and generation settings as the grader's other query paths
+            new_batch_requests.append(grading_model.build_batch_request(str(uuid), prompt))
 
     # Delete any old batch file for the model
     if os.path.exists(batch_file_path):
@@ -221,7 +251,8 @@ def submit_batches(
     res_dir: str,
     query_col: str = 'question',
     gold_col: str = 'answer',
-    response_col: str = 'response'
+    response_col: str = 'response',
+    deferred: Optional[Dict[str, List[Tuple[str, str]]]] = None
 ) -> Dict[str, str]:
     """
     Submit batch files for BioScore grading for all models in models_to_use.
@@ -235,11 +266,16 @@ def submit_batches(
         query_col (str, optional): Column name for queries. Defaults to 'question'.
         gold_col (str, optional): Column name for gold answers. Defaults to 'answer'.
         response_col (str, optional): Column name for model responses. Defaults to 'response'.
+        deferred (Dict[str, List[Tuple[str, str]]], optional): Receives, for each model, the (UUID, prompt)
+            of the prompts left out of its batch because an earlier model's batch already holds them.
 
     Returns:
         Dict[str, str]: Dictionary mapping model names to batch IDs.
     """
     batch_ids = {}
+    # Prompts already in a submitted batch; their duplicates are answered from the cache once
+    # that batch is processed, since batches are polled in submission order
+    submitted_keys = set()
 
     for model in models_to_use:
         # Load the dataset
@@ -264,7 +300,9 @@ def submit_batches(
             bioscore_grading_prompts,
             batch_file_path,
             grading_model,
-            uuids
+            uuids,
+            submitted_keys,
+            deferred.setdefault(model, []) if deferred is not None else None
         )
 
         # Submit batch only if a new batch file was created
@@ -286,7 +324,8 @@ def poll_batch_results(
     res_dir: str,
     query_col: str = 'question',
     gold_col: str = 'answer',
-    response_col: str = 'response'
+    response_col: str = 'response',
+    poll_freq: int = 30
 ) -> Dict[str, float]:
     """
     Poll the batch results for a specific model and process the results.
@@ -299,13 +338,17 @@ def poll_batch_results(
         query_col (str, optional): Column name for queries. Defaults to 'question'.
         gold_col (str, optional): Column name for gold answers. Defaults to 'answer'.
         response_col (str, optional): Column name for model responses. Defaults to 'response'.
+        poll_freq (int, optional): Seconds between batch status checks. Defaults to 30.
 
     Returns:
         Dict[str, float]: Dictionary mapping UUIDs to BioScore results.
     """
     batch_id = batch_ids[model]
     print(f"Polling BioScore batch results for {model} with batch ID {batch_id}...")
-    batch_results = grading_model.poll_batch_status(batch_id)
+    batch_results = grading_model.poll_batch_status(batch_id, poll_freq)
+    if isinstance(batch_results, dict):
+        print(f"❌ BioScore batch for {model} returned no results: {batch_results.get('error')}")
+        return {}
 
     # Save the batch results to a JSONL file
     batch_result_path = f"{CACHE_DIR}/{model}_grading_batch_results.jsonl"
@@ -324,6 +367,39 @@ def poll_batch_results(
     return bioscore_results
 
 
+def grade_deferred_duplicates(
+    grading_model,
+    deferred: Dict[str, List[Tuple[str, str]]],
+    poll_freq: int = 30
+) -> None:
+    """
+    Grade repeated prompts whose grade is still missing after every batch was processed. A prompt
+    repeated across models is only submitted with the first model's batch, so if that batch failed
+    or returned an invalid grade, the later models' copies are submitted again in one follow-up
+    batch. Valid grades are cached and mapped to every model from the cache.
+
+    Args:
+        grading_model: The grading model instance with batch query support.
+        deferred (Dict[str, List[Tuple[str, str]]]): For each model, the (UUID, prompt) of the prompts
+            left out of its batch, as filled in by `submit_batches`.
+        poll_freq (int, optional): Seconds between batch status checks. Defaults to 30.
+    """
+    followup_name = '_duplicates'
+    prompts, custom_ids = [], []
+    for model, entries in deferred.items():
+        for uuid, prompt in entries:
+            prompts.append(prompt)
+            custom_ids.append(f"{model}:{uuid}")
+
+    batch_file_path = f"{CACHE_DIR}/{followup_name}_grading_batch.jsonl"
+    # Prompts graded in the meantime are skipped, and each missing prompt is submitted once
+    if not generate_batch_file(prompts, batch_file_path, grading_model, custom_ids, set()):
+        return
+    print("Submitting BioScore grading for repeated prompts with missing grades to GPT-4o batch API...")
+    batch_id = grading_model.submit_batch_query(batch_file_path)
+    poll_batch_results(grading_model, followup_name, {followup_name: batch_id}, None, poll_freq=poll_freq)
+
+
 def get_all_model_BioScore(
     res_dir: str,
     models_to_use: List[str],
@@ -339,7 +415,8 @@ def get_all_model_BioScore(
     Args:
         res_dir (str): Directory containing the model response CSV files.
         models_to_use (List[str]): List of model names to grade.
-        hyperparams (dict): Hyperparameters for the grading model.
+        hyperparams (dict): Hyperparameters for the grading model, including 'batch_poll_seconds'
+            between batch status checks (default 30).
         bioscore_grading_prompt (str): The grading prompt template.
         query_col (str, optional): Column name for queries. Defaults to 'question'.
         gold_col (str, optional): Column name for gold answers. Defaults to 'answer'.
@@ -354,10 +431,17 @@ def get_all_model_BioScore(
         grading_model_name,
         bioscore_system_prompt,
         max_new_tokens,
-        temperature
+        temperature,
+        cache_config=hyperparams.get('cache'),
+        base_url=hyperparams.get('base_url'),
+        prompt_prefix=get_template_prefix(bioscore_grading_prompt),
+        registry=load_model_registry(hyperparams.get('models'))
     )
 
+    poll_freq = hyperparams.get('batch_poll_seconds', 30)
+
     # Step 1: Submit batch files
+    deferred = {}
     batch_ids = submit_batches(
         grading_model,
         models_to_use,
@@ -365,23 +449,31 @@ def get_all_model_BioScore(
         res_dir,
         query_col,
         gold_col,
-        response_col
+        response_col,
+        deferred
     )
 
     # Step 2: Poll each model for batch results after all submissions
+    bioscore_results = {}
     for model in models_to_use:
         if model in batch_ids:
-            new_bioscore_results = poll_batch_results(
+            bioscore_results[model] = poll_batch_results(
                 grading_model,
                 model,
                 batch_ids,
                 res_dir,
                 query_col,
                 gold_col,
-                response_col
+                response_col,
+                poll_freq=poll_freq
             )
-        else:
-            new_bioscore_results = {}
+
+    # Step 3: Regrade repeated prompts whose first submission did not produce a valid grade
+    grade_deferred_duplicates(grading_model, deferred, poll_freq)
+
+    # Step 4: Map the grades to each model's responses
+    for model in models_to_use:
+        new_bioscore_results = bioscore_results.get(model, {})
 
         # Load the original dataset
         data = load_dataset(f'{res_dir}/{model}_responses.csv')
@@ -404,4 +496,5 @@ def get_all_model_BioScore(
 
     # Cleanup
     print("All batches submitted and results processed.")
+    print(grading_model.cache.stats_message())
     grading_model.delete()
\ No newline at end of file
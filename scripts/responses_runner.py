@@ -3,69 +3,32 @@ responses_runner.py
 
 This script collects responses from specified language models for a given set of queries.
 It initializes the appropriate model client, handles retries in case of failures,
-and saves the responses to a CSV file.
+and saves the responses to a CSV file. API-backed models can optionally be queried
+concurrently through their async clients.
 """
 
 import argparse
+import asyncio
+import hashlib
 import json
+import signal
+import sys
 import time
 import os
-from typing import List, Callable, Tuple
+from typing import List, Callable, Optional, Tuple
 
 import pandas as pd
 from tqdm import tqdm
 
 from scripts.scripts_utils import load_dataset, save_dataset
-from scripts.collect_responses.gpt_query import GPTQuery
-from scripts.collect_responses.gemini_query import GeminiQuery
-from scripts.collect_responses.claude_query import ClaudeQuery
-from scripts.collect_responses.perplexity_query import PerplexityQuery
-from scripts.collect_responses.huggingface_query import HuggingFaceQuery
+from scripts.collect_responses.checkpoint import ResponseCheckpoint, load_completed_responses, is_valid_response
+from scripts.collect_responses.query_result import QueryResult, METRIC_FIELDS, summarize_results, format_summary
+from scripts.collect_responses.retry_queue import RetryQueue, retry_delay, failed_result
+from scripts.collect_responses.model_registry import initialize_model, load_model_registry
+from scripts.collect_responses.shards import parse_shard, select_shard, shard_path, merge_shards
 
-
-def initialize_model(
-    model_name: str,
-    system_prompt: str,
-    max_new_tokens: int,
-    temperature: float
-):
-    """
-    Initialize the model client and create an instance of the query class for the specified model.
-
-    Args:
-        model_name (str): Name of the model to initialize.
-        system_prompt (str): System prompt to provide to the model.
-        max_new_tokens (int): Maximum number of tokens to generate.
-        temperature (float): Sampling temperature.
-
-    Returns:
-        An instance of the appropriate model query class.
-
-    Raises:
-        ValueError: If the model_name is not recognized.
-    """
-    if model_name == 'gpt-3.5-turbo':
-        return GPTQuery(system_prompt, 'gpt-3.5-turbo-0125', max_tokens=max_new_tokens, temperature=temperature)
-    elif model_name == 'gpt-4o':
-        return GPTQuery(system_prompt, 'gpt-4o-2024-05-13', max_tokens=max_new_tokens, temperature=temperature)
-    elif model_name == 'gpt-4.5-preview':
-        return GPTQuery(system_prompt, 'gpt-4.5-preview-2025-02-27', max_tokens=max_new_tokens, temperature=temperature)
-    elif model_name == 'gemini-1.5-pro':
-        return GeminiQuery(system_prompt, 'gemini-1.5-pro', max_tokens=max_new_tokens, temperature=temperature)
-    elif model_name == 'gemini-2.0-flash':
-        return GeminiQuery(system_prompt, 'gemini-2.0-flash', max_tokens=max_new_tokens, temperature=temperature)
-    elif model_name == 'claude-3.5-sonnet':
-        return ClaudeQuery(system_prompt, 'claude-3-5-sonnet-20240620', max_tokens=max_new_tokens, temperature=temperature)
-    elif model_name == 'claude-3.7-sonnet':
-        return ClaudeQuery(system_prompt, 'claude-3-7-sonnet-20250219', max_tokens=max_new_tokens, temperature=temperature)
-    elif model_name == 'perplexity-sonar-huge':
-        return PerplexityQuery(system_prompt, 'llama-3.1-sonar-huge-128k-online', max_tokens=max_new_tokens, temperature=temperature)
-    elif model_name == 'gemma-2-27b-it':
-        return HuggingFaceQuery(system_prompt, 'google/gemma-2-27b-it', max_tokens=max_new_tokens, do_sample=False)
-    elif model_name == 'llama-3.1-70b-it':
-        return HuggingFaceQuery(system_prompt, 'meta-llama/Meta-Llama-3.1-70B-Instruct', max_tokens=max_new_tokens, do_sample=False)
-    else:
-        raise ValueError(f"❌ Model '{model_name}' is not recognized.")
+# Directory for batch API request and result files
+BATCH_DIR = ".cache/batch_queries"
 
 
 def delete_model(query_instance) -> None:
@@ -101,33 +64,79 @@ def query_model_retries(
     query_checker: Callable[[str], Tuple[str, bool]],
     retries: int,
     initial_delay: int
-) -> str:
+) -> QueryResult:
     """
-    Query the model with retries in case of failure.
+    Query the model with retries in case of failure. Fatal errors (e.g. an invalid request or
+    API key) are not retried, and rate-limited queries wait for the server's Retry-After hint.
 
     Args:
         query (str): The query string to send to the model.
         query_instance: The model query instance.
         query_checker (Callable): A function to check the validity of the response.
-        retries (int): Number of retries allowed.
+        retries (int): Number of attempts allowed.
         initial_delay (int): Initial delay between retries.
 
     Returns:
-        str: The model's response or an error message.
+        QueryResult: The model's response or an error message, with the metrics of the last
+            attempt and the number of retries.
     """
-    retry_count = 0
-    delay = initial_delay
-    while retry_count < retries:
-        response = query_instance.query(query)
-        response, valid = query_checker(response)
+    failures = 0
+    while True:
+        result = query_instance.query_result(query)
+        _, valid = query_checker(result.response)
         if valid:
-            return response
+            result.retries = failures
+            return result
+        failures += 1
+        delay = retry_delay(result, failures, initial_delay)
+        if delay is None or failures >= retries:
+            return failed_result(query, result, failures)
+        print(f"❌ Error querying model ({result.error_type or 'transient'}). Retry {failures}/{retries} in {delay:.1f}s")
+        time.sleep(delay)
+
+
+async def query_model_retries_async(
+    query: str,
+    query_instance,
+    query_checker: Callable[[str], Tuple[str, bool]],
+    retries: int,
+    initial_delay: int,
+    semaphore: Optional[asyncio.Semaphore] = None
+) -> QueryResult:
+    """
+    Asynchronously query the model with retries in case of failure. Fatal errors are not
+    retried, and rate-limited queries wait for the server's Retry-After hint.
+
+    Args:
+        query (str): The query string to send to the model.
+        query_instance: The model query instance, which must provide an `aquery_result` coroutine.
+        query_checker (Callable): A function to check the validity of the response.
+        retries (int): Number of attempts allowed.
+        initial_delay (int): Initial delay between retries.
+        semaphore (asyncio.Semaphore, optional): Held only while a request is in flight, so
+            queries waiting out a backoff do not block other queries.
+
+    Returns:
+        QueryResult: The model's response or an error message, with the metrics of the last
+            attempt and the number of retries.
+    """
+    failures = 0
+    while True:
+        if semaphore is not None:
+            async with semaphore:
+                result = await query_instance.aquery_result(query)
         else:
-            retry_count += 1
-            print(f"❌ Error querying model. Retry {retry_count}/{retries}")
-            time.sleep(delay)
-            delay *= 2  # Exponential backoff
-    return f"ERROR: Failed getting response for '{query}' after {retries} retries. Last error: {response}"
+            result = await query_instance.aquery_result(query)
+        _, valid = query_checker(result.response)
+        if valid:
+            result.retries = failures
+            return result
+        failures += 1
+        delay = retry_delay(result, failures, initial_delay)
+        if delay is None or failures >= retries:
+            return failed_result(query, result, failures)
+        print(f"❌ Error querying model ({result.error_type or 'transient'}). Retry {failures}/{retries} in {delay:.1f}s")
+        await asyncio.sleep(delay)
 
 
 def collect_single_model_responses(
@@ -136,27 +145,275 @@ def collect_single_model_responses(
     queries: List[str],
     query_checker: Callable[[str], Tuple[str, bool]],
     retries: int,
-    initial_delay: int
-) -> List[str]:
+    initial_delay: int,
+    on_response: Optional[Callable[[int, QueryResult], None]] = None
+) -> List[QueryResult]:
     """
-    Collect responses from a specific model for a list of queries sequentially.
+    Collect responses from a specific model for a list of queries sequentially. Failed queries
+    are put on a retry queue instead of blocking: new queries keep running while they back off,
+    and each one is retried as soon as its backoff has passed.
 
     Args:
         model_name (str): Name of the model.
         query_instance: The model query instance.
         queries (List[str]): List of queries to send to the model.
         query_checker (Callable): A function to check the validity of responses.
+        retries (int): Number of attempts for each query.
+        initial_delay (int): Initial delay between retries.
+        on_response (Callable, optional): Called with the query index and result as each query completes.
+
+    Returns:
+        List[QueryResult]: Responses from the model with their query metrics.
+    """
+    results = [None] * len(queries)
+    retry_queue = RetryQueue(retries, initial_delay)
+    progress = tqdm(total=len(queries), desc=f"🔧 Running queries on {model_name}")
+
+    def attempt(i: int):
+        result = query_instance.query_result(queries[i])
+        _, valid = query_checker(result.response)
+        if valid:
+            result.retries = retry_queue.failure_count(i)
+        elif retry_queue.schedule(i, result):
+            return
+        else:
+            result = failed_result(queries[i], result, retry_queue.failure_count(i))
+        results[i] = result
+        progress.update(1)
+        if on_response is not None:
+            on_response(i, result)
+
+    for i in range(len(queries)):
+        for ready in retry_queue.pop_ready():
+            attempt(ready)
+        attempt(i)
+
+    # Only retries remain; sleep until the next one is due
+    while len(retry_queue):
+        time.sleep(retry_queue.wait_time())
+        for ready in retry_queue.pop_ready():
+            attempt(ready)
+    progress.close()
+    return results
+
+
+async def collect_single_model_responses_async(
+    model_name: str,
+    query_instance,
+    queries: List[str],
+    query_checker: Callable[[str], Tuple[str, bool]],
+    retries: int,
+    initial_delay: int,
+    max_concurrency: int,
+    on_response: Optional[Callable[[int, QueryResult], None]] = None
+) -> List[QueryResult]:
+    """
+    Collect responses from a specific model for a list of queries concurrently.
+    At most `max_concurrency` requests are in flight at once, and the responses
+    are returned in the same order as the queries. Queries backing off after an
+    error release their slot until they are retried.
+
+    Args:
+        model_name (str): Name of the model.
+        query_instance: The model query instance, which must provide an `aquery_result` coroutine.
+        queries (List[str]): List of queries to send to the model.
+        query_checker (Callable): A function to check the validity of responses.
         retries (int): Number of retries for each query.
         initial_delay (int): Initial delay between retries.
+        max_concurrency (int): Maximum number of requests in flight.
+        on_response (Callable, optional): Called with the query index and result as each query completes.
+
+    Returns:
+        List[QueryResult]: Responses from the model with their query metrics.
+    """
+    semaphore = asyncio.Semaphore(max(1, max_concurrency))
+    progress = tqdm(total=len(queries), desc=f"🔧 Running queries on {model_name} (x{max_concurrency})")
+
+    async def run_query(i: int, query: str) -> QueryResult:
+        result = await query_model_retries_async(query, query_instance, query_checker, retries, initial_delay, semaphore)
+        progress.update(1)
+        if on_response is not None:
+            on_response(i, result)
+        return result
+
+    try:
+        results = await asyncio.gather(*(run_query(i, query) for i, query in enumerate(queries)))
+    finally:
+        progress.close()
+        await query_instance.aclose()
+    return list(results)
+
+
+def collect_single_model_responses_batched(
+    model_name: str,
+    query_instance,
+    queries: List[str],
+    query_checker: Callable[[str], Tuple[str, bool]],
+    retries: int,
+    initial_delay: int,
+    on_response: Optional[Callable[[int, QueryResult], None]] = None
+) -> List[QueryResult]:
+    """
+    Collect responses from a local model through its batched query API. All queries are handed to
+    `stream_batch_results`, which keeps the model's batch full and yields each response as soon as it
+    finishes; queries whose batched response fails the check are retried one at a time.
+
+    Args:
+        model_name (str): Name of the model.
+        query_instance: The model query instance, which must provide `stream_batch_results`.
+        queries (List[str]): List of queries to send to the model.
+        query_checker (Callable): A function to check the validity of responses.
+        retries (int): Number of retries for each failed query.
+        initial_delay (int): Initial delay between retries.
+        on_response (Callable, optional): Called with the query index and result as each query completes.
+
+    Returns:
+        List[QueryResult]: Responses from the model with their query metrics.
+    """
+    results = [None] * len(queries)
+    progress = tqdm(total=len(queries), desc=f"🔧 Running batched queries on {model_name}")
+    for i, result in query_instance.stream_batch_results(queries):
+        _, valid = query_checker(result.response)
+        if not valid:
+            result = query_model_retries(queries[i], query_instance, query_checker, retries, initial_delay)
+            result.retries += 1
+        results[i] = result
+        if on_response is not None:
+            on_response(i, result)
+        progress.update(1)
+    progress.close()
+    return results
+
+
+def collect_single_model_responses_batch_api(
+    model_name: str,
+    query_instance,
+    queries: List[str],
+    custom_ids: List[str],
+    query_checker: Callable[[str], Tuple[str, bool]],
+    retries: int,
+    initial_delay: int,
+    poll_freq: int = 30,
+    on_response: Optional[Callable[[int, QueryResult], None]] = None,
+    batch_name: Optional[str] = None
+) -> List[QueryResult]:
+    """
+    Collect responses from a specific model by submitting every uncached query as one batch
+    through the provider's batch API. Results are mapped back by custom ID and stored in the
+    model's response cache; repeated queries are submitted once, and queries without a valid
+    batch result are queried directly. The
+    batch ID is kept in `BATCH_DIR` with a hash of the submitted requests until the batch finishes;
+    if polling fails, the pending queries are returned as errors and a restarted run with the same
+    requests resumes polling the same batch. A saved batch built from different requests is discarded.
+
+    Args:
+        model_name (str): Name of the model.
+        query_instance: The model query instance, which must provide `build_batch_request`,
+            `parse_batch_result`, `submit_batch_query` and `poll_batch_status`.
+        queries (List[str]): List of queries to send to the model.
+        custom_ids (List[str]): Unique identifier for each query, e.g. the question UUIDs.
+        query_checker (Callable): A function to check the validity of responses.
+        retries (int): Number of retries for queries answered directly.
+        initial_delay (int): Initial delay between retries.
+        poll_freq (int, optional): Seconds between batch status checks. Defaults to 30.
+        on_response (Callable, optional): Called with the query index and result as each query completes.
+        batch_name (str, optional): Prefix of the batch files in `BATCH_DIR`. Defaults to `{model_name}_responses`.
 
     Returns:
-        List[str]: List of responses from the model.
+        List[QueryResult]: Responses from the model with their query metrics.
     """
-    responses = []
-    for query in tqdm(queries, desc=f"🔧 Running queries on {model_name}"):
-        response = query_model_retries(query, query_instance, query_checker, retries, initial_delay)
-        responses.append(response)
-    return responses
+    batch_name = batch_name or f"{model_name}_responses"
+    results = [None] * len(queries)
+    batch_requests = []
+    polling_failed = False
+    # Repeated queries are submitted once and share the first occurrence's result
+    first_index = {}
+    duplicates = {}
+    for i, (custom_id, query) in enumerate(zip(custom_ids, queries)):
+        cache_key = query_instance.get_cache_key(query)
+        if cache_key in first_index:
+            duplicates[i] = first_index[cache_key]
+        elif cache_key in query_instance.cache:
+            results[i] = QueryResult(query_instance.cache[cache_key], cache_hit=True)
+        else:
+            first_index[cache_key] = i
+            batch_requests.append(query_instance.build_batch_request(custom_id, query))
+
+    if batch_requests:
+        os.makedirs(BATCH_DIR, exist_ok=True)
+        batch_file_path = os.path.join(BATCH_DIR, f"{batch_name}_batch.jsonl")
+        batch_id_path = os.path.join(BATCH_DIR, f"{batch_name}_batch_id.txt")
+
+        batch_lines = ''.join(json.dumps(request) + '\n' for request in batch_requests)
+        batch_hash = hashlib.sha256(batch_lines.encode('utf-8')).hexdigest()
+
+        # Resume polling a batch submitted by an interrupted run instead of paying for it twice,
+        # as long as it was built from the same requests
+        batch_id = None
+        if os.path.exists(batch_id_path):
+            with open(batch_id_path, 'r') as f:
+                saved_id, _, saved_hash = f.read().strip().partition('\n')
+            if saved_id and saved_hash.strip() == batch_hash:
+                batch_id = saved_id
+            else:
+                print(f"⚠️  Discarding saved batch {saved_id or '(empty)'} for {model_name}: it was built from different requests")
+                os.remove(batch_id_path)
+        if batch_id is not None:
+            print(f"🔧 Resuming batch {batch_id} for {model_name}")
+        else:
+            with open(batch_file_path, 'w') as f:
+                f.write(batch_lines)
+            print(f"🔧 Submitting {len(batch_requests)} queries for {model_name} to the batch API...")
+            batch_id = query_instance.submit_batch_query(batch_file_path)
+            if not isinstance(batch_id, dict):
+                # The hash of the submitted requests is kept next to the ID to validate a resume
+                with open(batch_id_path, 'w') as f:
+                    f.write(f"{batch_id}\n{batch_hash}")
+        batch_results = batch_id if isinstance(batch_id, dict) else query_instance.poll_batch_status(batch_id, poll_freq)
+        # Keep the batch ID if polling itself failed, so the next run picks the batch up again
+        polling_failed = isinstance(batch_results, dict) and batch_results.get('error', '').startswith("Error during batch polling")
+        if not polling_failed and os.path.exists(batch_id_path):
+            os.remove(batch_id_path)
+
+        if isinstance(batch_results, dict):
+            print(f"❌ Batch collection failed for {model_name}: {batch_results.get('error')}")
+        else:
+            batch_result_path = os.path.join(BATCH_DIR, f"{batch_name}_batch_results.jsonl")
+            with open(batch_result_path, 'w') as f:
+                f.write(batch_results)
+            print(f"🔧 Batch results saved for {model_name} to {batch_result_path}")
+
+            # Map results back to queries by custom ID and fill the cache
+            query_index = {custom_id: i for i, custom_id in enumerate(custom_ids)}
+            for line in batch_results.splitlines():
+                if not line.strip():
+                    continue
+                custom_id, response = query_instance.parse_batch_result(json.loads(line))
+                i = query_index.get(custom_id)
+                if i is None or response is None or not query_checker(response)[1]:
+                    continue
+                results[i] = QueryResult(response)
+                query_instance.cache[query_instance.get_cache_key(queries[i])] = response
+            query_instance.save_cache()
+            for i, first in duplicates.items():
+                if results[first] is not None:
+                    results[i] = QueryResult(results[first].response, cache_hit=True)
+
+    missing = sum(result is None for result in results)
+    if missing and polling_failed:
+        # Leave the queries to the resumed batch rather than paying for them twice
+        print(f"⚠️  {missing} queries are still pending in batch {batch_id} for {model_name}, rerun to resume polling")
+    elif missing:
+        print(f"⚠️  {missing} queries have no batch result for {model_name}, querying them directly")
+    for i, query in enumerate(queries):
+        if results[i] is None:
+            if polling_failed:
+                results[i] = QueryResult(f"ERROR: Batch {batch_id} still pending for '{query}'")
+            else:
+                results[i] = query_model_retries(query, query_instance, query_checker, retries, initial_delay)
+        if on_response is not None:
+            on_response(i, results[i])
+    return results
 
 
 def get_model_responses(
@@ -166,10 +423,17 @@ def get_model_responses(
     hyperparams: dict,
     query_col: str = 'question',
     retries: int = 3,
-    initial_delay: int = 2
+    initial_delay: int = 2,
+    collection_mode: str = 'sync',
+    checkpoint_every: int = 25,
+    shard: Optional[Tuple[int, int]] = None
 ) -> pd.DataFrame:
     """
     Get responses from a single LLM for each query in the dataset and save the results.
+    Completed responses are checkpointed as they arrive, and UUIDs that already have a valid
+    response in a previous results file or checkpoint, collected with the same prompt and generation
+    settings (`{model}_cache_key`), are not queried again. Each response's query metrics (latency,
+    token usage, retries, cache hit) are saved as `{model}_<metric>` columns.
 
     Args:
         data (pd.DataFrame): DataFrame containing the queries.
@@ -179,32 +443,153 @@ def get_model_responses(
         query_col (str, optional): Column name containing the queries. Defaults to 'question'.
         retries (int, optional): Number of retries for each query. Defaults to 3.
         initial_delay (int, optional): Initial delay between retries. Defaults to 2.
+        collection_mode (str, optional): 'sync' to query one question at a time, 'async' to keep
+            up to `hyperparams['max_concurrency']` requests in flight, or 'batch' to submit the split
+            through the provider's batch API. Defaults to 'sync'. Local models with a batched query
+            API always keep up to `hyperparams['batch_size']` prompts generating at a time.
+        checkpoint_every (int, optional): Number of completed responses between checkpoint writes. Defaults to 25.
+        shard (Tuple[int, int], optional): Shard index and number of shards when `data` is one shard of the
+            split; results are then saved to the shard's partial results file. Defaults to None.
 
     Returns:
         pd.DataFrame: DataFrame with the model responses added.
     """
-    data[f'{model_name}_response'] = ''
+    response_col = f'{model_name}_response'
+    cache_key_col = f'{model_name}_cache_key'
+    metric_cols = {metric: f'{model_name}_{metric}' for metric in METRIC_FIELDS}
+    os.makedirs(res_by_model_dir, exist_ok=True)
+    if shard is not None:
+        save_path = shard_path(res_by_model_dir, model_name, *shard)
+    else:
+        save_path = os.path.join(res_by_model_dir, f'{model_name}_responses.csv')
+    results_name = os.path.splitext(os.path.basename(save_path))[0]
+    checkpoint = ResponseCheckpoint(
+        os.path.join(res_by_model_dir, f'{results_name}.checkpoint.jsonl'),
+        flush_every=checkpoint_every
+    )
+
     # Extract hyperparameters
     system_prompt = hyperparams.get('system_prompt', '')
     max_new_tokens = hyperparams.get('max_new_tokens', 1024)
     temperature = hyperparams.get('temperature', 0.0)
-
-    query_instance = initialize_model(model_name, system_prompt, max_new_tokens, temperature)
-    responses = collect_single_model_responses(
-        model_name,
-        query_instance,
-        data[query_col].tolist(),
-        check_model_response,
-        retries,
-        initial_delay,
+    max_concurrency = hyperparams.get('max_concurrency', 1)
+    rate_limit = hyperparams.get('rate_limit')
+    cache_config = hyperparams.get('cache')
+    batch_size = hyperparams.get('batch_size') or 8
+
+    query_instance = initialize_model(
+        model_name, system_prompt, max_new_tokens, temperature, rate_limit, cache_config, batch_size,
+        model_store_config=hyperparams.get('model_store'),
+        connection_config=hyperparams.get('connection'),
+        base_url=hyperparams.get('base_url'),
+        hedging=hyperparams.get('hedging'),
+        cpu_config=hyperparams.get('cpu'),
+        continuous_batching=hyperparams.get('continuous_batching', True),
+        registry=load_model_registry(hyperparams.get('models'))
     )
-    data[f'{model_name}_response'] = responses
+    queries = data[query_col].tolist()
+    uuids = data['uuid'].astype(str).tolist()
+    cache_keys = {uuid: query_instance.get_cache_key(query) for uuid, query in zip(uuids, queries)}
+
+    # Resume from responses completed by previous runs with the same prompt and generation settings
+    completed = load_completed_responses(
+        save_path,
+        checkpoint,
+        response_col,
+        lambda response: is_valid_response(response, check_model_response),
+        metric_cols,
+        cache_keys=cache_keys,
+        cache_key_col=cache_key_col
+    )
+    pending = [i for i, uuid in enumerate(uuids) if uuid not in completed]
+    if completed:
+        print(f"🔧 Resuming {model_name}: {len(data) - len(pending)} responses already collected, {len(pending)} remaining")
+
+    if hasattr(query_instance, 'stream_batch_results'):
+        collection_mode = 'batched'
+    elif collection_mode == 'async' and not hasattr(query_instance, 'aquery'):
+        print(f"⚠️  {model_name} has no async client, falling back to sync collection")
+        collection_mode = 'sync'
+    elif collection_mode == 'batch' and getattr(query_instance, 'build_batch_request', None) is None:
+        print(f"⚠️  {model_name} has no batch API support, falling back to sync collection")
+        collection_mode = 'sync'
+
+    pending_queries = [queries[i] for i in pending]
+
+    def record_response(i: int, result: QueryResult):
+        completed_uuid = uuids[pending[i]]
+        checkpoint.add(completed_uuid, result.response, result.metrics(), cache_key=cache_keys[completed_uuid])
+        if is_valid_response(result.response, check_model_response):
+            completed[completed_uuid] = {'response': result.response, **result.metrics()}
+
+    collection_start = time.perf_counter()
+    try:
+        if collection_mode == 'batched':
+            results = collect_single_model_responses_batched(
+                model_name,
+                query_instance,
+                pending_queries,
+                check_model_response,
+                retries,
+                initial_delay,
+                on_response=record_response,
+            )
+        elif collection_mode == 'batch':
+            results = collect_single_model_responses_batch_api(
+                model_name,
+                query_instance,
+                pending_queries,
+                [uuids[i] for i in pending],
+                check_model_response,
+                retries,
+                initial_delay,
+                on_response=record_response,
+                batch_name=results_name,
+            )
+        elif collection_mode == 'async':
+            results = asyncio.run(collect_single_model_responses_async(
+                model_name,
+                query_instance,
+                pending_queries,
+                check_model_response,
+                retries,
+                initial_delay,
+                max_concurrency,
+                on_response=record_response,
+            ))
+        else:
+            results = collect_single_model_responses(
+                model_name,
+                query_instance,
+                pending_queries,
+                check_model_response,
+                retries,
+                initial_delay,
+                on_response=record_response,
+            )
+    finally:
+        checkpoint.flush()
+    elapsed = time.perf_counter() - collection_start
+    pending_results = dict(zip(pending, results))
+    records = [
+        {'response': pending_results[i].response, **pending_results[i].metrics()} if i in pending_results else completed[uuid]
+        for i, uuid in enumerate(uuids)
+    ]
+    data[response_col] = [record['response'] for record in records]
+    data[cache_key_col] = [cache_keys[uuid] for uuid in uuids]
+    for metric, col in metric_cols.items():
+        data[col] = [record.get(metric) for record in records]
+    print(query_instance.cache.stats_message())
+    hedger = getattr(query_instance, 'hedger', None)
+    if hedger is not None and hedger.enabled:
+        print(hedger.stats_message())
+        hedger.shutdown()
+    if results:
+        print(format_summary(model_name, summarize_results(results, elapsed)))
     delete_model(query_instance)
 
-    # Ensure the directory exists
-    os.makedirs(res_by_model_dir, exist_ok=True)
-    save_path = os.path.join(res_by_model_dir, f'{model_name}_responses.csv')
     save_dataset(save_path, data)
+    checkpoint.remove()
     return data
 
 
@@ -222,17 +607,23 @@ def main():
     parser.add_argument('--model_name', type=str, required=True, 
         help="Specify a single model to run"
     )
-    parser.add_argument('--hyperparams', type=str, required=True, 
-        help='Model hyperparameters as JSON string'
+    parser.add_argument('--hyperparams', type=str,
+        help='Model hyperparameters as JSON string (required unless merging shards)'
+    )
+    parser.add_argument('--collection_mode', type=str, choices=['sync', 'async', 'batch'], default='sync',
+        help="Query questions one at a time ('sync'), concurrently through async clients ('async'), "
+             "or as one submission to the provider's batch API ('batch')"
+    )
+    parser.add_argument('--shard', type=str,
+        help="Only collect shard 'i/N' of the split (0 <= i < N), selected by UUID hash"
+    )
+    parser.add_argument('--merge_shards', type=int, metavar='N',
+        help="Merge the model's N shard results into its responses file instead of querying"
     )
     args = parser.parse_args()
 
-    # Deserialize hyperparameters
-    try:
-        hyperparams = json.loads(args.hyperparams)
-    except json.JSONDecodeError as e:
-        print(f"❌ Error parsing hyperparameters JSON: {e}")
-        return
+    # Turn SLURM's SIGTERM into an exception so pending checkpoints are flushed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
 
     qa_path = args.qa_path
     res_by_model_dir = args.res_by_model_dir
@@ -243,12 +634,44 @@ def main():
         print("❌ No data to process. Exiting.")
         return
 
+    if args.merge_shards:
+        try:
+            merged = merge_shards(data, model_name, res_by_model_dir, args.merge_shards)
+        except ValueError as e:
+            print(e)
+            sys.exit(1)
+        print(f"✅ Merged {args.merge_shards} shards into {len(merged)} responses for {model_name}")
+        return
+
+    if args.hyperparams is None:
+        print("❌ --hyperparams is required to collect responses.")
+        sys.exit(1)
+
+    # Deserialize hyperparameters
+    try:
+        hyperparams = json.loads(args.hyperparams)
+    except json.JSONDecodeError as e:
+        print(f"❌ Error parsing hyperparameters JSON: {e}")
+        return
+
+    shard = None
+    if args.shard:
+        try:
+            shard = parse_shard(args.shard)
+        except ValueError as e:
+            print(e)
+            sys.exit(1)
+        data = select_shard(data, *shard)
+        print(f"🔧 Shard {args.shard}: {len(data)} Q/A selected")
+
     print(f"🔧 Getting model responses on {len(data)} Q/A for {model_name}")
     data = get_model_responses(
         data,
         model_name=model_name,
         res_by_model_dir=res_by_model_dir,
-        hyperparams=hyperparams
+        hyperparams=hyperparams,
+        collection_mode=args.collection_mode,
+        shard=shard
     )
     print(f"🔧 Responses collected and saved to for {model_name}")
 
@@ -56,6 +56,12 @@ def parse_arguments():
     parser.add_argument('--run_graphs', action='store_true',
         help='Run graphs generation step'
     )
+    parser.add_argument('--shard', type=str,
+        help="With --run_responses, only collect shard 'i/N' of the split (e.g. one SLURM array task)"
+    )
+    parser.add_argument('--merge_shards', type=int, metavar='N',
+        help="Merge N response shards per model into their responses files, then continue with the other steps"
+    )
     return parser.parse_args()
 
 def load_configuration(config_path):
@@ -98,6 +104,134 @@ def setup_environment(config):
     stream_message(f"🔧 Set HF_HOME to {relative_hf_home}")
     stream_message(f"🔧 Set HF_DATASETS_CACHE to {relative_hf_datasets_cache}")
 
+def run_model_jobs(jobs, limits, log_dir=None, poll_interval=1.0):
+    """
+    Run one subprocess per model, keeping at most `limits[resource]` jobs of each resource
+    class running at once. Jobs start in the given order as slots free up.
+
+    Args:
+        jobs (list): Job dictionaries with 'name', 'cmd' and 'resource' keys.
+        limits (dict): Maximum number of concurrent jobs per resource, e.g. {'api': 4, 'local': 1}.
+        log_dir (str, optional): Directory for per-model log files. If None, jobs write to this
+            process's stdout, which is only readable when a single job runs at a time.
+        poll_interval (float, optional): Seconds between checks for finished jobs. Defaults to 1.0.
+
+    Returns:
+        dict: Mapping of model name to a result with 'exit_code', 'duration' and 'log_path'.
+    """
+    if log_dir is not None:
+        os.makedirs(log_dir, exist_ok=True)
+    pending = list(jobs)
+    running = {}
+    results = {}
+    try:
+        while pending or running:
+            # Start every pending job whose resource class has a free slot
+            for job in list(pending):
+                in_use = sum(1 for active in running.values() if active['job']['resource'] == job['resource'])
+                if in_use >= max(1, limits.get(job['resource'], 1)):
+                    continue
+                pending.remove(job)
+                log_path = os.path.join(log_dir, f"{job['name']}.log") if log_dir is not None else None
+                log_file = open(log_path, 'w') if log_path is not None else None
+                process = subprocess.Popen(
+                    job['cmd'],
+                    stdout=log_file,
+                    stderr=subprocess.STDOUT if log_file else None,
+                    # Unbuffered output keeps log files current while jobs run
+                    env={**os.environ, 'PYTHONUNBUFFERED': '1'}
+                )
+                running[job['name']] = {
+                    'job': job, 'process': process, 'log_file': log_file,
+                    'log_path': log_path, 'start': time.monotonic()
+                }
+                log_message = f" (log: {os.path.relpath(log_path, start=BASE_DIR)})" if log_path else ""
+                stream_message(f"🔧 Starting response generation for model: {job['name']}{log_message}")
+
+            time.sleep(poll_interval if running else 0)
+            for name, active in list(running.items()):
+                exit_code = active['process'].poll()
+                if exit_code is None:
+                    continue
+                if active['log_file'] is not None:
+                    active['log_file'].close()
+                results[name] = {
+                    'exit_code': exit_code,
+                    'duration': time.monotonic() - active['start'],
+                    'log_path': active['log_path']
+                }
+                del running[name]
+                if exit_code == 0:
+                    stream_message(f"✅ Completed response generation for model: {name}")
+                else:
+                    stream_message(f"❌ Response generation failed for model: {name} (exit code {exit_code})")
+    finally:
+        # Stop any remaining jobs on interrupt; the runners checkpoint on SIGTERM
+        for active in running.values():
+            active['process'].terminate()
+        for active in running.values():
+            active['process'].wait()
+            if active['log_file'] is not None:
+                active['log_file'].close()
+    return results
+
+def print_job_summary(results):
+    """
+    Print the exit code, duration and log file of every model job.
+
+    Args:
+        results (dict): Job results as returned by `run_model_jobs`.
+    """
+    print("-" * 100)
+    for name, result in results.items():
+        status = "✅" if result['exit_code'] == 0 else "❌"
+        minutes, seconds = divmod(int(result['duration']), 60)
+        log_path = os.path.relpath(result['log_path'], start=BASE_DIR) if result['log_path'] else "-"
+        print(f"{status} {name:<30} exit code {result['exit_code']:<4} {minutes:>4}m{seconds:02d}s  {log_path}")
+    print("-" * 100)
+
+def split_rate_limit(rate_limit, parts):
+    """
+    Divide a provider quota evenly between jobs that run at the same time, since each job
+    process throttles itself with its own rate limiter.
+
+    Args:
+        rate_limit (dict): Quota with 'requests_per_minute' and 'tokens_per_minute', or None.
+        parts (int): Number of jobs sharing the quota at once.
+
+    Returns:
+        dict: Each job's share of the quota, or None if the provider is unthrottled.
+    """
+    if not rate_limit or parts <= 1:
+        return rate_limit
+    return {key: value / parts if value else value for key, value in rate_limit.items()}
+
+def merge_model_shards(models, qa_path, res_by_model_dir, num_shards):
+    """
+    Merge each model's shard results into its `{model}_responses.csv`.
+
+    Args:
+        models (list): Names of the models to merge.
+        qa_path (str): Path to the QA CSV file the shards were taken from.
+        res_by_model_dir (str): Directory holding the shard files.
+        num_shards (int): Number of shards per model.
+
+    Returns:
+        list: Names of the models whose shards could not be merged.
+    """
+    failed = []
+    for model_name in models:
+        cmd = [
+            'python', '-m', 'scripts.responses_runner',
+            '--qa_path', qa_path,
+            '--res_by_model_dir', res_by_model_dir,
+            '--model_name', model_name,
+            '--merge_shards', str(num_shards)
+        ]
+        if subprocess.run(cmd).returncode != 0:
+            failed.append(model_name)
+    return failed
+
 def run_responses(args, config):
     """
     Run the response generation step.
@@ -115,6 +249,9 @@ def run_responses(args, config):
         'system_prompt': system_prompt,
         'max_new_tokens': model_params.get('max_tokens', 1024),
         'temperature': model_params.get('temperature', 0.0),
+        'cache': config.get('cache'),
+        'model_store': config.get('model_store'),
+        'models': config['models'],
     }
 
     # Get paths from the config
@@ -125,6 +262,12 @@ def run_responses(args, config):
     res_dir = config['paths'].get('output_directory', './results/')
     res_by_model_dir = os.path.abspath(os.path.join(res_dir, 'by_model/'))
 
+    # Response collection settings
+    collection_mode = config.get('collection', {}).get('mode', 'sync')
+    num_shards = config.get('collection', {}).get('shards', 1) or 1
+    providers = config.get('providers', {})
+    model_types = {model['name']: model.get('type') for model in config['models']}
+
     # Determine models to run
     models_to_run = [model['name'] for model in config['models'] if model.get('use', False)]
 
@@ -136,23 +279,101 @@ def run_responses(args, config):
             stream_message(f"❌ Model '{args.model}' not found in configuration.")
             sys.exit(1)
 
+    # Scheduler limits: API models mostly wait on the network, local models share the accelerator
+    scheduler = config.get('scheduler', {})
+    limits = {
+        'api': scheduler.get('max_api_jobs', 1),
+        'local': scheduler.get('max_local_jobs', 1),
+    }
+    logs_directory = config['paths'].get('logs_directory', './logs/')
+    log_dir = os.path.abspath(os.path.join(logs_directory, 'responses'))
+
+    # Every job of a provider that can run at the same time gets an equal share of its quota:
+    # the provider's models and shards up to the scheduler limit, times the tasks of a SLURM array
+    shards_per_job = num_shards if num_shards > 1 and not args.shard else 1
+    array_tasks = int(args.shard.split('/')[-1]) if args.shard else 1
+    concurrent_jobs = {}
+    for model_name in models_to_run:
+        concurrent_jobs[model_types[model_name]] = concurrent_jobs.get(model_types[model_name], 0) + shards_per_job
+
     stream_message("🚀 Running response generation step")
+    jobs = []
     for model_name in models_to_run:
-        model_hyperparams_str = json.dumps(model_hyperparams)
+        provider_config = providers.get(model_types[model_name], {})
+        resource = 'local' if model_types[model_name] == 'huggingface' else 'api'
+        quota_parts = min(concurrent_jobs[model_types[model_name]], limits[resource]) * array_tasks
+        model_hyperparams_str = json.dumps({
+            **model_hyperparams,
+            'max_concurrency': provider_config.get('max_concurrency', 1),
+            'rate_limit': split_rate_limit(provider_config.get('rate_limit'), quota_parts),
+            'batch_size': provider_config.get('batch_size'),
+            'connection': provider_config.get('connection'),
+            'base_url': provider_config.get('base_url'),
+            'hedging': provider_config.get('hedging'),
+            'cpu': provider_config.get('cpu'),
+            'continuous_batching': provider_config.get('continuous_batching', True),
+        })
         cmd = [
             'python', '-m', 'scripts.responses_runner',
             '--qa_path', qa_path,
             '--res_by_model_dir', res_by_model_dir,
             '--model_name', model_name,
-            '--hyperparams', model_hyperparams_str
+            '--hyperparams', model_hyperparams_str,
+            '--collection_mode', provider_config.get('collection_mode', collection_mode)
         ]
-        stream_message(f"🔧 Starting response generation for model: {model_name}")
-        try:
-            subprocess.run(cmd, check=True)
-            stream_message(f"✅ Completed response generation for model: {model_name}")
-        except subprocess.CalledProcessError as e:
-            stream_message(f"❌ Response generation failed for model: {model_name}")
-    stream_message("✅ Completed response generation for all models")
+        if args.shard:
+            # A single shard of a sharded run, e.g. one task of a SLURM job array
+            jobs.append({'name': model_name, 'model': model_name, 'cmd': cmd + ['--shard', args.shard], 'resource': resource})
+        elif num_shards > 1:
+            for index in range(num_shards):
+                jobs.append({
+                    'name': f"{model_name}.shard-{index}-of-{num_shards}",
+                    'model': model_name,
+                    'cmd': cmd + ['--shard', f"{index}/{num_shards}"],
+                    'resource': resource,
+                })
+        else:
+            jobs.append({'name': model_name, 'model': model_name, 'cmd': cmd, 'resource': resource})
+
+    # A single job keeps its output on the console; concurrent jobs each get a log file
+    results = run_model_jobs(jobs, limits, log_dir=log_dir if len(jobs) > 1 else None)
+    print_job_summary(results)
+    failed = sorted({job['model'] for job in jobs if results[job['name']]['exit_code'] != 0})
+
+    # Combine the shards of every model whose shard jobs all succeeded
+    if num_shards > 1 and not args.shard:
+        merged = [model_name for model_name in models_to_run if model_name not in failed]
+        failed += merge_model_shards(merged, qa_path, res_by_model_dir, num_shards)
+    if failed:
+        stream_message(f"❌ Response generation failed for {len(failed)} model(s): {', '.join(failed)}")
+    else:
+        stream_message("✅ Completed response generation for all models")
+
+def run_merge(args, config):
+    """
+    Run the shard merge step for response collection split across separate jobs.
+
+    Args:
+        args (argparse.Namespace): Command-line arguments.
+        config (dict): Configuration dictionary.
+    """
+    dataset_directory = config['paths'].get('dataset_directory', './data/')
+    split_type = config['dataset'].get('split', 'test')
+    dataset_name = f"CARDBiomedBench_{split_type}.csv"
+    qa_path = os.path.abspath(os.path.join(dataset_directory, dataset_name))
+    res_dir = config['paths'].get('output_directory', './results/')
+    res_by_model_dir = os.path.abspath(os.path.join(res_dir, 'by_model/'))
+
+    models_to_merge = [model['name'] for model in config['models'] if model.get('use', False)]
+    if args.model:
+        models_to_merge = [args.model]
+
+    stream_message(f"🚀 Merging {args.merge_shards} response shards per model")
+    failed = merge_model_shards(models_to_merge, qa_path, res_by_model_dir, args.merge_shards)
+    if failed:
+        stream_message(f"❌ Shard merge failed for {len(failed)} model(s): {', '.join(failed)}")
+        sys.exit(1)
+    stream_message("✅ Merged response shards for all models")
 
 def run_metrics(args, config):
     """
@@ -172,6 +393,11 @@ def run_metrics(args, config):
         'system_prompt': bioscore_system_prompt,
         'max_new_tokens': model_params.get('max_tokens', 1024),
         'temperature': model_params.get('temperature', 0.0),
+        'cache': config.get('cache'),
+        'model_store': config.get('model_store'),
+        'models': config['models'],
+        # The BioScore grading model is an OpenAI model
+        'base_url': config.get('providers', {}).get('openai', {}).get('base_url'),
     }
 
     # Get paths from the config
@@ -253,8 +479,8 @@ def main():
     setup_environment(config)
 
     # Determine if at least one step is selected
-    if not (args.run_responses or args.run_metrics or args.run_graphs):
-        stream_message("❌ No execution flags provided. Please specify at least one of --run_responses, --run_metrics, --run_graphs.")
+    if not (args.run_responses or args.run_metrics or args.run_graphs or args.merge_shards):
+        stream_message("❌ No execution flags provided. Please specify at least one of --run_responses, --merge_shards, --run_metrics, --run_graphs.")
         sys.exit(1)
 
     if args.run_responses:
@@ -262,6 +488,9 @@ def main():
     else:
         stream_message("⚠️  Skipping response generation step  ⚠️")
 
+    if args.merge_shards:
+        run_merge(args, config)
+
     if args.run_metrics:
         run_metrics(args, config)
     else: